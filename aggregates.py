@@ -0,0 +1,164 @@
+import math
+from sqlalchemy import and_, case, func, or_
+from sqlalchemy.dialects.sqlite import insert
+from models import Reading, ReadingAggregate
+
+def round_mean(value_sum, number_of_readings):
+    """Returns the mean rounded to two digits like round(avg(value), 2) in SQL"""
+    return round(value_sum / number_of_readings, 2)
+
+def device_type_key(row):
+    """Groups rows by device and sensor type"""
+    return row['device_uuid'], row['type']
+
+def accumulate(rows, key=device_type_key):
+    """Returns the aggregates of rows grouped by key
+
+    Returns a dict mapping the key of a row to a list of
+    [number_of_readings, value_sum, min_value, min_date_created, max_value, max_date_created].
+    Ties of min or max are resolved to the earliest date_created.
+    """
+    groups = {}
+    for row in rows:
+        value = row['value']
+        date_created = row['date_created']
+        row_key = key(row)
+        group = groups.get(row_key)
+        if group is None:
+            groups[row_key] = [1, value, value, date_created, value, date_created]
+            continue
+        merge(group, (1, value, value, date_created, value, date_created))
+    return groups
+
+def merge(group, other):
+    """Merges the aggregates other into group, both in the format returned by accumulate"""
+    group[0] += other[0]
+    group[1] += other[1]
+    if other[2] < group[2] or (other[2] == group[2] and other[3] < group[3]):
+        group[2] = other[2]
+        group[3] = other[3]
+    if other[4] > group[4] or (other[4] == group[4] and other[5] < group[5]):
+        group[4] = other[4]
+        group[5] = other[5]
+    return group
+
+def _replaces(excluded_value, excluded_date, value, date_created, compare):
+    """SQL condition whether the excluded min/max replaces the stored one"""
+    return or_(compare(excluded_value, value),
+               and_(excluded_value == value, excluded_date < date_created))
+
+def upsert_statement(table, index_elements):
+    """Returns an insert statement merging its aggregate columns into an existing row of table
+
+    table needs the columns number_of_readings, value_sum, min_value, min_date_created,
+    max_value and max_date_created and a unique constraint on index_elements.
+    """
+    statement = insert(table)
+    excluded = statement.excluded
+    replaces_min = _replaces(excluded.min_value, excluded.min_date_created,
+                             table.c.min_value, table.c.min_date_created, lambda a, b: a < b)
+    replaces_max = _replaces(excluded.max_value, excluded.max_date_created,
+                             table.c.max_value, table.c.max_date_created, lambda a, b: a > b)
+    return statement.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={'number_of_readings': table.c.number_of_readings + excluded.number_of_readings,
+              'value_sum': table.c.value_sum + excluded.value_sum,
+              'min_value': case((replaces_min, excluded.min_value), else_=table.c.min_value),
+              'min_date_created': case((replaces_min, excluded.min_date_created), else_=table.c.min_date_created),
+              'max_value': case((replaces_max, excluded.max_value), else_=table.c.max_value),
+              'max_date_created': case((replaces_max, excluded.max_date_created), else_=table.c.max_date_created)})
+
+def group_parameters(key, group):
+    """Returns the aggregate columns of a group as returned by accumulate merged into key"""
+    return dict(key,
+                number_of_readings=group[0],
+                value_sum=group[1],
+                min_value=group[2],
+                min_date_created=group[3],
+                max_value=group[4],
+                max_date_created=group[5])
+
+def update_aggregates(session, rows):
+    """Merges rows into the reading_aggregates table
+
+    Must be called in the transaction inserting rows into readings,
+    so the aggregates never diverge from the readings.
+    """
+    groups = accumulate(rows)
+    if not groups:
+        return
+    table = ReadingAggregate.__table__
+    statement = upsert_statement(table, [table.c.device_uuid, table.c.type])
+    session.execute(statement, [group_parameters({'device_uuid': device_uuid, 'type': sensor_type}, group)
+                                for (device_uuid, sensor_type), group in groups.items()])
+
+def lookup(session, device_uuid, sensor_type):
+    """Returns the ReadingAggregate of a device and sensor type or None if there are no readings"""
+    return session.query(ReadingAggregate).get((device_uuid, sensor_type))
+
+def _expected_aggregates_query(session):
+    """Query computing the reading_aggregates rows from the readings table"""
+    return session.query(Reading.device_uuid,
+                         Reading.type,
+                         func.count(),
+                         func.total(Reading.value),
+                         func.min(Reading.value),
+                         func.max(Reading.value)).\
+                   group_by(Reading.device_uuid, Reading.type)
+
+def _extreme_date_created(session, device_uuid, sensor_type, value):
+    """Returns the earliest date_created of the readings of a device holding value"""
+    return session.query(func.min(Reading.date_created)).\
+                   filter(Reading.device_uuid==device_uuid).\
+                   filter(Reading.type==sensor_type).\
+                   filter(Reading.value==value).scalar()
+
+def rebuild_aggregates(session):
+    """Recomputes the reading_aggregates table from the readings table and commits
+
+    Returns the number of aggregate rows.
+    """
+    session.query(ReadingAggregate).delete()
+    count = 0
+    for device_uuid, sensor_type, number_of_readings, value_sum, min_value, max_value in _expected_aggregates_query(session).all():
+        session.add(ReadingAggregate(device_uuid=device_uuid,
+                                     type=sensor_type,
+                                     number_of_readings=number_of_readings,
+                                     value_sum=value_sum,
+                                     min_value=min_value,
+                                     min_date_created=_extreme_date_created(session, device_uuid, sensor_type, min_value),
+                                     max_value=max_value,
+                                     max_date_created=_extreme_date_created(session, device_uuid, sensor_type, max_value)))
+        count += 1
+    session.commit()
+    return count
+
+def check_aggregates(session):
+    """Compares the reading_aggregates table with aggregates computed from the readings table
+
+    Returns a list of (device_uuid, type) keys whose aggregates differ or are missing.
+    """
+    expected = dict(((row[0], row[1]), tuple(row[2:])) for row in _expected_aggregates_query(session))
+    stored = dict(((row.device_uuid, row.type), (row.number_of_readings, row.value_sum, row.min_value, row.max_value))
+                  for row in session.query(ReadingAggregate))
+    return sorted(key for key in expected.keys() | stored.keys() if not _same_aggregates(expected.get(key), stored.get(key)))
+
+def missing_aggregates(session):
+    """Returns the sorted (device_uuid, type) keys of readings without a reading_aggregates row
+
+    The summaries without start and end are ordered from reading_aggregates, so these devices
+    are left out of them until the aggregates are rebuilt.
+    """
+    query = session.query(Reading.device_uuid, Reading.type).\
+                    outerjoin(ReadingAggregate, and_(ReadingAggregate.device_uuid==Reading.device_uuid,
+                                                     ReadingAggregate.type==Reading.type)).\
+                    filter(ReadingAggregate.device_uuid.is_(None)).\
+                    distinct().\
+                    order_by(Reading.device_uuid, Reading.type)
+    return [(device_uuid, sensor_type) for device_uuid, sensor_type in query]
+
+def _same_aggregates(expected, stored):
+    if expected is None or stored is None:
+        return expected is stored
+    #The incrementally maintained sum of fractional values may differ in the last digits
+    return expected[0] == stored[0] and math.isclose(expected[1], stored[1]) and expected[2:] == stored[2:]
@@ -0,0 +1,91 @@
+import itertools
+import aggregates
+import db
+import histograms
+import queries
+from models import Reading
+
+#NumPy is optional, without it QUANTILE_ENGINE can not be 'numpy'
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def to_value(value):
+    """Returns a NumPy scalar as int if it is integral, like the readings table stores it"""
+    value = float(value)
+    return int(value) if value.is_integer() else value
+
+def fetch_arrays(session, device_uuid, sensor_type, start=None, end=None):
+    """Returns the date_created and value of the readings of a device as float64 arrays
+
+    The rows are read with the raw DBAPI cursor of the session and packed into a single
+    interleaved array while they are fetched, so no ORM row objects are created and a reading
+    takes 16 bytes. Epoch dates are exact in a float64.
+    """
+    packed = fetch_packed(session, queries.filter_readings(session.query(Reading.date_created, Reading.value),
+                                                           device_uuid, sensor_type, start, end))
+    return packed[:, 0], packed[:, 1]
+
+def fetch_packed(session, query):
+    """Returns the rows of a query of numeric columns as float64 array of one row per reading
+
+    The rows are read with the raw DBAPI cursor of the session, see fetch_arrays.
+    """
+    sql, parameters = db.compile_query(session, query)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(sql, parameters)
+        packed = np.fromiter(itertools.chain.from_iterable(cursor), dtype=np.float64)
+    finally:
+        cursor.close()
+    return packed.reshape(-1, len(query.column_descriptions))
+
+def value_counts(values):
+    """Returns the sorted (value, number_of_readings) tuples of a float64 array of values"""
+    unique, counts = np.unique(values, return_counts=True)
+    return [(to_value(value), int(count)) for value, count in zip(unique, counts)]
+
+def statistics(dates, values, percentiles=()):
+    """Computes every metric of the readings given as arrays by fetch_arrays
+
+    The values are sorted once, all quantiles, the mode and min/max are read from the sorted
+    array. The quartiles use the ranks of histograms.quartile_ranks and percentiles the nearest
+    rank. Ties of min, max and median resolve to the earliest date_created, ties of the mode to
+    the smallest value.
+
+    Returns None if there are no readings.
+    """
+    number_of_readings = len(values)
+    if number_of_readings == 0:
+        return None
+    sorted_values = np.sort(values)
+    #Start of every run of equal values in the sorted array
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_values)) + 1))
+    counts = np.diff(np.append(starts, number_of_readings))
+    mode = int(np.argmax(counts))
+
+    def reading(value):
+        return {'value': to_value(value), 'date_created': to_value(dates[values == value].min())}
+
+    quartile_1_rank, median_rank, quartile_3_rank = histograms.quartile_ranks(number_of_readings)
+    return {'number_of_readings': number_of_readings,
+            'min': reading(sorted_values[0]),
+            'max': reading(sorted_values[-1]),
+            'mean': aggregates.round_mean(float(values.sum()), number_of_readings),
+            'quartile_1': to_value(sorted_values[quartile_1_rank - 1]),
+            'median': reading(sorted_values[median_rank - 1]),
+            'quartile_3': to_value(sorted_values[quartile_3_rank - 1]),
+            'mode': {'value': to_value(sorted_values[starts[mode]]), 'number_of_readings': int(counts[mode])},
+            'percentiles': dict((percentile, to_value(sorted_values[histograms.percentile_rank(number_of_readings, percentile) - 1]))
+                                for percentile in percentiles)}
+
+def range_values(session, device_uuid, sensor_type, start=None, end=None):
+    """Returns the sorted values of the readings of a device in a date range as float64 array"""
+    _, values = fetch_arrays(session, device_uuid, sensor_type, start, end)
+    values.sort()
+    return values
+
+def value_at_rank(sorted_values, rank):
+    """Returns the value with the 1-based rank of an array returned by range_values"""
+    return to_value(sorted_values[rank - 1])
@@ -1,20 +1,46 @@
+import atexit
+import click
+import functools
 import json
+import signal
+import threading
 import time
-from flask import Flask, request
+from flask import Blueprint, Flask, Response, current_app, request, stream_with_context
 from flask.json import jsonify
-from jsonschema import validate, ValidationError
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, create_engine, func
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.exc import MultipleResultsFound
-
-Base = declarative_base()
+from jsonschema import ValidationError
+import aggregates
+import analytics
+import asgi
+import cache
+import columnar
+import db
+import downsampling
+import histograms
+import ingest
+import parallel
+import queries
+import rollups
+import sharding
+import sketches
+import storage
+import summary
+import validation
 
 HTTP_UNPROCESSABLE_ENTITY = 422 #https://tools.ietf.org/html/rfc4918#section-11.2
 DATE_MIN = 0
 SENSOR_MIN = 0
 SENSOR_MAX = 100
 VALID_SENSOR_TYPES = ['temperature', 'humidity']
+BATCH_MAX_READINGS = 10000
+FLEET_MAX_DEVICES = 1000
+DOWNSAMPLE_MAX_POINTS = 10000
+DOWNSAMPLE_METHODS = ['aggregate', 'lttb']
+PAGE_DEFAULT_LIMIT = 1000
+PAGE_MAX_LIMIT = 10000
+QUANTILE_PRECISIONS = ['exact', 'approx']
+QUANTILE_ENGINES = ['histograms', 'numpy']
+STORAGE_ENGINES = ['sqlite', 'sharded', 'memory', 'columnar']
+SERVER_MODES = ['wsgi', 'asgi']
 
 #JSONschema for HTTP POST request to /devices/<string:device_uuid>/readings/
 request_device_readings_schema_post = {
@@ -34,6 +60,7 @@ request_device_readings_schema_post = {
    },
    'required': ['type','value']
 }
+request_device_readings_post_validator = validation.compile_validator(request_device_readings_schema_post)
 
 #JSONschema for HTTP GET request to /devices/<string:device_uuid>/readings/
 request_device_readings_schema_get = {
@@ -50,20 +77,21 @@ request_device_readings_schema_get = {
            'type': 'number',
            'minimum': DATE_MIN,
        },
+       'limit': {
+           'type': 'integer',
+           'minimum': 1,
+           'maximum': PAGE_MAX_LIMIT,
+       },
+       'cursor': {
+           'type': 'string',
+       },
    },
    'required': []
 }
+request_device_readings_get_validator = validation.compile_validator(request_device_readings_schema_get)
 
-class Reading(Base):
-    """Sqlalchemy ORM Class for readings table"""
-    __tablename__ = 'readings'
-    id = Column(Integer, primary_key=True, autoincrement=True)
-    device_uuid = Column(String)
-    type = Column(String)
-    value = Column(Integer)
-    date_created = Column(Integer)
-
-app = Flask(__name__)
+bp = Blueprint('readings', __name__)
+ingest_queue_lock = threading.Lock()
 
 def normalize_quartiles(q_list):
     """This function normalize quartiles of format [a] [a,b] and [a,b,c] to [a,b,c,d]
@@ -88,15 +116,116 @@ def normalize_quartiles(q_list):
         return [(1,) + q_list[0][1:], (2,) + q_list[1][1:], (3,) + q_list[2][1:], (4,) + q_list[2][1:]]
     return [q_list[0], q_list[1], q_list[2], q_list[3]]
 
-def get_db_session():
-    """Returns a valid db session for sqlalchemy"""
-    if app.config['TESTING']:
-        engine = create_engine("sqlite:///test_database.db")
-    else:
-        engine = create_engine("sqlite:///database.db")
-    return sessionmaker(bind=engine)()
+def iter_json_list(rows, chunk_size):
+    """Encodes rows incrementally as JSON list
+
+    The rows are encoded and yielded in chunks of chunk_size rows, so neither the rows
+    nor the full JSON document are held in memory at once.
 
-@app.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'])
+    Parameters:
+        rows: Iterable of result rows
+        chunk_size: Number of rows encoded per yielded string
+    """
+    yield '['
+    separator = ''
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(dict(row), sort_keys=True, separators=(',', ':')))
+        if len(chunk) >= chunk_size:
+            yield separator + ','.join(chunk)
+            separator = ','
+            chunk = []
+    if chunk:
+        yield separator + ','.join(chunk)
+    yield ']'
+
+def get_storage():
+    """Returns the storage engine of the current app, see storage.Storage"""
+    return current_app.extensions['storage']
+
+def bump_result_cache(app, rows):
+    """Invalidates the cached metric results of the devices of rows committed outside of a request"""
+    result_cache = app.extensions.get('result_cache')
+    if result_cache is not None:
+        result_cache.bump(set(row['device_uuid'] for row in rows))
+
+def get_ingest_queue():
+    """Returns the ingest queue of the current app and starts its writer thread on first use
+
+    The queue is flushed by serve and the ASGI lifespan shutdown, and by atexit otherwise.
+    """
+    app = current_app._get_current_object()
+    with ingest_queue_lock:
+        ingest_queue = app.extensions.get('ingest_queue')
+        if ingest_queue is None:
+            ingest_queue = ingest.IngestQueue(app.extensions['storage'].insert_many,
+                                              app.config['INGEST_QUEUE_SIZE'],
+                                              app.config['INGEST_BATCH_ROWS'],
+                                              app.config['INGEST_BATCH_INTERVAL'],
+                                              app.config['INGEST_QUEUE_TIMEOUT'],
+                                              functools.partial(bump_result_cache, app))
+            app.extensions['ingest_queue'] = ingest_queue
+            atexit.register(close_ingest_queue, app)
+    return ingest_queue
+
+def close_ingest_queue(app):
+    """Commits everything queued in the ingest queue of app, if it was started, and stops accepting readings"""
+    ingest_queue = app.extensions.get('ingest_queue')
+    if ingest_queue is not None:
+        ingest_queue.close()
+
+def cached_result(view):
+    """Caches the successful responses of a per device metric endpoint in the result cache
+
+    Results are keyed by endpoint, device_uuid and the canonical JSON of the query parameters,
+    i.e. type, start, end and endpoint specific ones. Requests which can not be parsed are
+    passed to the endpoint, which rejects them.
+    """
+    @functools.wraps(view)
+    def wrapper(device_uuid):
+        result_cache = current_app.extensions.get('result_cache')
+        if result_cache is None:
+            return view(device_uuid)
+        try:
+            data = json.loads(request.data) if request.data else {}
+        except json.JSONDecodeError:
+            return view(device_uuid)
+        key = (request.endpoint, device_uuid, json.dumps(data, sort_keys=True))
+        payload = result_cache.get(key, device_uuid)
+        if payload is not None:
+            return Response(payload, 200, mimetype=current_app.config['JSONIFY_MIMETYPE'])
+        generation = result_cache.generation(device_uuid)
+        response = current_app.make_response(view(device_uuid))
+        if response.status_code == 200:
+            result_cache.put(key, device_uuid, generation, response.get_data())
+        return response
+    return wrapper
+
+def write_readings(rows):
+    """Inserts and commits rows in the storage engine of the current request"""
+    get_storage().insert_many(rows)
+    bump_result_cache(current_app, rows)
+
+def store_readings(rows):
+    """Writes rows to the storage engine according to INGEST_MODE and INGEST_DURABILITY
+
+    In 'direct' mode the rows are committed by the request. In 'queued' mode they are handed
+    to the ingest queue and, unless INGEST_DURABILITY is 'commit', the request returns before
+    they are committed.
+
+    Returns the HTTP status code for the response, 201 if the rows are committed
+    and 202 if they are only queued.
+    """
+    if current_app.config['INGEST_MODE'] != 'queued':
+        write_readings(rows)
+        return 201
+    future = get_ingest_queue().submit(rows)
+    if current_app.config['INGEST_DURABILITY'] == 'commit':
+        future.result()
+        return 201
+    return 202
+
+@bp.route('/devices/<string:device_uuid>/readings/', methods = ['POST', 'GET'])
 def request_device_readings(device_uuid):
     """
     This endpoint allows clients to POST or GET data specific sensor types.
@@ -111,12 +240,14 @@ def request_device_readings(device_uuid):
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
     * type -> The type of sensor value a client is looking for
+    * limit -> The maximum number of readings per page
+    * cursor -> The next_cursor of the previous page
+
+    The readings are streamed as chunked JSON list. If limit or cursor are given,
+    a single page of readings ordered by date_created is returned as
+    {'readings': [...], 'next_cursor': <cursor or null>}.
     """
 
-    # Set the db that we want and open the connection
-    session = None
-    with app.app_context():
-        session = get_db_session()
     data = {}
     if request.data:
         try:
@@ -125,50 +256,172 @@ def request_device_readings(device_uuid):
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
 
     if request.method == 'POST':
-        try:
-            validate(instance=data, schema=request_device_readings_schema_post)
-        except ValidationError as validation_error:
-            return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
-         # Grab the post parameters
-        sensor_type = data.get('type')
-        value = data.get('value')
-        date_created = data.get('date_created', int(time.time()))
+        error = reading_error(data)
+        if error is not None:
+            return (f'Validation Error: {error}'), HTTP_UNPROCESSABLE_ENTITY
         # Insert data into db
-        reading = Reading(device_uuid=device_uuid,
-                          type=sensor_type,
-                          value=value,
-                          date_created=date_created)
-        session.add(reading)
-        session.commit()
+        try:
+            status = store_readings([ingest.reading_row(device_uuid, data)])
+        except ingest.IngestQueueFull as exception:
+            return (f'Service Unavailable: {exception}'), 503
 
         # Return success
-        return 'success', 201
+        return 'success', status
     elif request.method == 'GET':
         try:
-            validate(instance=data, schema=request_device_readings_schema_get)
+            validation.validate(request_device_readings_get_validator, data)
         except ValidationError as validation_error:
             return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
         sensor_type = data.get('type')
         start = data.get('start')
         end = data.get('end')
-        query = session.query(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created)\
-                       .filter(Reading.device_uuid==device_uuid)
-        if sensor_type is not None:
-            query = query.filter(Reading.type==sensor_type)
-        if start is not None:
-            query = query.filter(Reading.date_created >= start)
-        if end is not None:
-            query = query.filter(Reading.date_created <= end)
+        if 'limit' in data or 'cursor' in data:
+            return readings_page(device_uuid, data, sensor_type, start, end)
 
-        result = query.all()
-        if len(result) == 0:
-            return jsonify([]), 200
+        chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+        readings = get_storage().readings(device_uuid, sensor_type, start, end, chunk_size)
 
-        return jsonify([dict(row) for row in result]), 200
+        return Response(stream_with_context(iter_json_list(readings, chunk_size)), mimetype='application/json'), 200
 
     return (f'Invalid request method {request.method}'), HTTP_UNPROCESSABLE_ENTITY
 
+def readings_page(device_uuid, data, sensor_type, start, end):
+    """Returns the response for a single page of readings of a device using keyset pagination"""
+    limit = data.get('limit', PAGE_DEFAULT_LIMIT)
+    after = None
+    if 'cursor' in data:
+        try:
+            after = queries.decode_cursor(data['cursor'])
+        except ValueError as exception:
+            return (f'Validation Error: {exception}'), HTTP_UNPROCESSABLE_ENTITY
+
+    readings, after = get_storage().readings_page(device_uuid, limit, after, sensor_type, start, end)
+
+    return jsonify({'readings': readings,
+                    'next_cursor': None if after is None else queries.encode_cursor(*after)}), 200
+
+#JSONschema for HTTP POST request to /devices/<string:device_uuid>/readings/batch/
+#Every item is validated separately against request_device_readings_schema_post
+request_device_readings_batch_schema = {
+   'type': 'array',
+   'minItems': 1,
+   'maxItems': BATCH_MAX_READINGS,
+}
+request_device_readings_batch_validator = validation.compile_validator(request_device_readings_batch_schema)
+
+@bp.route('/devices/<string:device_uuid>/readings/batch/', methods = ['POST'])
+def request_device_readings_batch(device_uuid):
+    """
+    This endpoint allows clients to POST many readings of a device at once.
+
+    POST Parameters:
+    * A list of readings, each with the parameters of a single POST
+      to /devices/<uuid>/readings/
+
+    All valid readings are inserted in a single transaction. Invalid readings are
+    rejected and reported by their index in the list.
+    """
+    data = None
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_device_readings_batch_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    now = int(time.time())
+    rows = []
+    errors = []
+    for index, item in enumerate(data):
+        error = reading_error(item)
+        if error is not None:
+            errors.append({'index': index, 'error': error})
+            continue
+        rows.append(ingest.reading_row(device_uuid, item, now))
+
+    status = HTTP_UNPROCESSABLE_ENTITY
+    if rows:
+        try:
+            status = store_readings(rows)
+        except ingest.IngestQueueFull as exception:
+            return (f'Service Unavailable: {exception}'), 503
+
+    return jsonify({'accepted': len(rows),
+                    'rejected': len(errors),
+                    'errors': errors}), status
+
+#JSONschema for every line of a HTTP POST request to /readings/ingest/
+request_fleet_reading_schema = {
+   'type': 'object',
+   'properties': {
+       'device_uuid': {
+           'type': 'string',
+           'minLength': 1,
+       },
+       'type': {
+           "enum": VALID_SENSOR_TYPES,
+       },
+       'value': {
+           'type': 'number',
+           'minimum': SENSOR_MIN,
+           'maximum': SENSOR_MAX,
+       },
+       'date_created': {
+           'type': 'number',
+       },
+   },
+   'required': ['device_uuid','type','value']
+}
+request_fleet_reading_validator = validation.compile_validator(request_fleet_reading_schema)
+
+def reading_error(data, require_device_uuid=False):
+    """Returns the validation error message of a reading or None if it is valid
+
+    Uses the hand written validation.reading_error if FAST_READING_VALIDATION is set
+    and the precompiled jsonschema validator otherwise. Both accept the same readings.
+
+    Parameters:
+        data: The reading payload
+        require_device_uuid: Validate against request_fleet_reading_schema
+            instead of request_device_readings_schema_post
+    """
+    if current_app.config['FAST_READING_VALIDATION']:
+        return validation.reading_error(data, VALID_SENSOR_TYPES, SENSOR_MIN, SENSOR_MAX, require_device_uuid)
+    validator = request_fleet_reading_validator if require_device_uuid else request_device_readings_post_validator
+    try:
+        validation.validate(validator, data)
+    except ValidationError as validation_error:
+        return validation_error.message
+    return None
+
+@bp.route('/readings/ingest/', methods = ['POST'])
+def request_fleet_readings_ingest():
+    """
+    This endpoint allows gateways to POST readings of many devices at once.
+
+    POST Parameters:
+    * A newline delimited JSON stream (application/x-ndjson). Every line is a reading
+      with the parameters of a single POST to /devices/<uuid>/readings/ and the
+      device_uuid of the device it belongs to.
+
+    The body is parsed incrementally and committed in chunks of INGEST_CHUNK_SIZE readings.
+    Rejected lines are reported by their line number.
+    """
+    accepted, rejected, errors = ingest.ingest_ndjson(write_readings,
+                                                      request.stream,
+                                                      functools.partial(reading_error, require_device_uuid=True),
+                                                      current_app.config['INGEST_CHUNK_SIZE'],
+                                                      current_app.config['INGEST_MAX_LINE_BYTES'],
+                                                      current_app.config['INGEST_MAX_ERRORS'])
+
+    return jsonify({'accepted': accepted,
+                    'rejected': rejected,
+                    'errors': errors}), 201 if accepted else HTTP_UNPROCESSABLE_ENTITY
+
 request_device_readings_metric_schema = {
    'type': 'object',
    'properties': {
@@ -186,8 +439,10 @@ request_device_readings_metric_schema = {
    },
    'required': ['type']
 }
+request_device_readings_metric_validator = validation.compile_validator(request_device_readings_metric_schema)
 
-@app.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
+@bp.route('/devices/<string:device_uuid>/readings/min/', methods = ['GET'])
+@cached_result
 def request_device_readings_min(device_uuid):
     """
     This endpoint allows clients to GET the min sensor reading for a device.
@@ -200,14 +455,13 @@ def request_device_readings_min(device_uuid):
     * end -> The epoch end time for a sensor being created
     """
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_device_readings_metric_schema)
+        validation.validate(request_device_readings_metric_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -215,28 +469,17 @@ def request_device_readings_min(device_uuid):
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
-    query = session.query(Reading.device_uuid, Reading.type, func.min(Reading.value).label('value'), Reading.date_created) \
-                   .filter(Reading.device_uuid==device_uuid) \
-                   .filter(Reading.type==sensor_type)
-    if start_date is not None:
-        query = query.filter(Reading.date_created >= start_date)
-    if end_date is not None:
-        query = query.filter(Reading.date_created <= end_date)
-
-    result = None
-    try:
-        result = query.one_or_none()
-    except MultipleResultsFound as exception:
-        return (f'Internal Server Error: {exception}'), 500
-
-    if not all(result):
+    result = get_storage().aggregate(device_uuid, sensor_type, start_date, end_date)
+    if result is None:
         return jsonify({}), 200
 
-    return jsonify(dict(result)), 200
+    return jsonify({'device_uuid': device_uuid,
+                    'type': sensor_type,
+                    'value': result[2],
+                    'date_created': result[3]}), 200
 
-@app.route('/devices/<string:device_uuid>/readings/max/', methods = ['GET'])
+@bp.route('/devices/<string:device_uuid>/readings/max/', methods = ['GET'])
+@cached_result
 def request_device_readings_max(device_uuid):
     """
     This endpoint allows clients to GET the max sensor reading for a device.
@@ -249,14 +492,13 @@ def request_device_readings_max(device_uuid):
     * end -> The epoch end time for a sensor being created
     """
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_device_readings_metric_schema)
+        validation.validate(request_device_readings_metric_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -264,29 +506,40 @@ def request_device_readings_max(device_uuid):
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
-
-    query = session.query(Reading.device_uuid, Reading.type, func.max(Reading.value).label('value'), Reading.date_created) \
-                   .filter(Reading.device_uuid==device_uuid) \
-                   .filter(Reading.type==sensor_type)
-    if start_date is not None:
-        query = query.filter(Reading.date_created >= start_date)
-    if end_date is not None:
-        query = query.filter(Reading.date_created <= end_date)
-
-    result = None
-    try:
-        result = query.one_or_none()
-    except MultipleResultsFound as exception:
-        return (f'Internal Server Error: {exception}'), 500
-
-    if not all(result):
+    result = get_storage().aggregate(device_uuid, sensor_type, start_date, end_date)
+    if result is None:
         return jsonify({}), 200
 
-    return jsonify(dict(result)), 200
+    return jsonify({'device_uuid': device_uuid,
+                    'type': sensor_type,
+                    'value': result[4],
+                    'date_created': result[5]}), 200
 
-@app.route('/devices/<string:device_uuid>/readings/median/', methods = ['GET'])
+#JSONschema for HTTP GET request to /devices/<string:device_uuid>/median/
+request_device_readings_median_schema = {
+   'type': 'object',
+   'properties': {
+       'type': {
+            "enum": VALID_SENSOR_TYPES,
+       },
+       'start': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'end': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'precision': {
+            "enum": QUANTILE_PRECISIONS,
+       },
+   },
+   'required': ['type']
+}
+request_device_readings_median_validator = validation.compile_validator(request_device_readings_median_schema)
+
+@bp.route('/devices/<string:device_uuid>/readings/median/', methods = ['GET'])
+@cached_result
 def request_device_readings_median(device_uuid):
     """
     This endpoint allows clients to GET the median sensor reading for a device.
@@ -297,16 +550,16 @@ def request_device_readings_median(device_uuid):
     Optional Query Parameters
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * precision -> 'exact' (default) or 'approx' to answer from the quantile sketches
     """
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_device_readings_metric_schema)
+        validation.validate(request_device_readings_median_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -314,30 +567,22 @@ def request_device_readings_median(device_uuid):
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
-
-    quartile_cte = session.query(Reading.date_created, Reading.value, func.ntile(4).over(order_by=Reading.value).label('quartiles'))\
-                          .filter(Reading.device_uuid==device_uuid)\
-                          .filter(Reading.type==sensor_type)
-    if start_date is not None:
-        quartile_cte = quartile_cte.filter(Reading.date_created >= start_date)
-    if end_date is not None:
-        quartile_cte = quartile_cte.filter(Reading.date_created <= end_date)
-    quartile_cte = quartile_cte.cte('p')
-    query = session.query(quartile_cte.c.quartiles, func.max(quartile_cte.c.value), quartile_cte.c.date_created,).group_by(quartile_cte.c.quartiles)
-    result = query.all()
-    if len(result) == 0:
+    quantiles = get_storage().quantiles(device_uuid, sensor_type, start_date, end_date, data.get('precision'))
+    if quantiles is None:
         return jsonify({}), 200
 
-    quartiles = normalize_quartiles(result)
+    number_of_readings, value_at_rank = quantiles
+    _, median_rank, _ = histograms.quartile_ranks(number_of_readings)
+    value = value_at_rank(median_rank)
+    date_created = get_storage().earliest_date_created(device_uuid, sensor_type, value, start_date, end_date)
 
     return jsonify({'device_uuid': device_uuid,
                      'type': sensor_type,
-                     'value': quartiles[1][1],
-                     'date_created': quartiles[1][2]}), 200
+                     'value': value,
+                     'date_created': date_created}), 200
 
-@app.route('/devices/<string:device_uuid>/readings/mean/', methods = ['GET'])
+@bp.route('/devices/<string:device_uuid>/readings/mean/', methods = ['GET'])
+@cached_result
 def request_device_readings_mean(device_uuid):
     """
     This endpoint allows clients to GET the mean sensor readings for a device.
@@ -351,14 +596,13 @@ def request_device_readings_mean(device_uuid):
     """
 
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_device_readings_metric_schema)
+        validation.validate(request_device_readings_metric_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -366,26 +610,10 @@ def request_device_readings_mean(device_uuid):
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
-
-    query = session.query(func.round(func.avg(Reading.value),2).label("value")) \
-                   .filter(Reading.device_uuid==device_uuid) \
-                   .filter(Reading.type==sensor_type)
-    if start_date is not None:
-        query = query.filter(Reading.date_created >= start_date)
-    if end_date is not None:
-        query = query.filter(Reading.date_created <= end_date)
-
-    result = None
-    try:
-        result = dict(query.one_or_none())
-    except MultipleResultsFound as exception:
-        return (f'Internal Server Error: {exception}'), 500
-
-    if result['value'] is None:
+    result = get_storage().aggregate(device_uuid, sensor_type, start_date, end_date)
+    if result is None:
         return jsonify({}), 200
-    return jsonify(result), 200
+    return jsonify({'value': aggregates.round_mean(result[1], result[0])}), 200
 
 #JSONschema for HTTP GET request to /devices/<string:device_uuid>/quartiles/
 request_device_readings_quartiles_schema = {
@@ -402,11 +630,16 @@ request_device_readings_quartiles_schema = {
            'type': 'number',
            'minimum': DATE_MIN,
        },
+       'precision': {
+            "enum": QUANTILE_PRECISIONS,
+       },
    },
    'required': ['type','start','end']
 }
+request_device_readings_quartiles_validator = validation.compile_validator(request_device_readings_quartiles_schema)
 
-@app.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
+@bp.route('/devices/<string:device_uuid>/readings/quartiles/', methods = ['GET'])
+@cached_result
 def request_device_readings_quartiles(device_uuid):
     """
     This endpoint allows clients to GET the 1st and 3rd quartile
@@ -416,16 +649,123 @@ def request_device_readings_quartiles(device_uuid):
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+
+    Optional Query Parameters
+    * precision -> 'exact' (default) or 'approx' to answer from the quantile sketches
+    """
+    data = {}
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_device_readings_quartiles_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    sensor_type = data.get('type')
+    start_date = data.get('start')
+    end_date = data.get('end')
+
+    quantiles = get_storage().quantiles(device_uuid, sensor_type, start_date, end_date, data.get('precision'))
+    if quantiles is None:
+        return jsonify({}), 200
+
+    number_of_readings, value_at_rank = quantiles
+    quartile_1_rank, _, quartile_3_rank = histograms.quartile_ranks(number_of_readings)
+
+    return jsonify({'quartile_1': value_at_rank(quartile_1_rank),
+                     'quartile_3': value_at_rank(quartile_3_rank)}), 200
+
+#JSONschema for HTTP GET request to /devices/<string:device_uuid>/percentile/
+request_device_readings_percentile_schema = {
+   'type': 'object',
+   'properties': {
+       'type': {
+            "enum": VALID_SENSOR_TYPES,
+       },
+       'percentile': {
+           'type': 'number',
+           'minimum': 0,
+           'maximum': 100,
+       },
+       'start': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'end': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'precision': {
+            "enum": QUANTILE_PRECISIONS,
+       },
+   },
+   'required': ['type','percentile']
+}
+request_device_readings_percentile_validator = validation.compile_validator(request_device_readings_percentile_schema)
+
+@bp.route('/devices/<string:device_uuid>/readings/percentile/', methods = ['GET'])
+@cached_result
+def request_device_readings_percentile(device_uuid):
+    """
+    This endpoint allows clients to GET the nearest rank percentile
+    sensor reading value for a device.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+    * percentile -> The percentile from 0 to 100
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * precision -> 'exact' (default) or 'approx' to answer from the quantile sketches
+    """
+    data = {}
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_device_readings_percentile_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    sensor_type = data.get('type')
+    start_date = data.get('start')
+    end_date = data.get('end')
+
+    quantiles = get_storage().quantiles(device_uuid, sensor_type, start_date, end_date, data.get('precision'))
+    if quantiles is None:
+        return jsonify({}), 200
+
+    number_of_readings, value_at_rank = quantiles
+
+    return jsonify({'value': value_at_rank(histograms.percentile_rank(number_of_readings, data['percentile']))}), 200
+
+@bp.route('/devices/<string:device_uuid>/readings/mode/', methods = ['GET'])
+@cached_result
+def request_device_readings_mode(device_uuid):
+    """
+    This endpoint allows clients to GET the most frequent sensor reading value for a device.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
     """
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_device_readings_quartiles_schema)
+        validation.validate(request_device_readings_metric_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -433,20 +773,259 @@ def request_device_readings_quartiles(device_uuid):
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
+    result = get_storage().mode(device_uuid, sensor_type, start_date, end_date)
+    if result is None:
+        return jsonify({}), 200
+
+    value, count = result
+
+    return jsonify({'value': value,
+                    'number_of_readings': count}), 200
+
+#JSONschema for HTTP GET request to /devices/<string:device_uuid>/stats/
+request_device_readings_stats_schema = {
+   'type': 'object',
+   'properties': {
+       'type': {
+            "enum": VALID_SENSOR_TYPES,
+       },
+       'start': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'end': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'metrics': {
+           'type': 'array',
+           'items': {
+               "enum": storage.STATISTICS,
+           },
+           'minItems': 1,
+           'uniqueItems': True,
+       },
+   },
+   'required': ['type']
+}
+request_device_readings_stats_validator = validation.compile_validator(request_device_readings_stats_schema)
+
+@bp.route('/devices/<string:device_uuid>/readings/stats/', methods = ['GET'])
+@cached_result
+def request_device_readings_stats(device_uuid):
+    """
+    This endpoint allows clients to GET several statistics of the sensor readings
+    of a device at once, computed from a single pass over the readings.
 
-    quartile_cte = session.query(Reading.value, func.ntile(4).over(order_by=Reading.value).label('quartiles'))\
-                          .filter(Reading.device_uuid==device_uuid)\
-                          .filter(Reading.type==sensor_type)\
-                          .filter(Reading.date_created >= start_date)\
-                          .filter(Reading.date_created <= end_date)\
-                          .cte('p')
-    query = session.query(quartile_cte.c.quartiles, func.max(quartile_cte.c.value), ).group_by(quartile_cte.c.quartiles)
-    quartiles = normalize_quartiles(query.all())
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
 
-    return jsonify({'quartile_1': quartiles[0][1],
-                     'quartile_3': quartiles[2][1]}), 200
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * metrics -> List of number_of_readings, min, max, mean, median, quartiles and mode, all by default
+
+    Every metric is returned with the response of its own endpoint.
+    """
+    data = {}
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_device_readings_stats_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    sensor_type = data.get('type')
+    start_date = data.get('start')
+    end_date = data.get('end')
+    metrics = data.get('metrics', storage.STATISTICS)
+
+    result = get_storage().statistics(device_uuid, sensor_type, start_date, end_date, metrics)
+
+    return jsonify(statistics_response(device_uuid, sensor_type, result, metrics)), 200
+
+def statistics_response(device_uuid, sensor_type, result, metrics):
+    """Returns every metric of the result of storage.Storage.statistics in the response format of its own endpoint"""
+    if result is None:
+        return {}
+    response = {}
+    for metric in metrics:
+        if metric in ('min', 'max', 'median'):
+            response[metric] = dict(result[metric], device_uuid=device_uuid, type=sensor_type)
+        elif metric == 'mean':
+            response[metric] = {'value': result['mean']}
+        elif metric == 'quartiles':
+            response[metric] = {'quartile_1': result['quartile_1'], 'quartile_3': result['quartile_3']}
+        else:
+            response[metric] = result[metric]
+    return response
+
+#JSONschema for HTTP GET request to /devices/<string:device_uuid>/buckets/
+request_device_readings_buckets_schema = {
+   'type': 'object',
+   'properties': {
+       'type': {
+            "enum": VALID_SENSOR_TYPES,
+       },
+       'start': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'end': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'bucket': {
+           'type': 'number',
+           'exclusiveMinimum': 0,
+       },
+       'points': {
+           'type': 'integer',
+           'minimum': 3,
+           'maximum': DOWNSAMPLE_MAX_POINTS,
+       },
+       'method': {
+            "enum": DOWNSAMPLE_METHODS,
+       },
+   },
+   'required': ['type']
+}
+request_device_readings_buckets_validator = validation.compile_validator(request_device_readings_buckets_schema)
+
+@bp.route('/devices/<string:device_uuid>/readings/buckets/', methods = ['GET'])
+@cached_result
+def request_device_readings_buckets(device_uuid):
+    """
+    This endpoint allows clients to GET the sensor readings of a device downsampled for plotting.
+
+    Mandatory Query Parameters:
+    * type -> The type of sensor value a client is looking for
+
+    Optional Query Parameters
+    * start -> The epoch start time for a sensor being created
+    * end -> The epoch end time for a sensor being created
+    * method -> 'aggregate' (default) or 'lttb'
+    * bucket -> Width of the buckets of 'aggregate' in seconds
+    * points -> Number of buckets of 'aggregate' if no bucket is given, requires start and end,
+      or number of readings selected by 'lttb'
+
+    'aggregate' returns the number_of_readings, min, max and mean per bucket as
+    {'bucket': <width>, 'buckets': [...]}, 'lttb' returns the readings selected by
+    Largest-Triangle-Three-Buckets as {'readings': [...]}.
+    """
+    data = {}
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_device_readings_buckets_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    sensor_type = data.get('type')
+    start_date = data.get('start')
+    end_date = data.get('end')
+    points = data.get('points')
+
+    if data.get('method', 'aggregate') == 'lttb':
+        if points is None:
+            return ('Validation Error: lttb requires points'), HTTP_UNPROCESSABLE_ENTITY
+        readings = sorted((reading['date_created'], reading['value'])
+                          for reading in get_storage().readings(device_uuid, sensor_type, start_date, end_date))
+        return jsonify({'readings': [{'date_created': date_created, 'value': value}
+                                     for date_created, value in downsampling.lttb(readings, points)]}), 200
+
+    width = data.get('bucket')
+    if width is None:
+        if points is None or start_date is None or end_date is None:
+            return ('Validation Error: aggregate requires bucket or points, start and end'), HTTP_UNPROCESSABLE_ENTITY
+        width = downsampling.bucket_width(start_date, end_date, points)
+
+    buckets = get_storage().buckets(device_uuid, sensor_type, width, start_date, end_date)
+
+    return jsonify({'bucket': width,
+                    'buckets': [{'bucket_start': bucket_start,
+                                 'number_of_readings': number_of_readings,
+                                 'min': min_value,
+                                 'max': max_value,
+                                 'mean': aggregates.round_mean(value_sum, number_of_readings)}
+                                for bucket_start, number_of_readings, value_sum, min_value, max_value in buckets]}), 200
+
+#JSONschema for HTTP POST request to /readings/query/
+request_fleet_readings_query_schema = {
+   'type': 'object',
+   'properties': {
+       'device_uuids': {
+           'type': 'array',
+           'items': {
+               'type': 'string',
+               'minLength': 1,
+           },
+           'minItems': 1,
+           'maxItems': FLEET_MAX_DEVICES,
+           'uniqueItems': True,
+       },
+       'type': {
+            "enum": VALID_SENSOR_TYPES,
+       },
+       'start': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'end': {
+           'type': 'number',
+           'minimum': DATE_MIN,
+       },
+       'metrics': {
+           'type': 'array',
+           'items': {
+               "enum": storage.STATISTICS,
+           },
+           'minItems': 1,
+           'uniqueItems': True,
+       },
+   },
+   'required': ['device_uuids', 'type']
+}
+request_fleet_readings_query_validator = validation.compile_validator(request_fleet_readings_query_schema)
+
+@bp.route('/readings/query/', methods = ['POST'])
+def request_fleet_readings_query():
+    """
+    This endpoint allows clients to query the same statistics of many devices at once.
+
+    POST Parameters:
+    * device_uuids -> List of the devices
+    * type -> The type of sensor value a client is looking for
+    * start -> Optional epoch start time for a sensor being created
+    * end -> Optional epoch end time for a sensor being created
+    * metrics -> Optional list of the metrics of /devices/<uuid>/readings/stats/, all by default
+
+    Returns a map from every device to the response of /devices/<uuid>/readings/stats/.
+    """
+    data = None
+    if request.data:
+        try:
+            data = json.loads(request.data)
+        except json.JSONDecodeError:
+            return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
+    try:
+        validation.validate(request_fleet_readings_query_validator, data)
+    except ValidationError as validation_error:
+        return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
+
+    sensor_type = data['type']
+    metrics = data.get('metrics', storage.STATISTICS)
+
+    results = get_storage().fleet_statistics(data['device_uuids'], sensor_type, data.get('start'), data.get('end'), metrics)
+
+    return jsonify(dict((device_uuid, statistics_response(device_uuid, sensor_type, results.get(device_uuid), metrics))
+                        for device_uuid in data['device_uuids'])), 200
 
 #JSONschema for HTTP GET request to /devices/<string:device_uuid>/summary/
 request_summary_schema = {
@@ -463,11 +1042,31 @@ request_summary_schema = {
            'type': 'number',
            'minimum': DATE_MIN,
        },
+       'order_by': {
+            "enum": summary.SUMMARY_COLUMNS,
+       },
+       'order': {
+            "enum": ['asc', 'desc'],
+       },
+       'limit': {
+           'type': 'integer',
+           'minimum': 1,
+           'maximum': PAGE_MAX_LIMIT,
+       },
+       'cursor': {
+           'type': 'string',
+       },
+       'top_n': {
+           'type': 'integer',
+           'minimum': 1,
+           'maximum': PAGE_MAX_LIMIT,
+       },
    },
    'required': []
 }
+request_summary_validator = validation.compile_validator(request_summary_schema)
 
-@app.route('/summary/', methods = ['GET'])
+@bp.route('/summary/', methods = ['GET'])
 def request_readings_summary():
     """
     This endpoint allows clients to GET a full summary
@@ -477,16 +1076,20 @@ def request_readings_summary():
     * type -> The type of sensor value a client is looking for
     * start -> The epoch start time for a sensor being created
     * end -> The epoch end time for a sensor being created
+    * order_by -> The summary column the devices are sorted by, number_of_readings by default
+    * order -> 'desc' (default) or 'asc'
+    * top_n -> Only return the first top_n device summaries
+    * limit -> Return a page of at most limit device summaries
+    * cursor -> The next_cursor of the previous page
     """
     data = {}
-    session = None
     if request.data:
         try:
             data = json.loads(request.data)
         except json.JSONDecodeError:
             return ('Request contains no valid JSON in POST data'), HTTP_UNPROCESSABLE_ENTITY
     try:
-        validate(instance=data, schema=request_summary_schema)
+        validation.validate(request_summary_validator, data)
     except ValidationError as validation_error:
         return (f'Validation Error: {validation_error}'), HTTP_UNPROCESSABLE_ENTITY
 
@@ -494,39 +1097,277 @@ def request_readings_summary():
     start_date = data.get('start')
     end_date = data.get('end')
 
-    with app.app_context():
-        session = get_db_session()
-
-    query = session.query(Reading.device_uuid,
-                          func.max(Reading.value),
-                          func.min(Reading.value),
-                          func.round(func.avg(Reading.value),2),
-                          func.count(),).\
-                    group_by(Reading.device_uuid)
-    if sensor_type is not None:
-        query = query.filter(Reading.type==sensor_type)
-    if start_date is not None:
-        query = query.filter(Reading.date_created >= start_date)
-    if end_date is not None:
-        query = query.filter(Reading.date_created <= end_date)
-    aggregates = dict((i[0], i[1:]) for i in query.all())
-
-    quartile_cte = session.query(Reading.device_uuid, Reading.value, func.ntile(4).over(partition_by=Reading.device_uuid,order_by=Reading.value).label('quartiles')).cte('p')
-    quartile_query = session.query(quartile_cte.c.device_uuid, quartile_cte.c.quartiles, func.max(quartile_cte.c.value), ).group_by(quartile_cte.c.device_uuid, quartile_cte.c.quartiles)
-    quartile_dict = {}
-    for device_uuid, quartile, value in quartile_query.all():
-        quartile_dict.setdefault(device_uuid, []).append((quartile,value))
-    quartiles = dict(map(lambda x: (x[0], normalize_quartiles(x[1])), quartile_dict.items()))
-
-    return jsonify([{'device_uuid': value,
-                         'max_reading_value': aggregates[value][0],
-                         'min_reading_value': aggregates[value][1],
-                         'mean_reading_value': aggregates[value][2],
-                         'number_of_readings': aggregates[value][3],
-                         'quartile_1_value': quartiles[value][0][1],
-                         'median_reading_value': quartiles[value][1][1],
-                         'quartile_3_value': quartiles[value][1][1],
-                         } for value in aggregates.keys()]), 200
+    order_by = data.get('order_by', 'number_of_readings')
+    order = data.get('order', 'desc')
+
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    if 'limit' in data or 'cursor' in data:
+        return summary_page(data, order_by, order, sensor_type, start_date, end_date)
+
+    summaries = get_storage().summaries(order_by, order == 'desc', sensor_type, start_date, end_date,
+                                        limit=data.get('top_n'), chunk_size=chunk_size)
+
+    return Response(stream_with_context(iter_json_list((row for _, row in summaries), chunk_size)), mimetype='application/json'), 200
+
+def summary_page(data, order_by, order, sensor_type, start, end):
+    """Returns the response for a single page of device summaries using keyset pagination"""
+    limit = data.get('limit', PAGE_DEFAULT_LIMIT)
+    after = None
+    if 'cursor' in data:
+        try:
+            cursor_order_by, cursor_order, value, device_uuid = queries.decode_summary_cursor(data['cursor'])
+        except ValueError as exception:
+            return (f'Validation Error: {exception}'), HTTP_UNPROCESSABLE_ENTITY
+        if (cursor_order_by, cursor_order) != (order_by, order):
+            return (f'Validation Error: Cursor {data["cursor"]} belongs to a summary ordered by {cursor_order_by} {cursor_order}'), HTTP_UNPROCESSABLE_ENTITY
+        after = (value, device_uuid)
+
+    rows = list(get_storage().summaries(order_by, order == 'desc', sensor_type, start, end,
+                                        after, limit + 1, current_app.config['STREAM_CHUNK_SIZE']))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        value, last = rows[-1]
+        next_cursor = queries.encode_summary_cursor(order_by, order, value, last['device_uuid'])
+
+    return jsonify({'summaries': [row for _, row in rows],
+                    'next_cursor': next_cursor}), 200
+
+@bp.route('/stats/pool/', methods = ['GET'])
+def request_pool_stats():
+    """
+    This endpoint allows clients to GET the connection pool statistics
+    of this process to size DB_POOL_SIZE and DB_MAX_OVERFLOW.
+    """
+    return jsonify(db.pool_status(current_app.config)), 200
+
+@bp.route('/stats/cache/', methods = ['GET'])
+def request_cache_stats():
+    """
+    This endpoint allows clients to GET the hit, miss and eviction counters
+    of the metric result cache of this process if RESULT_CACHE_SIZE is set.
+    """
+    result_cache = current_app.extensions.get('result_cache')
+    if result_cache is None:
+        return jsonify({}), 200
+    return jsonify(result_cache.status()), 200
+
+@bp.route('/stats/ingest/', methods = ['GET'])
+def request_ingest_stats():
+    """
+    This endpoint allows clients to GET the statistics of the ingest queue
+    of this process if INGEST_MODE is 'queued'.
+    """
+    if current_app.config['INGEST_MODE'] != 'queued':
+        return jsonify({}), 200
+    return jsonify(get_ingest_queue().status()), 200
+
+def create_storage(config):
+    """Returns the storage engine selected by STORAGE_ENGINE"""
+    if config['STORAGE_ENGINE'] == 'memory':
+        return storage.MemoryStorage()
+    if config['STORAGE_ENGINE'] == 'columnar':
+        return columnar.ColumnStore(config['COLUMNAR_PATH'])
+    analytic_pool = None
+    if config['ANALYTIC_WORKERS'] > 0:
+        analytic_pool = parallel.AnalyticPool(config['ANALYTIC_WORKERS'], config['ANALYTIC_WORKER_NICE'])
+    if config['STORAGE_ENGINE'] == 'sharded':
+        return sharding.ShardedStorage(sharding.create_sqlite_shards(config, config['QUANTILE_ENGINE'], analytic_pool),
+                                       config['SHARD_EXECUTOR_WORKERS'])
+    return storage.SQLiteStorage(config, config['QUANTILE_ENGINE'], analytic_pool=analytic_pool)
+
+def database_configs(config):
+    """Returns the configs of every SQLite database of the app, one per shard if STORAGE_ENGINE is 'sharded'"""
+    if config['STORAGE_ENGINE'] == 'sharded':
+        return sharding.shard_configs(config)
+    return [config]
+
+def create_app(config=None):
+    """Creates and configures the flask application
+
+    Parameters:
+        config: Optional mapping overriding the default configuration.
+            Settings are also read from the file referenced by the CANARY_SETTINGS environment variable.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(
+        TESTING=False,
+        DATABASE_URI=db.DEFAULT_DATABASE_URI,
+        TEST_DATABASE_URI=db.DEFAULT_TEST_DATABASE_URI,
+        DB_POOL_SIZE=db.DEFAULT_POOL_SIZE,
+        DB_MAX_OVERFLOW=db.DEFAULT_MAX_OVERFLOW,
+        DB_POOL_TIMEOUT=db.DEFAULT_POOL_TIMEOUT,
+        DB_BOOTSTRAP=True,
+        SQLITE_PROFILE=db.DEFAULT_SQLITE_PROFILE,
+        SQLITE_PRAGMAS={},
+        INGEST_CHUNK_SIZE=5000,
+        INGEST_MAX_LINE_BYTES=65536,
+        INGEST_MAX_ERRORS=100,
+        FAST_READING_VALIDATION=True,
+        STREAM_CHUNK_SIZE=1000,
+        INGEST_MODE='direct',
+        INGEST_DURABILITY='async',
+        INGEST_QUEUE_SIZE=100000,
+        INGEST_QUEUE_TIMEOUT=1.0,
+        INGEST_BATCH_ROWS=5000,
+        INGEST_BATCH_INTERVAL=0.05,
+        RESULT_CACHE_SIZE=0,
+        RESULT_CACHE_TTL=5.0,
+        QUANTILE_ENGINE='histograms',
+        STORAGE_ENGINE='sqlite',
+        COLUMNAR_PATH='columnar',
+        SHARD_COUNT=4,
+        SHARD_DATABASE_URI='sqlite:///database_{shard}.db',
+        TEST_SHARD_DATABASE_URI='sqlite:///test_database_{shard}.db',
+        SHARD_EXECUTOR_WORKERS=16,
+        ANALYTIC_WORKERS=0,
+        ANALYTIC_WORKER_NICE=10,
+        SERVER_MODE='wsgi',
+        SERVER_HOST='127.0.0.1',
+        SERVER_PORT=5000,
+        ASGI_EXECUTOR_WORKERS=32,
+        ASGI_MAX_BODY_BYTES=16 * 1024 * 1024,
+    )
+    app.config.from_envvar('CANARY_SETTINGS', silent=True)
+    if config is not None:
+        app.config.from_mapping(config)
+    if app.config['QUANTILE_ENGINE'] not in QUANTILE_ENGINES:
+        raise ValueError(f'Unknown QUANTILE_ENGINE {app.config["QUANTILE_ENGINE"]!r}, expected one of {QUANTILE_ENGINES!r}')
+    if app.config['QUANTILE_ENGINE'] == 'numpy' and analytics.np is None:
+        raise RuntimeError('QUANTILE_ENGINE \'numpy\' requires NumPy to be installed')
+    if app.config['STORAGE_ENGINE'] not in STORAGE_ENGINES:
+        raise ValueError(f'Unknown STORAGE_ENGINE {app.config["STORAGE_ENGINE"]!r}, expected one of {STORAGE_ENGINES!r}')
+    if app.config['SHARD_COUNT'] < 1:
+        raise ValueError(f'SHARD_COUNT must be at least 1, got {app.config["SHARD_COUNT"]!r}')
+    if app.config['SERVER_MODE'] not in SERVER_MODES:
+        raise ValueError(f'Unknown SERVER_MODE {app.config["SERVER_MODE"]!r}, expected one of {SERVER_MODES!r}')
+    app.extensions['storage'] = create_storage(app.config)
+    if app.config['RESULT_CACHE_SIZE'] > 0:
+        app.extensions['result_cache'] = cache.ResultCache(app.config['RESULT_CACHE_SIZE'], app.config['RESULT_CACHE_TTL'])
+    app.register_blueprint(bp)
+    app.teardown_appcontext(db.remove_session)
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Creates missing tables and indexes"""
+        for config in database_configs(app.config):
+            for name in db.bootstrap_schema(db.get_engine(config)):
+                click.echo(f'Backfilled {name} of {db.database_uri(config)}')
+        click.echo('Database schema is up to date')
+
+    @app.cli.command('rebuild-aggregates')
+    def rebuild_aggregates_command():
+        """Recomputes the per device aggregates from the readings table"""
+        count = 0
+        for config in database_configs(app.config):
+            count += aggregates.rebuild_aggregates(db.get_session(config))
+            db.remove_session()
+        click.echo(f'Rebuilt {count} aggregates')
+
+    @app.cli.command('rebuild-rollups')
+    def rebuild_rollups_command():
+        """Recomputes the minute, hour and day rollups from the readings table"""
+        count = 0
+        for config in database_configs(app.config):
+            count += rollups.rebuild_rollups(db.get_session(config))
+            db.remove_session()
+        click.echo(f'Rebuilt rollups of {count} readings')
+
+    @app.cli.command('rebuild-histograms')
+    def rebuild_histograms_command():
+        """Recomputes the hour and day value histograms from the readings table"""
+        count = 0
+        for config in database_configs(app.config):
+            count += histograms.rebuild_histograms(db.get_session(config))
+            db.remove_session()
+        click.echo(f'Rebuilt histograms of {count} readings')
+
+    @app.cli.command('rebuild-sketches')
+    def rebuild_sketches_command():
+        """Recomputes the hour and day quantile sketches from the readings table"""
+        count = 0
+        for config in database_configs(app.config):
+            count += sketches.rebuild_sketches(db.get_session(config))
+            db.remove_session()
+        click.echo(f'Rebuilt sketches of {count} readings')
+
+    @app.cli.command('check-aggregates')
+    def check_aggregates_command():
+        """Checks the per device aggregates against the readings table"""
+        mismatches = []
+        missing = set()
+        for config in database_configs(app.config):
+            session = db.get_session(config)
+            mismatches.extend(aggregates.check_aggregates(session))
+            missing.update(aggregates.missing_aggregates(session))
+            db.remove_session()
+        for device_uuid, sensor_type in mismatches:
+            if (device_uuid, sensor_type) in missing:
+                click.echo(f'{device_uuid} {sensor_type}: aggregates missing, the device is left out of summaries')
+            else:
+                click.echo(f'{device_uuid} {sensor_type}: aggregates differ from readings')
+        if mismatches:
+            raise click.ClickException(f'{len(mismatches)} aggregates are inconsistent, run rebuild-aggregates')
+        click.echo('Aggregates are consistent')
+
+    @app.cli.command('check-indexes')
+    def check_indexes_command():
+        """Checks the query plan of every endpoint query for index usage"""
+        #Every shard has the same schema, so the plans of the first database stand for all
+        session = db.get_session(database_configs(app.config)[0])
+        failed = False
+        for name, (uses_index, plan) in queries.check_query_plans(session).items():
+            failed = failed or not uses_index
+            click.echo(f'{name}: {"ok" if uses_index else "FULL SCAN"} ({"; ".join(plan)})')
+        db.remove_session()
+        if failed:
+            raise click.ClickException('Not all queries use the readings index')
+
+    return app
+
+def create_asgi_app(flask_app):
+    """Returns the ASGI application serving the routes of flask_app on an asyncio event loop
+
+    Requests run on a dedicated executor of ASGI_EXECUTOR_WORKERS threads, see asgi.ASGIApp.
+    Only the NDJSON ingest body is streamed to its worker, every other body is read on the
+    event loop first, up to ASGI_MAX_BODY_BYTES.
+    """
+    return asgi.ASGIApp(flask_app, flask_app.config['ASGI_EXECUTOR_WORKERS'], flask_app.config['ASGI_MAX_BODY_BYTES'],
+                        streamed_paths=['/readings/ingest/'],
+                        on_shutdown=functools.partial(close_ingest_queue, flask_app))
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(128 + signum)
+
+def serve(flask_app):
+    """Serves flask_app according to SERVER_MODE
+
+    'wsgi' runs the threaded Werkzeug server, 'asgi' runs the ASGI application on uvicorn,
+    which has to be installed for this mode. In both modes SIGTERM commits the queued
+    readings before the process exits.
+    """
+    host = flask_app.config['SERVER_HOST']
+    port = flask_app.config['SERVER_PORT']
+    if flask_app.config['SERVER_MODE'] != 'asgi':
+        #SIGTERM exits like Ctrl-C, through the flush below
+        signal.signal(signal.SIGTERM, _exit_on_signal)
+        try:
+            flask_app.run(host, port)
+        finally:
+            close_ingest_queue(flask_app)
+        return
+    try:
+        import uvicorn
+    except ImportError:
+        raise RuntimeError('SERVER_MODE \'asgi\' requires uvicorn to be installed')
+    #uvicorn handles SIGTERM itself and flushes the queue in the lifespan shutdown
+    uvicorn.run(create_asgi_app(flask_app), host=host, port=port)
+
+#Spawned analytic workers of `python app.py` import this module as __mp_main__, they only run
+#functions of parallel and must neither build an app nor start a pool of their own
+if __name__ != '__mp_main__':
+    app = create_app()
+    asgi_app = create_asgi_app(app)
 
 if __name__ == '__main__':
-    app.run()
+    serve(app)
@@ -0,0 +1,186 @@
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+class RequestBody(io.RawIOBase):
+    """File like wsgi.input reading the body of an ASGI request from a worker thread
+
+    Every read waits on the event loop for the next http.request message, so the body is never
+    buffered as a whole. The worker thread is blocked while it waits, so a slow client holds a
+    worker for the duration of its upload. Only bodies too large to buffer are read this way.
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = bytearray()
+        self._more_body = True
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more_body = False
+            raise OSError('Client disconnected')
+        self._buffer += message.get('body', b'')
+        self._more_body = message.get('more_body', False)
+
+    def read(self, size=-1):
+        while self._more_body and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def readline(self, size=-1):
+        while self._more_body and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        data = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return data
+
+class BodyTooLarge(Exception):
+    """Raised if a buffered request body exceeds its maximum size"""
+
+async def read_body(receive, max_bytes):
+    """Reads the whole body of an ASGI request on the event loop
+
+    Returns the body, or None if the client disconnected. Raises BodyTooLarge once the body
+    exceeds max_bytes.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        if len(body) > max_bytes:
+            raise BodyTooLarge(f'Request body exceeds {max_bytes} bytes')
+        if not message.get('more_body', False):
+            return bytes(body)
+
+def build_environ(scope, body):
+    """Returns the WSGI environ of an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {'REQUEST_METHOD': scope['method'],
+               'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+               'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+               'QUERY_STRING': scope.get('query_string', b'').decode('latin1'),
+               'SERVER_NAME': server[0],
+               'SERVER_PORT': str(server[1]),
+               'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+               'REMOTE_ADDR': client[0],
+               'REMOTE_PORT': str(client[1]),
+               'wsgi.version': (1, 0),
+               'wsgi.url_scheme': scope.get('scheme', 'http'),
+               'wsgi.input': body,
+               #The body ends with the last http.request message, even without Content-Length
+               'wsgi.input_terminated': True,
+               'wsgi.errors': sys.stderr,
+               'wsgi.multithread': True,
+               'wsgi.multiprocess': False,
+               'wsgi.run_once': False}
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin1').upper().replace('-', '_')
+        value = value.decode('latin1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        environ[name] = environ[name] + ',' + value if name in environ else value
+    return environ
+
+class ASGIApp:
+    """Serves a WSGI application on an asyncio event loop as ASGI application
+
+    The event loop only owns the connections. Every request runs start to end, including its
+    streamed response, on a single thread of a dedicated executor, so the thread local db
+    sessions work unchanged and at most max_workers requests touch the database at once,
+    no matter how many keep-alive connections are open. Request bodies are read on the loop
+    before the request is handed to a worker, so a slow upload does not hold a worker, and
+    bodies larger than max_body_bytes are answered with a 413. The bodies of streamed_paths
+    are unbounded and are instead passed to the worker one message at a time while it reads
+    them. Response chunks are passed back to the loop one message at a time.
+
+    Parameters:
+        wsgi_app: The WSGI application, e.g. the Flask app
+        max_workers: Number of executor threads running requests
+        max_body_bytes: Maximum size of a body read before its request runs
+        streamed_paths: Paths whose request bodies are streamed to the worker instead
+        on_shutdown: Optional function called on lifespan shutdown before the executor stops
+    """
+
+    def __init__(self, wsgi_app, max_workers, max_body_bytes, streamed_paths=(), on_shutdown=None):
+        self.wsgi_app = wsgi_app
+        self.max_body_bytes = max_body_bytes
+        self.streamed_paths = frozenset(streamed_paths)
+        self.on_shutdown = on_shutdown
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='asgi-worker')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError(f'Unsupported ASGI scope type {scope["type"]!r}')
+        loop = asyncio.get_running_loop()
+        if scope['path'] in self.streamed_paths:
+            body = RequestBody(receive, loop)
+        else:
+            try:
+                data = await read_body(receive, self.max_body_bytes)
+            except BodyTooLarge as error:
+                await send({'type': 'http.response.start', 'status': 413, 'headers': [(b'content-type', b'text/plain')]})
+                await send({'type': 'http.response.body', 'body': str(error).encode(), 'more_body': False})
+                return
+            if data is None:
+                return
+            body = io.BytesIO(data)
+        await loop.run_in_executor(self.executor, self._run, scope, body, send, loop)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.on_shutdown is not None:
+                    await asyncio.get_running_loop().run_in_executor(self.executor, self.on_shutdown)
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _run(self, scope, body, send, loop):
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['start'] = {'type': 'http.response.start',
+                                 'status': int(status.split(' ', 1)[0]),
+                                 'headers': [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]}
+
+        chunks = self.wsgi_app(build_environ(scope, body), start_response)
+        try:
+            started = False
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                if not started:
+                    send_message(response['start'])
+                    started = True
+                send_message({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                send_message(response['start'])
+            send_message({'type': 'http.response.body', 'body': b'', 'more_body': False})
+        finally:
+            #Closing the response tears down the app context and its db session on this thread
+            if hasattr(chunks, 'close'):
+                chunks.close()
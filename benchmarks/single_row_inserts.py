@@ -0,0 +1,46 @@
+"""Reports the rate of single reading insert transactions with and without updating the sketches in them
+
+Every run inserts into a fresh database, the runs of both variants alternate so disk and CPU
+noise hit both alike. Only numbers are reported, nothing is asserted.
+
+    python benchmarks/single_row_inserts.py [transactions] [runs] [sqlite profile]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db
+import ingest
+import sketches
+
+def inserts_per_second(root, run, transactions, profile, update_sketches):
+    config = {'DATABASE_URI': f'sqlite:///{root}/run_{run}.db', 'SQLITE_PROFILE': profile}
+    session = db.get_session(config)
+    try:
+        began = time.perf_counter()
+        for index in range(transactions):
+            rows = [{'device_uuid': 'bench_device', 'type': 'temperature', 'value': index % 101, 'date_created': index * 60}]
+            ingest.insert_readings(session, rows)
+            if update_sketches:
+                sketches.update_sketches(session, rows)
+            session.commit()
+        return transactions / (time.perf_counter() - began)
+    finally:
+        db.remove_session()
+        db.dispose_engines()
+
+def main(transactions=2000, runs=3, profile=db.DEFAULT_SQLITE_PROFILE):
+    rates = {'eager sketches': [], 'lazy sketches': []}
+    with tempfile.TemporaryDirectory() as root:
+        for run in range(runs):
+            rates['eager sketches'].append(inserts_per_second(root, 2 * run, transactions, profile, True))
+            rates['lazy sketches'].append(inserts_per_second(root, 2 * run + 1, transactions, profile, False))
+    for name, values in rates.items():
+        print(f'{name}: {statistics.median(values):.0f} inserts/s (median of {runs} runs of {transactions}, {profile} profile)')
+
+if __name__ == '__main__':
+    main(*[int(argument) for argument in sys.argv[1:3]], *sys.argv[3:4])
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+class ResultCache:
+    """Bounded in-process LRU cache for metric results with a TTL and per device generations
+
+    Every device has a generation counter which is bumped once new readings of the device are
+    committed. An entry remembers the generation it was computed at and is stale as soon as
+    the generation of its device moves on, so results are invalidated exactly when the device
+    gets new data. The TTL bounds the staleness for writes the process does not see, e.g. by
+    other processes or tools writing to the database.
+
+    Parameters:
+        max_entries: Maximum number of cached results, the least recently used one is evicted
+        ttl: Seconds an entry is served at most
+        clock: Function returning the current time in seconds
+    """
+
+    def __init__(self, max_entries, ttl, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, device_uuid):
+        """Returns the current generation of a device
+
+        It has to be read before computing a result which is then put with this generation,
+        so a result computed concurrently with a write is never served as fresh.
+        """
+        with self._lock:
+            return self._generations.get(device_uuid, 0)
+
+    def bump(self, device_uuids):
+        """Invalidates every cached result of device_uuids"""
+        with self._lock:
+            for device_uuid in device_uuids:
+                self._generations[device_uuid] = self._generations.get(device_uuid, 0) + 1
+
+    def get(self, key, device_uuid):
+        """Returns the cached result of key or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            generation, expires, result = entry
+            if generation != self._generations.get(device_uuid, 0):
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            if expires <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, key, device_uuid, generation, result):
+        """Caches result of key computed at generation of device_uuid"""
+        with self._lock:
+            if generation != self._generations.get(device_uuid, 0):
+                return
+            self._entries[key] = (generation, self.clock() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """Removes every cached result"""
+        with self._lock:
+            self._entries.clear()
+
+    def status(self):
+        """Returns the cache statistics"""
+        with self._lock:
+            return {'entries': len(self._entries),
+                    'max_entries': self.max_entries,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'invalidations': self.invalidations}
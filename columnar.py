@@ -0,0 +1,244 @@
+import bisect
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import defaultdict
+import storage
+
+DATE_FILE = 'date_created.f64'
+VALUE_FILE = 'value.f64'
+MANIFEST_FILE = 'manifest.idx'
+#Runs file of series written before the manifest, read for compatibility
+RUNS_FILE = 'runs.idx'
+#A series is rewritten as a single sorted run once readings out of date order created more runs
+MAX_RUNS = 64
+
+#first_date_created, last_date_created, offset and length of a run sorted by date_created
+_RUN = struct.Struct('<ddQQ')
+#Generation of the live column files, followed by the runs in the manifest
+_MANIFEST = struct.Struct('<Q')
+_ITEM_SIZE = 8
+
+def encode_name(name):
+    """Returns the directory name of a device_uuid or sensor type, safe for any string"""
+    return 'x' + name.encode().hex()
+
+def decode_name(directory):
+    """Returns the device_uuid or sensor type of a directory created by encode_name"""
+    return bytes.fromhex(directory[1:]).decode()
+
+def _map(path, length):
+    """Maps the first length float64 items of a column file read only, zero-copy"""
+    if length == 0:
+        return memoryview(b'').cast('d')
+    with open(path, 'rb') as column:
+        return memoryview(mmap.mmap(column.fileno(), length * _ITEM_SIZE, access=mmap.ACCESS_READ)).cast('d')
+
+def _sync(file):
+    """Flushes file to disk"""
+    file.flush()
+    os.fsync(file.fileno())
+
+def _sync_directory(path):
+    """Flushes the entries of a directory to disk, e.g. after creating or replacing files in it"""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+class Series:
+    """Append-only date_created and value columns of the readings of one device and sensor type
+
+    Both columns are files of little endian float64, the n-th item of both files belongs to
+    the same reading. Readings are appended in runs sorted by date_created, a reading older
+    than the last one starts a new run. The manifest is the sparse time index: it holds first
+    and last date_created, offset and length of every run, so a date range is found by a
+    binary search within the few runs overlapping it.
+
+    The manifest also names the generation of the column files. A compaction writes both
+    columns of the next generation and switches to them with the single atomic replace of the
+    manifest, so a crash leaves either the old or the new generation live, never a mix.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.generation = 0
+        self.runs = []
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        legacy_path = os.path.join(path, RUNS_FILE)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'rb') as manifest:
+                data = manifest.read()
+            self.generation, = _MANIFEST.unpack_from(data)
+            self.runs = [list(run) for run in _RUN.iter_unpack(data[_MANIFEST.size:])]
+        elif os.path.exists(legacy_path):
+            #Series written before the manifest hold the runs only, with the columns of generation 0
+            with open(legacy_path, 'rb') as runs:
+                self.runs = [list(run) for run in _RUN.iter_unpack(runs.read())]
+        if os.path.isdir(path):
+            self._remove_stale_files()
+
+    def __len__(self):
+        return sum(run[3] for run in self.runs)
+
+    def column_path(self, name, generation=None):
+        """Returns the path of the column file name of a generation, the live one by default"""
+        generation = self.generation if generation is None else generation
+        if generation == 0:
+            return os.path.join(self.path, name)
+        stem, extension = os.path.splitext(name)
+        return os.path.join(self.path, f'{stem}.{generation}{extension}')
+
+    def append(self, dates, values):
+        """Appends readings sorted by date_created to the end of both columns
+
+        The caller has to hold the lock of the store.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        offset = len(self)
+        for name, items in ((DATE_FILE, dates), (VALUE_FILE, values)):
+            with open(self.column_path(name), 'ab') as column:
+                #Bytes past the runs are left by an append torn by a crash, the new items replace them
+                column.truncate(offset * _ITEM_SIZE)
+                column.write(array('d', items).tobytes())
+                _sync(column)
+        for date_created in dates:
+            if self.runs and self.runs[-1][1] <= date_created:
+                self.runs[-1][1] = date_created
+                self.runs[-1][3] += 1
+            else:
+                self.runs.append([date_created, date_created, offset, 1])
+            offset += 1
+        if len(self.runs) > MAX_RUNS:
+            self.compact()
+        else:
+            self._write_manifest()
+
+    def compact(self):
+        """Rewrites both columns as a single run sorted by date_created into the next generation
+
+        The files of the previous generation are deleted once the manifest names the new one.
+        Readers keep the mappings of the deleted files, so they are not disturbed.
+        The caller has to hold the lock of the store.
+        """
+        dates, values, _ = self.snapshot()
+        readings = sorted(zip(dates, values), key=lambda reading: reading[0])
+        generation = self.generation + 1
+        for name, column in ((DATE_FILE, 0), (VALUE_FILE, 1)):
+            with open(self.column_path(name, generation), 'wb') as output:
+                output.write(array('d', (reading[column] for reading in readings)).tobytes())
+                _sync(output)
+        _sync_directory(self.path)
+        self.generation = generation
+        self.runs = [[readings[0][0], readings[-1][0], 0, len(readings)]] if readings else []
+        self._write_manifest()
+        self._remove_stale_files()
+
+    def _write_manifest(self):
+        #The columns are synced before the manifest is replaced, so after a crash the runs never
+        #point past the items on disk, and items past the runs are cut off by the next append
+        path = os.path.join(self.path, MANIFEST_FILE)
+        with open(path + '.tmp', 'wb') as manifest:
+            manifest.write(_MANIFEST.pack(self.generation) + b''.join(_RUN.pack(*run) for run in self.runs))
+            _sync(manifest)
+        os.replace(path + '.tmp', path)
+        _sync_directory(self.path)
+
+    def _remove_stale_files(self):
+        #Columns of other generations are left by a finished or a crashed compaction
+        live = {os.path.basename(self.column_path(DATE_FILE)), os.path.basename(self.column_path(VALUE_FILE)), MANIFEST_FILE}
+        if os.path.exists(os.path.join(self.path, MANIFEST_FILE)):
+            stale = lambda name: name not in live
+        else:
+            live.add(RUNS_FILE)
+            stale = lambda name: name not in live and name.endswith('.f64')
+        for name in os.listdir(self.path):
+            if stale(name):
+                os.remove(os.path.join(self.path, name))
+
+    def snapshot(self):
+        """Returns zero-copy views of the date and value columns and a copy of the runs
+
+        The caller has to hold the lock of the store, the views stay valid after releasing it.
+        """
+        length = len(self)
+        return (_map(self.column_path(DATE_FILE), length),
+                _map(self.column_path(VALUE_FILE), length),
+                [tuple(run) for run in self.runs])
+
+def range_slices(dates, values, runs, start=None, end=None):
+    """Yields zero-copy (dates, values) slices of every run with start <= date_created <= end"""
+    for first, last, offset, length in runs:
+        if (start is not None and last < start) or (end is not None and first > end):
+            continue
+        lo = offset if start is None else bisect.bisect_left(dates, start, offset, offset + length)
+        hi = offset + length if end is None else bisect.bisect_right(dates, end, lo, offset + length)
+        if lo < hi:
+            yield dates[lo:hi], values[lo:hi]
+
+class ColumnStore(storage.SliceStorage):
+    """Storage engine keeping the readings of every device and sensor type in memory-mapped column files
+
+    Readings are stored under root/<device>/<type>/ without repeating device_uuid and type per
+    reading, 16 bytes per reading. Ingest is a sequential append, range queries a binary search
+    followed by zero-copy slices of the mapped columns and the queries of storage.SliceStorage
+    run over the slices. A store is safe to use from many threads of one process.
+
+    Parameters:
+        root: Directory of the column files
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _get_series(self, device_uuid, sensor_type):
+        key = (device_uuid, sensor_type)
+        series = self._series.get(key)
+        if series is None:
+            series = Series(os.path.join(self.root, encode_name(device_uuid), encode_name(sensor_type)))
+            self._series[key] = series
+        return series
+
+    def insert_many(self, rows):
+        """Appends rows as returned by ingest.reading_row"""
+        groups = defaultdict(list)
+        for row in rows:
+            groups[(row['device_uuid'], row['type'])].append((row['date_created'], row['value']))
+        with self._lock:
+            for (device_uuid, sensor_type), readings in groups.items():
+                readings.sort(key=lambda reading: reading[0])
+                self._get_series(device_uuid, sensor_type).append([reading[0] for reading in readings],
+                                                                  [reading[1] for reading in readings])
+
+    def device_uuids(self):
+        """Returns the sorted device_uuids with readings"""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(decode_name(directory) for directory in os.listdir(self.root))
+
+    def sensor_types(self, device_uuid, sensor_type=None):
+        """Returns the sorted sensor types of a device, restricted to sensor_type if given"""
+        path = os.path.join(self.root, encode_name(device_uuid))
+        if not os.path.isdir(path):
+            return []
+        sensor_types = sorted(decode_name(directory) for directory in os.listdir(path))
+        if sensor_type is not None:
+            return [sensor_type] if sensor_type in sensor_types else []
+        return sensor_types
+
+    def snapshot(self, device_uuid, sensor_type):
+        """Returns the zero-copy column views and runs of a series, see Series.snapshot"""
+        with self._lock:
+            return self._get_series(device_uuid, sensor_type).snapshot()
+
+    def slices(self, device_uuid, sensor_type=None, start=None, end=None):
+        """Yields (sensor_type, dates, values) zero-copy slices of the readings of a device in a date range"""
+        for series_type in self.sensor_types(device_uuid, sensor_type):
+            dates, values, runs = self.snapshot(device_uuid, series_type)
+            for date_slice, value_slice in range_slices(dates, values, runs, start, end):
+                yield series_type, date_slice, value_slice
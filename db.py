@@ -0,0 +1,198 @@
+import threading
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
+import aggregates
+import histograms
+import rollups
+from models import Base, Reading
+
+DEFAULT_DATABASE_URI = 'sqlite:///database.db'
+DEFAULT_TEST_DATABASE_URI = 'sqlite:///test_database.db'
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_SQLITE_PROFILE = 'durable'
+
+#Connection pragmas applied to every new SQLite connection, see https://sqlite.org/pragma.html
+#Both profiles use WAL, so readers do not block behind a writer and vice versa.
+STORAGE_PROFILES = {
+    #Every commit is fsynced, a committed reading survives a power loss
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+        'cache_size': -16384,
+        'temp_store': 'MEMORY',
+        'mmap_size': 0,
+    },
+    #The WAL is only fsynced at checkpoints, the last commits may be lost on power loss
+    #but the database stays consistent
+    'throughput': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+    },
+}
+
+#Thread-local session registry shared by all requests of this process
+Session = scoped_session(sessionmaker())
+
+_engines = {}
+_engines_lock = threading.Lock()
+#Additional thread-local session registries by name, e.g. one per shard
+_registries = {}
+
+def database_uri(config):
+    """Returns the database URI for the given flask config"""
+    if config.get('TESTING'):
+        return config.get('TEST_DATABASE_URI', DEFAULT_TEST_DATABASE_URI)
+    return config.get('DATABASE_URI', DEFAULT_DATABASE_URI)
+
+def get_engine(config):
+    """Returns the process wide engine for the database configured in config
+
+    Engines are created once per database URI and cached for the lifetime of the process.
+    This way every request shares the same connection pool instead of paying for engine
+    construction and a fresh connection.
+
+    Parameters:
+        config: flask config containing the DATABASE_URI and DB_POOL_* settings
+    """
+    uri = database_uri(config)
+    engine = _engines.get(uri)
+    if engine is not None:
+        return engine
+    with _engines_lock:
+        engine = _engines.get(uri)
+        if engine is None:
+            engine = create_engine(uri,
+                                   poolclass=QueuePool,
+                                   pool_size=config.get('DB_POOL_SIZE', DEFAULT_POOL_SIZE),
+                                   max_overflow=config.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+                                   pool_timeout=config.get('DB_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT),
+                                   connect_args={'check_same_thread': False})
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', pragma_listener(sqlite_pragmas(config)))
+            if config.get('DB_BOOTSTRAP', True):
+                bootstrap_schema(engine)
+            _engines[uri] = engine
+    return engine
+
+def sqlite_pragmas(config):
+    """Returns the pragmas of the configured SQLITE_PROFILE updated by SQLITE_PRAGMAS"""
+    profile = config.get('SQLITE_PROFILE', DEFAULT_SQLITE_PROFILE)
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f'Unknown SQLITE_PROFILE {profile}, expected one of {", ".join(STORAGE_PROFILES)}')
+    pragmas = dict(STORAGE_PROFILES[profile])
+    pragmas.update(config.get('SQLITE_PRAGMAS') or {})
+    return pragmas
+
+def pragma_listener(pragmas):
+    """Returns a connect event listener applying pragmas to every new DBAPI connection"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return set_pragmas
+
+#Tables derived from the readings table and the functions recomputing them, in rebuild order.
+#The sketches are left out since the queries compute missing ones, see sketches.fresh_sketches
+DERIVED_TABLES = (
+    ('reading_aggregates', aggregates.rebuild_aggregates),
+    ('reading_rollups', rollups.rebuild_rollups),
+    ('reading_histograms', histograms.rebuild_histograms),
+)
+
+def bootstrap_schema(engine):
+    """Creates missing tables and indexes
+
+    create_all only creates the indexes of new tables, so the indexes of an existing table
+    are created separately. This makes the bootstrap also act as migration for databases
+    created before an index was added.
+
+    A derived table created next to a readings table which already holds readings is
+    backfilled from it, otherwise the endpoints reading the derived table would silently miss
+    every reading inserted before the upgrade. The backfill scans the readings table once per
+    new table, so the first start after an upgrade of a large database takes a while.
+
+    Returns the names of the backfilled tables.
+    """
+    existing = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(engine)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
+    missing = [(name, rebuild) for name, rebuild in DERIVED_TABLES if name not in existing]
+    if Reading.__tablename__ not in existing or not missing:
+        return []
+    session = sessionmaker(bind=engine)()
+    try:
+        if session.query(Reading.id).first() is None:
+            return []
+        for name, rebuild in missing:
+            rebuild(session)
+        return [name for name, _ in missing]
+    finally:
+        session.close()
+
+def compile_query(session, query):
+    """Returns the SQL string and the tuple of positional parameters of query for the DBAPI cursor"""
+    #Expanding IN parameters are rendered as one bound parameter per value
+    compiled = query.statement.compile(dialect=session.bind.dialect, compile_kwargs={'render_postcompile': True})
+    return str(compiled), tuple(compiled.params[name] for name in compiled.positiontup)
+
+def explain_query_plan(session, query):
+    """Returns the detail column of the SQLite query plan for query"""
+    sql, parameters = compile_query(session, query)
+    plan = session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}', parameters)
+    return [row[3] for row in plan]
+
+def session_registry(name):
+    """Returns the process wide thread-local session registry called name
+
+    A thread can hold a session of every registry at once, e.g. of several shard databases,
+    while the sessions of a single registry are rebound whenever another engine is requested.
+    """
+    with _engines_lock:
+        registry = _registries.get(name)
+        if registry is None:
+            registry = scoped_session(sessionmaker())
+            _registries[name] = registry
+    return registry
+
+def get_session(config, registry=Session):
+    """Returns the scoped session of the current thread in registry bound to the configured engine"""
+    engine = get_engine(config)
+    if registry.registry.has():
+        session = registry()
+        if session.bind is engine:
+            return session
+        registry.remove()
+    return registry(bind=engine)
+
+def remove_session(exception=None):
+    """Closes the scoped sessions of the current thread and returns their connections to the pool"""
+    Session.remove()
+    for registry in list(_registries.values()):
+        registry.remove()
+
+def pool_status(config):
+    """Returns the connection pool statistics of the configured engine"""
+    pool = get_engine(config).pool
+    return {'pool_size': pool.size(),
+            'max_overflow': config.get('DB_MAX_OVERFLOW', DEFAULT_MAX_OVERFLOW),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()}
+
+def dispose_engines():
+    """Disposes all engines and their connection pools"""
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
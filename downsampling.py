@@ -0,0 +1,47 @@
+import math
+import rollups
+
+def bucket_width(start, end, points):
+    """Returns the width in seconds of the buckets covering [start, end] with at most about points buckets
+
+    Widths of a minute and more are rounded up to a multiple of the coarsest rollup granularity
+    not larger than them, so the buckets are merged from rollups instead of the raw readings.
+    """
+    width = (end - start) / points
+    if width <= 0:
+        return 1
+    for granularity in rollups.GRANULARITIES:
+        if width >= granularity:
+            return math.ceil(width / granularity) * granularity
+    return width
+
+def lttb(readings, threshold):
+    """Selects threshold of the (date_created, value) tuples sorted by date_created with Largest-Triangle-Three-Buckets
+
+    The first and last reading are kept. The readings in between are split into threshold - 2
+    buckets and every bucket keeps the reading spanning the largest triangle with the reading
+    kept for the previous bucket and the average of the next bucket, which preserves the
+    peaks and the shape of the series when plotted. Returns a list of the kept readings.
+    """
+    if threshold >= len(readings) or threshold < 3:
+        return list(readings)
+    every = (len(readings) - 2) / (threshold - 2)
+    kept = readings[0]
+    result = [kept]
+    for bucket in range(threshold - 2):
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, len(readings))
+        next_readings = readings[next_start:next_end]
+        average_date = sum(reading[0] for reading in next_readings) / len(next_readings)
+        average_value = sum(reading[1] for reading in next_readings) / len(next_readings)
+        kept_date, kept_value = kept
+        best_area = -1
+        for reading in readings[int(bucket * every) + 1:next_start]:
+            area = abs((kept_date - average_date) * (reading[1] - kept_value) -
+                       (kept_date - reading[0]) * (average_value - kept_value))
+            if area > best_area:
+                best_area = area
+                kept = reading
+        result.append(kept)
+    result.append(readings[-1])
+    return result
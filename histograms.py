@@ -0,0 +1,149 @@
+import math
+from collections import Counter
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert
+import rollups
+from models import Reading, ReadingHistogram
+
+#Minute histograms would write up to one row per reading, ragged edges below an hour are
+#read from the readings table instead
+GRANULARITIES = (rollups.DAY, rollups.HOUR)
+
+def update_histograms(session, rows, granularities=GRANULARITIES):
+    """Adds rows to the value counts of the reading_histograms table
+
+    Must be called in the transaction inserting rows into readings.
+    """
+    counts = Counter()
+    for granularity in granularities:
+        for row in rows:
+            counts[(row['device_uuid'], row['type'], granularity,
+                    rollups.bucket_start(row['date_created'], granularity), row['value'])] += 1
+    if not counts:
+        return
+    table = ReadingHistogram.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.device_uuid, table.c.type, table.c.granularity, table.c.bucket_start, table.c.value],
+        set_={'number_of_readings': table.c.number_of_readings + statement.excluded.number_of_readings})
+    session.execute(statement, [{'device_uuid': device_uuid,
+                                 'type': sensor_type,
+                                 'granularity': granularity,
+                                 'bucket_start': start,
+                                 'value': value,
+                                 'number_of_readings': count}
+                                for (device_uuid, sensor_type, granularity, start, value), count in counts.items()])
+
+def rebuild_histograms(session, chunk_size=10000):
+    """Recomputes the reading_histograms table from the readings table and commits
+
+    The readings are streamed in chunks of chunk_size rows.
+    Returns the number of readings.
+    """
+    session.query(ReadingHistogram).delete()
+    result = session.connection().execution_options(stream_results=True).execute(
+        select(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created))
+    count = 0
+    while True:
+        rows = [row._mapping for row in result.fetchmany(chunk_size)]
+        if not rows:
+            break
+        update_histograms(session, rows)
+        count += len(rows)
+    session.commit()
+    return count
+
+def histogram_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+    """Query for the value counts of a device summed over a range of buckets"""
+    return session.query(ReadingHistogram.value, func.sum(ReadingHistogram.number_of_readings)).\
+                   filter(ReadingHistogram.device_uuid==device_uuid).\
+                   filter(ReadingHistogram.type==sensor_type).\
+                   filter(ReadingHistogram.granularity==granularity).\
+                   filter(ReadingHistogram.bucket_start >= first_bucket_start).\
+                   filter(ReadingHistogram.bucket_start <= last_bucket_start).\
+                   group_by(ReadingHistogram.value)
+
+def range_histogram(session, device_uuid, sensor_type, start=None, end=None):
+    """Returns the value counts of the readings of a device with start <= date_created <= end
+
+    Missing bounds are replaced by the first and last date_created of the device.
+    The cost depends on the number of buckets times the number of distinct values and not on
+    the number of readings.
+
+    Returns a list of (value, number_of_readings) tuples sorted by value, which is empty if
+    there are no readings.
+    """
+    if start is None or end is None:
+        first, last = rollups.date_bounds(session, device_uuid, sensor_type)
+        if first is None:
+            return []
+        start = first if start is None else start
+        end = last if end is None else end
+    buckets, edges = rollups.plan_range(start, end, GRANULARITIES)
+    counts = Counter()
+    for granularity, first_bucket_start, last_bucket_start in buckets:
+        for value, count in histogram_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+            counts[value] += count
+    for lo, hi, hi_inclusive in edges:
+        #Counted here, grouping in SQL makes SQLite prefer the value index over the date range
+        for value, _ in rollups.edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive):
+            counts[value] += 1
+    return sorted(counts.items())
+
+def quartile_ranks(number_of_readings):
+    """Returns the 1-based ranks of the 1st quartile, median and 3rd quartile
+
+    The ranks are the ones the ntile(4) window function with normalize_quartiles picks:
+    the last reading of the 1st, 2nd and 3rd tile, where the first number_of_readings % 4
+    tiles hold one reading more.
+    """
+    if number_of_readings == 1:
+        return 1, 1, 1
+    if number_of_readings == 2:
+        return 1, 1, 2
+    if number_of_readings == 3:
+        return 1, 2, 3
+    size, remainder = divmod(number_of_readings, 4)
+    ranks = []
+    rank = 0
+    for tile in range(3):
+        rank += size + (1 if tile < remainder else 0)
+        ranks.append(rank)
+    return tuple(ranks)
+
+def percentile_rank(number_of_readings, percentile):
+    """Returns the 1-based nearest rank of percentile (0 to 100)"""
+    return max(1, math.ceil(percentile / 100 * number_of_readings))
+
+def number_of_readings(histogram):
+    """Returns the number of readings of a histogram as returned by range_histogram"""
+    return sum(count for _, count in histogram)
+
+def value_at_rank(histogram, rank):
+    """Returns the value of the reading with the 1-based rank in a histogram as returned by range_histogram"""
+    seen = 0
+    for value, count in histogram:
+        seen += count
+        if seen >= rank:
+            return value
+    raise ValueError(f'Rank {rank} exceeds the {seen} readings of the histogram')
+
+def mode(histogram):
+    """Returns the most frequent value of a histogram and its number of readings
+
+    Ties are resolved to the smallest value.
+    """
+    value, count = max(histogram, key=lambda item: (item[1], -item[0]))
+    return value, count
+
+def earliest_date_created_query(session, device_uuid, sensor_type, value, start=None, end=None):
+    """Query for the earliest date_created of the readings of a device holding value"""
+    query = session.query(func.min(Reading.date_created)).\
+                    filter(Reading.device_uuid==device_uuid).\
+                    filter(Reading.type==sensor_type).\
+                    filter(Reading.value==value)
+    if start is not None:
+        query = query.filter(Reading.date_created >= start)
+    if end is not None:
+        query = query.filter(Reading.date_created <= end)
+    return query
@@ -0,0 +1,241 @@
+import collections
+import json
+import logging
+import threading
+import time
+from concurrent.futures import Future
+import aggregates
+import histograms
+import rollups
+from models import Reading
+
+logger = logging.getLogger(__name__)
+
+def reading_row(device_uuid, data, now=None):
+    """Converts a validated reading payload into a row of the readings table
+
+    Parameters:
+        device_uuid: uuid of the device the reading belongs to
+        data: validated reading payload with type, value and optional date_created
+        now: date_created used if the payload contains none, defaults to the current time
+    """
+    if 'date_created' in data:
+        date_created = data['date_created']
+    else:
+        date_created = int(time.time()) if now is None else now
+    return {'device_uuid': device_uuid,
+            'type': data['type'],
+            'value': data['value'],
+            'date_created': date_created}
+
+def insert_readings(session, rows):
+    """Inserts rows into the readings table with a single executemany
+
+    The per device aggregates, rollups and histograms are updated in the same transaction, the
+    sketches are refreshed by the queries reading them, see sketches.fresh_sketches.
+    The caller is responsible for committing the session.
+
+    Parameters:
+        session: db session of the transaction
+        rows: list of dicts as returned by reading_row
+    """
+    if not rows:
+        return
+    session.execute(Reading.__table__.insert(), rows)
+    aggregates.update_aggregates(session, rows)
+    rollups.update_rollups(session, rows)
+    histograms.update_histograms(session, rows)
+
+def iter_ndjson(stream, max_line_bytes):
+    """Incrementally parses a newline delimited JSON stream
+
+    Only a single line is held in memory at a time. Lines exceeding max_line_bytes are
+    skipped and reported as error.
+
+    Yields tuples of (line_number, payload, error) where either payload or error is None.
+    Blank lines are ignored.
+    """
+    line_number = 0
+    while True:
+        line = stream.readline(max_line_bytes + 1)
+        if not line:
+            return
+        line_number += 1
+        if len(line) > max_line_bytes and not line.endswith(b'\n'):
+            #Discard the remainder of the oversized line
+            while line and not line.endswith(b'\n'):
+                line = stream.readline(max_line_bytes + 1)
+            yield line_number, None, f'Line exceeds {max_line_bytes} bytes'
+            continue
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line), None
+        except json.JSONDecodeError:
+            yield line_number, None, 'Line contains no valid JSON'
+
+def ingest_ndjson(write_rows, stream, validate_reading, chunk_size, max_line_bytes, max_errors):
+    """Inserts the readings of a newline delimited JSON stream in chunks of chunk_size rows
+
+    Each chunk is written separately, so memory usage is bounded by chunk_size and
+    max_errors no matter how large the stream is.
+
+    Parameters:
+        write_rows: Function inserting and committing a chunk of rows in the storage engine
+        stream: file like object of the request body
+        validate_reading: Function returning an error message for an invalid payload or None
+        chunk_size: Number of rows inserted and committed at once
+        max_line_bytes: Maximum length of a single line
+        max_errors: Maximum number of errors reported, further errors are only counted
+
+    Returns a tuple of (accepted, rejected, errors)
+    """
+    now = int(time.time())
+    accepted = 0
+    rejected = 0
+    errors = []
+    rows = []
+    for line_number, payload, error in iter_ndjson(stream, max_line_bytes):
+        if error is None:
+            error = validate_reading(payload)
+        if error is not None:
+            rejected += 1
+            if len(errors) < max_errors:
+                errors.append({'line': line_number, 'error': error})
+            continue
+        rows.append(reading_row(payload['device_uuid'], payload, now))
+        if len(rows) >= chunk_size:
+            write_rows(rows)
+            accepted += len(rows)
+            rows = []
+    if rows:
+        write_rows(rows)
+        accepted += len(rows)
+    return accepted, rejected, errors
+
+class IngestQueueFull(Exception):
+    """Raised if readings can not be queued since the ingest queue is full or closed"""
+
+class IngestQueue:
+    """Bounded in-process write-behind queue for readings
+
+    Request handlers submit validated rows and return immediately. A single writer thread
+    drains the queue and inserts everything queued within batch_interval seconds, or up to
+    batch_rows rows, in a single transaction. This turns many contended single row commits
+    into a few large ones.
+
+    The queue is bounded by rows, not submissions, so a few huge batches can not use more
+    memory than many single readings. Submitters waiting for room do not hold the lock, so each
+    of them waits at most put_timeout no matter how many wait at once.
+
+    Parameters:
+        write_rows: Function inserting and committing rows in the storage engine, see storage.Storage.insert_many
+        max_rows: Maximum number of rows waiting in the queue, a larger submission is only
+            accepted into an empty queue
+        batch_rows: Number of rows after which a batch is committed
+        batch_interval: Seconds after which a batch is committed
+        put_timeout: Seconds submit waits for room before raising IngestQueueFull
+        on_commit: Optional function called by the writer thread with the rows of every committed batch
+    """
+
+    def __init__(self, write_rows, max_rows, batch_rows, batch_interval, put_timeout, on_commit=None):
+        self.write_rows = write_rows
+        self.on_commit = on_commit
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.batch_interval = batch_interval
+        self.put_timeout = put_timeout
+        self.batches = 0
+        self.rows = 0
+        self._items = collections.deque()
+        self._queued_rows = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, rows):
+        """Queues rows for insertion
+
+        Returns a Future which is resolved once the rows are committed.
+        """
+        future = Future()
+        deadline = time.monotonic() + self.put_timeout
+        with self._condition:
+            while not self._closed and self._items and self._queued_rows + len(rows) > self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise IngestQueueFull('Ingest queue is full')
+                #Waiting releases the lock, other submitters and the writer are not blocked
+                self._condition.wait(remaining)
+            if self._closed:
+                raise IngestQueueFull('Ingest queue is closed')
+            self._items.append((rows, future))
+            self._queued_rows += len(rows)
+            self._condition.notify_all()
+        return future
+
+    def close(self, timeout=None):
+        """Stops accepting readings and blocks until every queued reading is committed"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def status(self):
+        """Returns the queue statistics"""
+        return {'queued': self._queued_rows,
+                'batches': self.batches,
+                'rows': self.rows}
+
+    def _take(self, batch, count):
+        #The caller holds the lock
+        while self._items and (not batch or count + len(self._items[0][0]) <= self.batch_rows):
+            rows, future = self._items.popleft()
+            self._queued_rows -= len(rows)
+            batch.append((rows, future))
+            count += len(rows)
+        self._condition.notify_all()
+        return count
+
+    def _run(self):
+        while True:
+            batch = []
+            with self._condition:
+                while not self._items and not self._closed:
+                    self._condition.wait()
+                if not self._items:
+                    return
+                count = self._take(batch, 0)
+                deadline = time.monotonic() + self.batch_interval
+                while count < self.batch_rows and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    if not self._items:
+                        self._condition.wait(remaining)
+                    before = count
+                    count = self._take(batch, count)
+                    if count == before and self._items:
+                        break
+            self._write(batch)
+
+    def _write(self, batch):
+        rows = [row for rows, _ in batch for row in rows]
+        try:
+            self.write_rows(rows)
+        except Exception as exception:
+            logger.exception('Failed to write %d queued submissions', len(batch))
+            for _, future in batch:
+                future.set_exception(exception)
+            return
+        if self.on_commit is not None:
+            #The rows are committed, a failing callback must neither fail them nor stop the writer
+            try:
+                self.on_commit(rows)
+            except Exception:
+                logger.exception('on_commit failed for %d committed rows', len(rows))
+        self.batches += 1
+        self.rows += len(rows)
+        for _, future in batch:
+            future.set_result(None)
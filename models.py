@@ -0,0 +1,94 @@
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Float, Index, Integer, LargeBinary, String
+
+Base = declarative_base()
+
+class Reading(Base):
+    """Sqlalchemy ORM Class for readings table"""
+    __tablename__ = 'readings'
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    device_uuid = Column(String)
+    type = Column(String)
+    value = Column(Integer)
+    date_created = Column(Integer)
+
+    __table_args__ = (
+        #Every per device endpoint filters on device_uuid, type and a date_created range.
+        #value is part of the index so min/max/mean/quartile queries never touch the table.
+        Index('ix_readings_device_type_date_value', 'device_uuid', 'type', 'date_created', 'value'),
+        #Keyset pagination seeks on (date_created, id) of a device, id is the rowid stored in every index entry
+        Index('ix_readings_device_date', 'device_uuid', 'date_created'),
+        #Finds the date_created of the reading holding a quantile value found in the histograms
+        Index('ix_readings_device_type_value_date', 'device_uuid', 'type', 'value', 'date_created'),
+    )
+
+class ReadingAggregate(Base):
+    """Sqlalchemy ORM Class for reading_aggregates table
+
+    Holds count, sum, min and max of all readings per device and sensor type.
+    The row is updated in the same transaction as every insert into readings.
+    min_date_created and max_date_created are the earliest date_created of the readings
+    holding the min and max value.
+    """
+    __tablename__ = 'reading_aggregates'
+    device_uuid = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    number_of_readings = Column(Integer, nullable=False)
+    value_sum = Column(Float, nullable=False)
+    min_value = Column(Integer, nullable=False)
+    min_date_created = Column(Integer, nullable=False)
+    max_value = Column(Integer, nullable=False)
+    max_date_created = Column(Integer, nullable=False)
+
+class ReadingRollup(Base):
+    """Sqlalchemy ORM Class for reading_rollups table
+
+    Holds count, sum, min and max of the readings per device, sensor type and time bucket
+    of granularity seconds starting at bucket_start. Like reading_aggregates the rows are
+    updated in the same transaction as every insert into readings.
+    """
+    __tablename__ = 'reading_rollups'
+    device_uuid = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    granularity = Column(Integer, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    number_of_readings = Column(Integer, nullable=False)
+    value_sum = Column(Float, nullable=False)
+    min_value = Column(Integer, nullable=False)
+    min_date_created = Column(Integer, nullable=False)
+    max_value = Column(Integer, nullable=False)
+    max_date_created = Column(Integer, nullable=False)
+
+class ReadingHistogram(Base):
+    """Sqlalchemy ORM Class for reading_histograms table
+
+    Holds the number of readings per value, device, sensor type and time bucket of
+    granularity seconds starting at bucket_start. A bucket has one row per distinct value:
+    since readings are validated to SENSOR_MIN..SENSOR_MAX, a bucket of integer readings has
+    at most 101 rows, while fractional values are not binned and can add a row per reading.
+    Like reading_rollups the rows are updated in the same transaction as every insert into readings.
+    """
+    __tablename__ = 'reading_histograms'
+    device_uuid = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    granularity = Column(Integer, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    value = Column(Integer, primary_key=True)
+    number_of_readings = Column(Integer, nullable=False)
+
+class ReadingSketch(Base):
+    """Sqlalchemy ORM Class for reading_sketches table
+
+    Holds a serialized sketches.KLLSketch of the values of the readings per device, sensor
+    type and time bucket of granularity seconds starting at bucket_start. Unlike the
+    histograms it is not limited to bounded integer values. Inserts do not update it, a row
+    is refreshed by the next query once its number_of_readings differs from the rollup of its
+    bucket, see sketches.fresh_sketches.
+    """
+    __tablename__ = 'reading_sketches'
+    device_uuid = Column(String, primary_key=True)
+    type = Column(String, primary_key=True)
+    granularity = Column(Integer, primary_key=True)
+    bucket_start = Column(Integer, primary_key=True)
+    number_of_readings = Column(Integer, nullable=False)
+    sketch = Column(LargeBinary, nullable=False)
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import sqlite3
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import NullPool
+import analytics
+import queries
+import rollups
+import summary
+from models import Reading, ReadingAggregate
+
+#Read-only engines of the databases a worker process has queried, by database URI
+_worker_engines = {}
+
+def _init_worker(nice):
+    if nice:
+        os.nice(nice)
+
+def read_only_engine(database_uri):
+    """Returns an engine opening the SQLite database of database_uri read-only
+
+    Read-only connections never take the write lock, so they can not delay a commit of the
+    API process, and the WAL lets them read while it writes.
+    """
+    path = make_url(database_uri).database
+    return create_engine('sqlite://',
+                         creator=lambda: sqlite3.connect(f'file:{path}?mode=ro', uri=True),
+                         poolclass=NullPool)
+
+def _worker_session(database_uri):
+    engine = _worker_engines.get(database_uri)
+    if engine is None:
+        engine = read_only_engine(database_uri)
+        _worker_engines[database_uri] = engine
+    return Session(bind=engine)
+
+def summary_partition(database_uri, order_by, descending, sensor_type, start, end, after, limit, first_device_uuid, last_device_uuid):
+    """Returns the ordered (value, summary) tuples of the devices with first_device_uuid <= device_uuid < last_device_uuid
+
+    Runs in a worker process, None leaves a side of the device range open. The summaries are
+    ordered, filtered by after and limited like summary.order_summaries, so a worker only hands
+    back the devices which can be on the page.
+    """
+    session = _worker_session(database_uri)
+    try:
+        query = queries.summary_value_counts_query(session, sensor_type, start, end)
+        if first_device_uuid is not None:
+            query = query.filter(Reading.device_uuid >= first_device_uuid)
+        if last_device_uuid is not None:
+            query = query.filter(Reading.device_uuid < last_device_uuid)
+        return list(summary.order_summaries(summary.iter_summaries(query), order_by, descending, after, limit))
+    finally:
+        session.close()
+
+def value_counts_partition(database_uri, device_uuid, sensor_type, lo, hi, hi_inclusive):
+    """Returns the sorted (value, number_of_readings) tuples of the readings of a device in [lo, hi) or [lo, hi]
+
+    Runs in a worker process of the 'numpy' quantile engine. The values are read with the raw
+    cursor into a float64 array and counted by np.unique, like analytics.statistics.
+    """
+    session = _worker_session(database_uri)
+    try:
+        packed = analytics.fetch_packed(session, rollups.edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive))
+        return analytics.value_counts(packed[:, 0])
+    finally:
+        session.close()
+
+def device_partitions(device_uuids, count):
+    """Splits the sorted device_uuids into at most count ranges of about the same number of devices
+
+    Returns a list of (first_device_uuid, last_device_uuid) ranges including the first and
+    excluding the last device. The first and last range are open, so devices missing from
+    device_uuids are still covered.
+    """
+    count = max(1, min(count, len(device_uuids)))
+    bounds = [device_uuids[len(device_uuids) * index // count] for index in range(1, count)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def time_partitions(start, end, count):
+    """Splits the inclusive range [start, end] into count ranges of the same length
+
+    Returns a list of (lo, hi, hi_inclusive) ranges, only the last one includes its end.
+    """
+    width = (end - start) / count
+    bounds = [start + width * index for index in range(1, count)]
+    return [(lo, hi, index == count - 1) for index, (lo, hi) in enumerate(zip([start] + bounds, bounds + [end]))]
+
+class AnalyticPool:
+    """Process pool running the CPU heavy parts of fleet wide summaries and exact quantiles
+
+    A job is split into one partition per worker, by device range for the summary and by time
+    range for the value counts of a quantile, and every worker computes its partition on its
+    own read-only connection, so the GIL of the API process is not held while they run. The
+    parent process only merges the partial results: the summaries of disjoint device ranges
+    are complete and ordered by the workers, so they are merged, the value counts of disjoint
+    time ranges, counted with NumPy by the workers, are added.
+    Workers run with the given nice increment, so request threads, including ingest, keep
+    their share of the CPU. Only file based SQLite databases can be read by the workers.
+
+    Parameters:
+        max_workers: Number of worker processes and partitions per job
+        nice: Niceness increment of the worker processes
+    """
+
+    def __init__(self, max_workers, nice=0):
+        self.max_workers = max_workers
+        #Spawned workers do not inherit the threads, locks and connections of the API process
+        self.executor = ProcessPoolExecutor(max_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(nice,))
+
+    def summaries(self, session, database_uri, order_by, descending, sensor_type=None, start=None, end=None, after=None, limit=None):
+        """Yields (value, summary) tuples of the devices ordered by a summary column like summary.iter_ordered_summaries
+
+        Every worker orders and limits the summaries of its device range, the ordered ranges are
+        merged while streaming, so the API process holds at most limit summaries per worker.
+        session is only used to read the device_uuids of the reading_aggregates table, which
+        bound the device ranges of the workers.
+        """
+        device_uuids = [device_uuid for device_uuid, in session.query(ReadingAggregate.device_uuid).distinct().order_by(ReadingAggregate.device_uuid)]
+        futures = [self.executor.submit(summary_partition, database_uri, order_by, descending, sensor_type, start, end, after, limit,
+                                        first_device_uuid, last_device_uuid)
+                   for first_device_uuid, last_device_uuid in device_partitions(device_uuids, self.max_workers)]
+        key = summary.sort_key(descending)
+        partitions = (iter(future.result()) for future in futures)
+        yield from itertools.islice(heapq.merge(*partitions, key=lambda item: key(item[0], item[1]['device_uuid'])), limit)
+
+    def range_histogram(self, session, database_uri, device_uuid, sensor_type, start=None, end=None):
+        """Returns the value counts of the readings of a device in a date range like histograms.range_histogram
+
+        The counts are computed from the raw readings of one time range per worker. Missing
+        bounds are replaced by the first and last date_created of the device, read with session.
+        """
+        if start is None or end is None:
+            first, last = rollups.date_bounds(session, device_uuid, sensor_type)
+            if first is None:
+                return []
+            start = first if start is None else start
+            end = last if end is None else end
+        if start > end:
+            return []
+        futures = [self.executor.submit(value_counts_partition, database_uri, device_uuid, sensor_type, lo, hi, hi_inclusive)
+                   for lo, hi, hi_inclusive in time_partitions(start, end, self.max_workers)]
+        counts = Counter()
+        for future in futures:
+            for value, count in future.result():
+                counts[value] += count
+        return sorted(counts.items())
+
+    def shutdown(self):
+        """Stops the worker processes"""
+        self.executor.shutdown(wait=True)
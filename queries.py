@@ -0,0 +1,208 @@
+import base64
+import binascii
+import json
+from sqlalchemy import Column, Float, MetaData, String, Table, and_, func, or_, tuple_
+from db import explain_query_plan
+from models import Reading, ReadingAggregate
+import histograms
+import rollups
+import sketches
+
+def filter_readings(query, device_uuid=None, sensor_type=None, start=None, end=None):
+    """Extends query with the optional device, type and date range filters shared by all endpoints"""
+    if device_uuid is not None:
+        query = query.filter(Reading.device_uuid==device_uuid)
+    if sensor_type is not None:
+        query = query.filter(Reading.type==sensor_type)
+    if start is not None:
+        query = query.filter(Reading.date_created >= start)
+    if end is not None:
+        query = query.filter(Reading.date_created <= end)
+    return query
+
+def readings_query(session, device_uuid, sensor_type=None, start=None, end=None):
+    """Query for the raw readings of a device"""
+    query = session.query(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created)
+    return filter_readings(query, device_uuid, sensor_type, start, end)
+
+def readings_page_query(session, device_uuid, limit, after=None, sensor_type=None, start=None, end=None):
+    """Query for a page of readings of a device ordered by (date_created, id)
+
+    The page starts after the (date_created, id) tuple of the previous page, so each page is a
+    single seek on the index no matter how deep into the history it is. One more row than limit
+    is returned to tell whether there is a next page.
+    """
+    query = session.query(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created, Reading.id)
+    query = filter_readings(query, device_uuid, sensor_type, start, end)
+    if after is not None:
+        query = query.filter(tuple_(Reading.date_created, Reading.id) > tuple_(*after))
+    return query.order_by(Reading.date_created, Reading.id).limit(limit + 1)
+
+def encode_cursor(date_created, reading_id):
+    """Returns the opaque cursor pointing after the reading with date_created and reading_id"""
+    return base64.urlsafe_b64encode(json.dumps([date_created, reading_id]).encode()).decode()
+
+def decode_cursor(cursor):
+    """Returns the (date_created, id) tuple of a cursor created by encode_cursor
+
+    Raises ValueError for an invalid cursor.
+    """
+    try:
+        date_created, reading_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError(f'Invalid cursor {cursor}')
+    if not all(isinstance(i, (int, float)) and not isinstance(i, bool) for i in (date_created, reading_id)):
+        raise ValueError(f'Invalid cursor {cursor}')
+    return date_created, reading_id
+
+def summary_value_counts_query(session, sensor_type=None, start=None, end=None):
+    """Query for the number of readings per device and value ordered by device
+
+    The groups are produced in the order of the (device_uuid, type, value, date_created) index
+    in a single pass without sorting, so the per device summaries can be folded while streaming.
+    Readings of several sensor types of a device come in one sorted run per type.
+    """
+    query = session.query(Reading.device_uuid, Reading.value, func.count())
+    if sensor_type is not None:
+        #An equality on the plain column makes SQLite sort all groups in a temporary b-tree
+        query = query.filter(Reading.type.concat('') == sensor_type)
+    query = filter_readings(query, None, None, start, end)
+    return query.group_by(Reading.device_uuid, Reading.type, Reading.value).\
+                 order_by(Reading.device_uuid, Reading.type, Reading.value)
+
+def fleet_value_counts_query(session, device_uuids, sensor_type, start=None, end=None):
+    """Query for the number of readings per value of every device in device_uuids ordered by device
+
+    A single grouped query seeks the composite index once per device of the IN list.
+    Returns a query for (device_uuid, value, number_of_readings) rows.
+    """
+    query = session.query(Reading.device_uuid, Reading.value, func.count()).\
+                    filter(Reading.device_uuid.in_(device_uuids)).\
+                    filter(Reading.type == sensor_type)
+    query = filter_readings(query, None, None, start, end)
+    return query.group_by(Reading.device_uuid, Reading.value).\
+                 order_by(Reading.device_uuid, Reading.value)
+
+#Connection local table of the (device_uuid, value) pairs joined by fleet_earliest_dates_query
+fleet_device_values = Table('fleet_device_values', MetaData(),
+                            Column('device_uuid', String),
+                            Column('value', Float),
+                            prefixes=['TEMPORARY'])
+
+def fleet_earliest_dates_query(session, device_values, sensor_type, start=None, end=None):
+    """Query for the earliest date_created of the readings of many devices holding a value
+
+    device_values is a list of (device_uuid, value) tuples. They are loaded into the temporary
+    fleet_device_values table of the connection of session, which is joined with the readings,
+    so every pair is a seek on the (device_uuid, type, value, date_created) index. SQLite scans
+    a row value IN list instead. Returns a query for (device_uuid, value, date_created) rows.
+    """
+    connection = session.connection()
+    fleet_device_values.create(connection, checkfirst=True)
+    connection.execute(fleet_device_values.delete())
+    if device_values:
+        connection.execute(fleet_device_values.insert(), [{'device_uuid': device_uuid, 'value': value}
+                                                          for device_uuid, value in device_values])
+    query = session.query(fleet_device_values.c.device_uuid, fleet_device_values.c.value, func.min(Reading.date_created)).\
+                    join(Reading, and_(Reading.device_uuid == fleet_device_values.c.device_uuid,
+                                       Reading.value == fleet_device_values.c.value)).\
+                    filter(Reading.type == sensor_type)
+    query = filter_readings(query, None, None, start, end)
+    return query.group_by(fleet_device_values.c.device_uuid, fleet_device_values.c.value)
+
+def summary_order_query(session, order_by, descending, sensor_type=None, start=None, end=None, after=None):
+    """Query for the devices of the summary ordered by a summary column and device_uuid
+
+    Without start and end the order is computed from the reading_aggregates table, which has a
+    row per device and sensor type, otherwise from the matching readings. Scanning the
+    aggregates instead of the readings relies on every device having its rows: inserts update
+    them in their transaction, the schema bootstrap backfills a new table and check-aggregates
+    reports devices whose rows are missing, see aggregates.missing_aggregates. Ties are ordered by
+    device_uuid ascending. after is the (value, device_uuid) of the last device of the previous
+    page. Returns a query for (device_uuid, value) rows.
+
+    Parameters:
+        order_by: One of device_uuid, number_of_readings, min_reading_value,
+            max_reading_value and mean_reading_value
+        descending: Whether the devices are ordered by descending values
+    """
+    if start is None and end is None:
+        device_uuid = ReadingAggregate.device_uuid
+        columns = {'device_uuid': ReadingAggregate.device_uuid,
+                   'number_of_readings': func.sum(ReadingAggregate.number_of_readings),
+                   'min_reading_value': func.min(ReadingAggregate.min_value),
+                   'max_reading_value': func.max(ReadingAggregate.max_value),
+                   'mean_reading_value': func.round(func.sum(ReadingAggregate.value_sum) / func.sum(ReadingAggregate.number_of_readings), 2)}
+        query = session.query(device_uuid, columns[order_by])
+        if sensor_type is not None:
+            query = query.filter(ReadingAggregate.type==sensor_type)
+    else:
+        device_uuid = Reading.device_uuid
+        columns = {'device_uuid': Reading.device_uuid,
+                   'number_of_readings': func.count(),
+                   'min_reading_value': func.min(Reading.value),
+                   'max_reading_value': func.max(Reading.value),
+                   'mean_reading_value': func.round(func.avg(Reading.value), 2)}
+        query = filter_readings(session.query(device_uuid, columns[order_by]), None, sensor_type, start, end)
+    column = columns[order_by]
+    query = query.group_by(device_uuid)
+    if after is not None:
+        value, after_device_uuid = after
+        beyond = column < value if descending else column > value
+        if order_by == 'device_uuid':
+            query = query.having(beyond)
+        else:
+            query = query.having(or_(beyond, and_(column == value, device_uuid > after_device_uuid)))
+    if order_by == 'device_uuid':
+        return query.order_by(column.desc() if descending else column)
+    return query.order_by(column.desc() if descending else column, device_uuid)
+
+def encode_summary_cursor(order_by, order, value, device_uuid):
+    """Returns the opaque cursor pointing after the device with value in a summary ordered by order_by"""
+    return base64.urlsafe_b64encode(json.dumps([order_by, order, value, device_uuid]).encode()).decode()
+
+def decode_summary_cursor(cursor):
+    """Returns the (order_by, order, value, device_uuid) tuple of a cursor created by encode_summary_cursor
+
+    Raises ValueError for an invalid cursor.
+    """
+    try:
+        order_by, order, value, device_uuid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeError, TypeError, ValueError):
+        raise ValueError(f'Invalid cursor {cursor}')
+    if not all(isinstance(i, str) for i in (order_by, order, device_uuid)) or isinstance(value, (bool, list, dict)) or value is None:
+        raise ValueError(f'Invalid cursor {cursor}')
+    return order_by, order, value, device_uuid
+
+READINGS_INDEX = 'ix_readings_device_type_date_value'
+READINGS_INDEX_PREFIX = 'ix_readings_'
+
+def endpoint_queries(session, device_uuid='device_uuid', sensor_type='temperature', start=0, end=1):
+    """Returns the queries issued by the per device endpoints keyed by endpoint name"""
+    return {'readings': readings_query(session, device_uuid, sensor_type, start, end),
+            'readings_device': readings_query(session, device_uuid),
+            'readings_page': readings_page_query(session, device_uuid, 10, (start, 0), sensor_type, start, end),
+            'readings_page_device': readings_page_query(session, device_uuid, 10, (start, 0)),
+            'rollups': rollups.rollups_query(session, device_uuid, sensor_type, rollups.HOUR, start, end),
+            'rollup_buckets': rollups.bucket_rollups_query(session, device_uuid, sensor_type, rollups.MINUTE, start, end),
+            'reading_buckets': rollups.bucket_readings_query(session, device_uuid, sensor_type, 90, start, end),
+            'rollup_edge': rollups.edge_query(session, device_uuid, sensor_type, start, end, True),
+            'first_date': rollups.date_bounds_query(session, device_uuid, sensor_type).order_by(Reading.date_created).limit(1),
+            'histograms': histograms.histogram_query(session, device_uuid, sensor_type, rollups.HOUR, start, end),
+            'sketches': sketches.bucket_states_query(session, device_uuid, sensor_type, rollups.HOUR, start, end),
+            'earliest_date': histograms.earliest_date_created_query(session, device_uuid, sensor_type, 50, start, end),
+            'fleet_value_counts': fleet_value_counts_query(session, [device_uuid, 'other_uuid'], sensor_type, start, end),
+            'fleet_earliest_dates': fleet_earliest_dates_query(session, [(device_uuid, 50), ('other_uuid', 50)], sensor_type, start, end)}
+
+def check_query_plans(session):
+    """Checks that every per device endpoint query is answered from an index and never scans a table
+
+    Returns a dict mapping the endpoint name to a tuple of (uses_index, plan details)
+    """
+    result = {}
+    for name, query in endpoint_queries(session).items():
+        plan = explain_query_plan(session, query)
+        uses_index = any(f'INDEX {READINGS_INDEX_PREFIX}' in detail or 'INDEX sqlite_autoindex_' in detail for detail in plan) \
+                     and not any(detail.startswith(('SCAN readings', 'SCAN reading_')) for detail in plan)
+        result[name] = (uses_index, plan)
+    return result
@@ -0,0 +1,223 @@
+import math
+from sqlalchemy import Integer, cast, func, select
+import aggregates
+from models import Reading, ReadingRollup
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+#Coarsest first, every granularity is a multiple of the next one
+GRANULARITIES = (DAY, HOUR, MINUTE)
+
+def bucket_start(date_created, granularity):
+    """Returns the start of the bucket of granularity seconds containing date_created"""
+    return math.floor(date_created / granularity) * granularity
+
+def plan_range(start, end, granularities=GRANULARITIES):
+    """Covers the inclusive date range [start, end] with whole buckets and raw ragged edges
+
+    The range is covered with the coarsest buckets possible. Only the parts at the edges
+    which are smaller than a bucket of the finest granularity have to be read from the
+    readings table, so the cost of a query depends on the number of buckets and not on
+    the number of readings.
+
+    Returns a tuple of (buckets, edges). buckets is a list of
+    (granularity, first_bucket_start, last_bucket_start) and edges a list of
+    (lo, hi, hi_inclusive) date ranges to be read from the readings table.
+    """
+    buckets = []
+    edges = []
+    _cover(start, end, True, granularities, buckets, edges)
+    return buckets, edges
+
+def _cover(lo, hi, hi_inclusive, granularities, buckets, edges):
+    if lo > hi or (lo == hi and not hi_inclusive):
+        return
+    if not granularities:
+        edges.append((lo, hi, hi_inclusive))
+        return
+    granularity = granularities[0]
+    first = math.ceil(lo / granularity) * granularity
+    #Every date of a whole bucket is smaller than its end, so the end may be equal to hi
+    last_end = math.floor(hi / granularity) * granularity
+    if first >= last_end:
+        _cover(lo, hi, hi_inclusive, granularities[1:], buckets, edges)
+        return
+    buckets.append((granularity, first, last_end - granularity))
+    _cover(lo, first, False, granularities[1:], buckets, edges)
+    _cover(last_end, hi, hi_inclusive, granularities[1:], buckets, edges)
+
+def rollup_key(granularity):
+    """Returns the function grouping rows by device, sensor type and bucket of granularity"""
+    def key(row):
+        return row['device_uuid'], row['type'], granularity, bucket_start(row['date_created'], granularity)
+    return key
+
+def update_rollups(session, rows, granularities=GRANULARITIES):
+    """Merges rows into the reading_rollups table
+
+    Must be called in the transaction inserting rows into readings.
+    """
+    parameters = []
+    for granularity in granularities:
+        for (device_uuid, sensor_type, _, start), group in aggregates.accumulate(rows, rollup_key(granularity)).items():
+            parameters.append(aggregates.group_parameters({'device_uuid': device_uuid,
+                                                           'type': sensor_type,
+                                                           'granularity': granularity,
+                                                           'bucket_start': start}, group))
+    if not parameters:
+        return
+    table = ReadingRollup.__table__
+    statement = aggregates.upsert_statement(table, [table.c.device_uuid, table.c.type, table.c.granularity, table.c.bucket_start])
+    session.execute(statement, parameters)
+
+def rebuild_rollups(session, chunk_size=10000):
+    """Recomputes the reading_rollups table from the readings table and commits
+
+    The readings are streamed in chunks of chunk_size rows.
+    Returns the number of readings.
+    """
+    session.query(ReadingRollup).delete()
+    result = session.connection().execution_options(stream_results=True).execute(
+        select(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created))
+    count = 0
+    while True:
+        rows = [row._mapping for row in result.fetchmany(chunk_size)]
+        if not rows:
+            break
+        update_rollups(session, rows)
+        count += len(rows)
+    session.commit()
+    return count
+
+def rollups_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+    """Query for the aggregate columns of the rollups of a device in a range of buckets"""
+    return session.query(ReadingRollup.number_of_readings,
+                         ReadingRollup.value_sum,
+                         ReadingRollup.min_value,
+                         ReadingRollup.min_date_created,
+                         ReadingRollup.max_value,
+                         ReadingRollup.max_date_created).\
+                   filter(ReadingRollup.device_uuid==device_uuid).\
+                   filter(ReadingRollup.type==sensor_type).\
+                   filter(ReadingRollup.granularity==granularity).\
+                   filter(ReadingRollup.bucket_start >= first_bucket_start).\
+                   filter(ReadingRollup.bucket_start <= last_bucket_start)
+
+def edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive):
+    """Query for value and date_created of the readings of a device in a ragged edge"""
+    query = session.query(Reading.value, Reading.date_created).\
+                    filter(Reading.device_uuid==device_uuid).\
+                    filter(Reading.type==sensor_type).\
+                    filter(Reading.date_created >= lo)
+    if hi_inclusive:
+        return query.filter(Reading.date_created <= hi)
+    return query.filter(Reading.date_created < hi)
+
+def date_bounds_query(session, device_uuid, sensor_type):
+    """Query for the date_created of the readings of a device"""
+    return session.query(Reading.date_created).\
+                   filter(Reading.device_uuid==device_uuid).\
+                   filter(Reading.type==sensor_type)
+
+def date_bounds(session, device_uuid, sensor_type):
+    """Returns the first and last date_created of the readings of a device
+
+    Each bound is a single seek on the readings index.
+    """
+    query = date_bounds_query(session, device_uuid, sensor_type)
+    first = query.order_by(Reading.date_created).limit(1).scalar()
+    last = query.order_by(Reading.date_created.desc()).limit(1).scalar()
+    return first, last
+
+def range_aggregates(session, device_uuid, sensor_type, start=None, end=None):
+    """Returns the aggregates of the readings of a device with start <= date_created <= end
+
+    Missing bounds are replaced by the first and last date_created of the device.
+    Returns a list in the format of aggregates.accumulate or None if there are no readings.
+    """
+    if start is None or end is None:
+        first, last = date_bounds(session, device_uuid, sensor_type)
+        if first is None:
+            return None
+        start = first if start is None else start
+        end = last if end is None else end
+    buckets, edges = plan_range(start, end)
+    result = None
+    for granularity, first_bucket_start, last_bucket_start in buckets:
+        for row in rollups_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+            result = list(row) if result is None else aggregates.merge(result, row)
+    for lo, hi, hi_inclusive in edges:
+        for value, date_created in edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive):
+            row = (1, value, value, date_created, value, date_created)
+            result = list(row) if result is None else aggregates.merge(result, row)
+    return result
+
+def bucket_rollups_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+    """Query for bucket_start, number_of_readings, value_sum, min_value and max_value of the rollups of a device"""
+    return session.query(ReadingRollup.bucket_start,
+                         ReadingRollup.number_of_readings,
+                         ReadingRollup.value_sum,
+                         ReadingRollup.min_value,
+                         ReadingRollup.max_value).\
+                   filter(ReadingRollup.device_uuid==device_uuid).\
+                   filter(ReadingRollup.type==sensor_type).\
+                   filter(ReadingRollup.granularity==granularity).\
+                   filter(ReadingRollup.bucket_start >= first_bucket_start).\
+                   filter(ReadingRollup.bucket_start <= last_bucket_start)
+
+def bucket_readings_query(session, device_uuid, sensor_type, width, start, end):
+    """Query for the aggregates of the readings of a device grouped into buckets of width seconds
+
+    Returns a query for (bucket_start, number_of_readings, value_sum, min_value, max_value) rows.
+    """
+    #floor(x) is trunc(x) minus one for negative x below their truncation, SQLite has no floor without the math extension
+    quotient = Reading.date_created / float(width)
+    truncated = cast(quotient, Integer)
+    bucket = (truncated - (quotient < truncated)) * width
+    return session.query(bucket, func.count(), func.total(Reading.value), func.min(Reading.value), func.max(Reading.value)).\
+                   filter(Reading.device_uuid==device_uuid).\
+                   filter(Reading.type==sensor_type).\
+                   filter(Reading.date_created >= start).\
+                   filter(Reading.date_created <= end).\
+                   group_by(bucket).\
+                   order_by(bucket)
+
+def range_buckets(session, device_uuid, sensor_type, width, start=None, end=None):
+    """Returns the aggregates of the readings of a device with start <= date_created <= end per bucket of width seconds
+
+    Buckets start at multiples of width. If width is a multiple of a rollup granularity the
+    buckets are merged from the rollups of the coarsest such granularity and only the ragged
+    edges are read from the readings table, otherwise the readings are grouped in the database.
+    Missing bounds are replaced by the first and last date_created of the device. Returns a list
+    of (bucket_start, number_of_readings, value_sum, min_value, max_value) tuples ordered by
+    bucket_start.
+    """
+    if start is None or end is None:
+        first, last = date_bounds(session, device_uuid, sensor_type)
+        if first is None:
+            return []
+        start = first if start is None else start
+        end = last if end is None else end
+    granularities = [granularity for granularity in GRANULARITIES if width % granularity == 0]
+    if not granularities:
+        return [tuple(row) for row in bucket_readings_query(session, device_uuid, sensor_type, width, start, end)]
+    buckets = {}
+    def merge(row):
+        key = bucket_start(row[0], width)
+        if key not in buckets:
+            buckets[key] = [key] + list(row[1:])
+            return
+        bucket = buckets[key]
+        bucket[1] += row[1]
+        bucket[2] += row[2]
+        bucket[3] = min(bucket[3], row[3])
+        bucket[4] = max(bucket[4], row[4])
+    whole, edges = plan_range(start, end, granularities[:1])
+    for granularity, first_bucket_start, last_bucket_start in whole:
+        for row in bucket_rollups_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+            merge(row)
+    for lo, hi, hi_inclusive in edges:
+        for value, date_created in edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive):
+            merge((date_created, 1, value, value, value))
+    return [tuple(buckets[key]) for key in sorted(buckets)]
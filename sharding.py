@@ -0,0 +1,184 @@
+import functools
+import heapq
+import itertools
+import queue
+import threading
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import db
+import storage
+import summary
+
+#Seconds a producer waits for room in its queue before checking whether the consumer is gone
+_PUT_TIMEOUT = 0.1
+
+def shard_index(device_uuid, shard_count):
+    """Returns the shard of a device, stable across processes unlike hash()"""
+    return zlib.crc32(device_uuid.encode()) % shard_count
+
+def shard_configs(config):
+    """Returns the database configs of the SHARD_COUNT shards of config
+
+    The URI of shard i is SHARD_DATABASE_URI (TEST_SHARD_DATABASE_URI when testing)
+    formatted with shard=i, every other setting is shared.
+    """
+    return [dict(config,
+                 DATABASE_URI=config['SHARD_DATABASE_URI'].format(shard=shard),
+                 TEST_DATABASE_URI=config['TEST_SHARD_DATABASE_URI'].format(shard=shard))
+            for shard in range(config['SHARD_COUNT'])]
+
+def create_sqlite_shards(config, quantile_engine='histograms', analytic_pool=None):
+    """Returns a storage.SQLiteStorage per shard of config, each with its own session registry"""
+    return [storage.SQLiteStorage(shard_config, quantile_engine, db.session_registry(db.database_uri(shard_config)), analytic_pool)
+            for shard_config in shard_configs(config)]
+
+def _call(method, *args):
+    #Runs on an executor thread, which must not keep the sessions of a request
+    try:
+        return method(*args)
+    finally:
+        db.remove_session()
+
+def _put(output, stop, item):
+    while not stop.is_set():
+        try:
+            output.put(item, timeout=_PUT_TIMEOUT)
+            return
+        except queue.Full:
+            pass
+
+def _produce(make_iterable, chunk_size, output, stop):
+    try:
+        iterator = iter(make_iterable())
+        while not stop.is_set():
+            chunk = list(itertools.islice(iterator, chunk_size))
+            _put(output, stop, chunk)
+            if not chunk:
+                return
+    except Exception as error:
+        _put(output, stop, error)
+    finally:
+        db.remove_session()
+
+def _consume(output):
+    while True:
+        chunk = output.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            return
+        yield from chunk
+
+class ShardedStorage(storage.Storage):
+    """Storage engine routing every device to one of several shards by a hash of its device_uuid
+
+    Per device reads and writes go to the shard of the device only, so writes of devices on
+    different shards never wait for the same SQLite write lock. Writes of many devices are
+    split by shard and committed in parallel, each shard in its own transaction. Fleet wide
+    queries fan out to all shards in parallel: since a device lives on a single shard its
+    aggregates and value counts are complete within that shard, so the statistics of the
+    shards are merged as they are and the ordered summaries of the shards are merged into
+    one order, streaming.
+
+    Parameters:
+        shards: List of storage.Storage engines, one per shard
+        max_workers: Number of executor threads running the shard writes and fleet statistics
+    """
+
+    def __init__(self, shards, max_workers):
+        self.shards = shards
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix='shard')
+
+    def shard(self, device_uuid):
+        """Returns the storage engine of the shard of a device"""
+        return self.shards[shard_index(device_uuid, len(self.shards))]
+
+    def insert_many(self, rows):
+        """Inserts rows, committing the rows of every shard in a transaction of that shard
+
+        The shards commit independently, so the rows of a batch are not atomic: if a shard
+        fails, the rows of the other shards may already be committed when the exception is
+        raised, and retrying the whole batch inserts those rows twice. The shards are written
+        one after the other on the calling thread once the executor is shut down.
+        """
+        groups = defaultdict(list)
+        for row in rows:
+            groups[shard_index(row['device_uuid'], len(self.shards))].append(row)
+        if len(groups) == 1:
+            shard, shard_rows = groups.popitem()
+            self.shards[shard].insert_many(shard_rows)
+            return
+        futures = []
+        for shard, shard_rows in groups.items():
+            try:
+                futures.append(self.executor.submit(_call, self.shards[shard].insert_many, shard_rows))
+            except RuntimeError:
+                #The executor refuses work once it is shut down, e.g. when atexit flushes the ingest queue
+                _call(self.shards[shard].insert_many, shard_rows)
+        for future in futures:
+            future.result()
+
+    def readings(self, device_uuid, sensor_type=None, start=None, end=None, chunk_size=1000):
+        return self.shard(device_uuid).readings(device_uuid, sensor_type, start, end, chunk_size)
+
+    def readings_page(self, device_uuid, limit, after=None, sensor_type=None, start=None, end=None):
+        return self.shard(device_uuid).readings_page(device_uuid, limit, after, sensor_type, start, end)
+
+    def aggregate(self, device_uuid, sensor_type, start=None, end=None):
+        return self.shard(device_uuid).aggregate(device_uuid, sensor_type, start, end)
+
+    def quantiles(self, device_uuid, sensor_type, start=None, end=None, precision=None):
+        return self.shard(device_uuid).quantiles(device_uuid, sensor_type, start, end, precision)
+
+    def earliest_date_created(self, device_uuid, sensor_type, value, start=None, end=None):
+        return self.shard(device_uuid).earliest_date_created(device_uuid, sensor_type, value, start, end)
+
+    def mode(self, device_uuid, sensor_type, start=None, end=None):
+        return self.shard(device_uuid).mode(device_uuid, sensor_type, start, end)
+
+    def buckets(self, device_uuid, sensor_type, width, start=None, end=None):
+        return self.shard(device_uuid).buckets(device_uuid, sensor_type, width, start, end)
+
+    def statistics(self, device_uuid, sensor_type, start=None, end=None, metrics=storage.STATISTICS):
+        return self.shard(device_uuid).statistics(device_uuid, sensor_type, start, end, metrics)
+
+    def fleet_statistics(self, device_uuids, sensor_type, start=None, end=None, metrics=storage.STATISTICS):
+        groups = defaultdict(list)
+        for device_uuid in device_uuids:
+            groups[shard_index(device_uuid, len(self.shards))].append(device_uuid)
+        futures = [self.executor.submit(_call, self.shards[shard].fleet_statistics, shard_devices, sensor_type, start, end, metrics)
+                   for shard, shard_devices in groups.items()]
+        result = {}
+        for future in futures:
+            result.update(future.result())
+        return result
+
+    def fan_out(self, make_iterable, stop, chunk_size=1000, queue_size=4):
+        """Returns an iterator per shard over the items of make_iterable(shard), produced in parallel
+
+        Each shard is iterated on a producer thread of its own which hands over chunks of
+        chunk_size items through a queue of queue_size chunks, so at most that many are buffered
+        per shard. The producers wait for the caller, so they are not taken from the executor,
+        where a few slow clients could starve the writes and every other fan-out. Exceptions of
+        a shard are raised by its iterator. The producers run until they are done or the
+        threading.Event stop is set, which the caller must do once it stops iterating.
+        """
+        iterators = []
+        for shard in self.shards:
+            output = queue.Queue(queue_size)
+            threading.Thread(target=_produce, args=(functools.partial(make_iterable, shard), chunk_size, output, stop),
+                             name='shard-fan-out', daemon=True).start()
+            iterators.append(_consume(output))
+        return iterators
+
+    def summaries(self, order_by, descending, sensor_type=None, start=None, end=None, after=None, limit=None, chunk_size=1000):
+        #Every shard orders and limits its own devices, the shard orders are merged by the same key
+        stop = threading.Event()
+        iterators = self.fan_out(lambda shard: shard.summaries(order_by, descending, sensor_type, start, end, after, limit, chunk_size),
+                                 stop, chunk_size)
+        key = summary.sort_key(descending)
+        try:
+            yield from itertools.islice(heapq.merge(*iterators, key=lambda item: key(item[0], item[1]['device_uuid'])), limit)
+        finally:
+            stop.set()
@@ -0,0 +1,330 @@
+import math
+import random
+import struct
+import sys
+from array import array
+from collections import defaultdict
+from sqlalchemy import and_, select, tuple_
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+import rollups
+from models import Reading, ReadingRollup, ReadingSketch
+
+#Same buckets as the histograms, ragged edges below an hour are read from the readings table
+GRANULARITIES = (rollups.DAY, rollups.HOUR)
+DEFAULT_K = 200
+#Stored keys looked up per query, stays below the SQLite limit of bound parameters
+LOOKUP_CHUNK_SIZE = 200
+
+_HEADER = struct.Struct('<BHQB')
+_VERSION = 1
+#Capacity of a compactor shrinks by this factor per level below the top one
+_CAPACITY_DECAY = 2 / 3
+
+def rank_error(k=DEFAULT_K):
+    """Returns the normalized rank error bound of a sketch of parameter k
+
+    With 99% probability the rank of a returned quantile is within rank_error(k) * number_of_readings
+    of the requested rank, see Karnin, Lang and Liberty: Optimal Quantile Approximation in Streams.
+    """
+    return 1.65 / k
+
+class KLLSketch:
+    """Mergeable streaming quantile sketch of Karnin, Lang and Liberty
+
+    Values are kept in a hierarchy of compactors. An item of level h stands for 2**h readings.
+    When the sketch exceeds its capacity, a full compactor is sorted and every second item is
+    promoted to the next level, which halves its size while keeping the rank of every value
+    within rank_error(k) * number_of_readings. Two sketches are merged by concatenating their
+    levels and compacting, so sketches of buckets and devices can be combined in any order.
+
+    The sketch uses O(k) memory no matter how many values it holds. Which half of a compactor
+    is promoted is seeded by the state of the sketch, so equal inputs give equal answers.
+
+    Parameters:
+        k: Capacity of the top compactor, the rank error is about 1.65 / k
+    """
+
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.number_of_readings = 0
+        self.levels = [[]]
+
+    def update(self, value):
+        """Adds a single value"""
+        self.levels[0].append(value)
+        self.number_of_readings += 1
+        if len(self.levels[0]) >= self._capacity(0):
+            self._compress()
+
+    def merge(self, other):
+        """Merges other into this sketch and returns this sketch"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append([])
+        for level, items in enumerate(other.levels):
+            self.levels[level].extend(items)
+        self.number_of_readings += other.number_of_readings
+        self._compress()
+        return self
+
+    def quantile(self, rank):
+        """Returns the value of approximately the 1-based rank"""
+        seen = 0
+        for value, weight in self._weighted_items():
+            seen += weight
+            if seen >= rank:
+                return value
+        raise ValueError(f'Rank {rank} exceeds the {self.number_of_readings} readings of the sketch')
+
+    def _weighted_items(self):
+        items = [(value, 1 << level) for level, values in enumerate(self.levels) for value in values]
+        items.sort()
+        return items
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(math.ceil(self.k * _CAPACITY_DECAY ** depth)))
+
+    def _size(self):
+        return sum(len(values) for values in self.levels)
+
+    def _max_size(self):
+        return sum(self._capacity(level) for level in range(len(self.levels)))
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for level, values in enumerate(self.levels):
+                if len(values) >= self._capacity(level):
+                    self._compact(level)
+                    break
+
+    def _compact(self, level):
+        if level + 1 == len(self.levels):
+            self.levels.append([])
+        values = sorted(self.levels[level])
+        #An odd item stays on its level so the total weight is preserved
+        keep = [values.pop()] if len(values) % 2 else []
+        offset = random.Random(self.number_of_readings * 64 + level).getrandbits(1)
+        self.levels[level + 1].extend(values[offset::2])
+        self.levels[level] = keep
+
+    def to_bytes(self):
+        """Serializes the sketch into a compact little endian binary format"""
+        lengths = array('I', (len(values) for values in self.levels))
+        values = array('d', (value for values in self.levels for value in values))
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            values.byteswap()
+        return _HEADER.pack(_VERSION, self.k, self.number_of_readings, len(self.levels)) + lengths.tobytes() + values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Deserializes a sketch serialized by to_bytes
+
+        Raises ValueError for data in an unknown format.
+        """
+        version, k, number_of_readings, number_of_levels = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f'Unknown sketch version {version}')
+        lengths = array('I')
+        lengths.frombytes(data[_HEADER.size:_HEADER.size + 4 * number_of_levels])
+        values = array('d')
+        values.frombytes(data[_HEADER.size + 4 * number_of_levels:])
+        if sys.byteorder == 'big':
+            lengths.byteswap()
+            values.byteswap()
+        sketch = cls(k)
+        sketch.number_of_readings = number_of_readings
+        sketch.levels = []
+        position = 0
+        for length in lengths:
+            sketch.levels.append(values[position:position + length].tolist())
+            position += length
+        return sketch
+
+def to_value(value):
+    """Returns integral sketch values as int like the readings table stores them"""
+    return int(value) if value.is_integer() else value
+
+def sketch_key(row, granularity):
+    """Returns the (device_uuid, type, granularity, bucket_start) key of the sketch of row"""
+    return row['device_uuid'], row['type'], granularity, rollups.bucket_start(row['date_created'], granularity)
+
+def _store_sketches(session, sketches):
+    #sketches maps (device_uuid, type, granularity, bucket_start) keys to the KLLSketch to store
+    table = ReadingSketch.__table__
+    statement = insert(table)
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.device_uuid, table.c.type, table.c.granularity, table.c.bucket_start],
+        set_={'number_of_readings': statement.excluded.number_of_readings,
+              'sketch': statement.excluded.sketch})
+    session.execute(statement, [{'device_uuid': device_uuid,
+                                 'type': sensor_type,
+                                 'granularity': granularity,
+                                 'bucket_start': start,
+                                 'number_of_readings': sketch.number_of_readings,
+                                 'sketch': sketch.to_bytes()}
+                                for (device_uuid, sensor_type, granularity, start), sketch in sketches.items()])
+
+def update_sketches(session, rows, granularities=GRANULARITIES, k=DEFAULT_K):
+    """Adds rows to the sketches of the reading_sketches table
+
+    Unlike counts, sketches can not be merged by SQL, so the sketches of the affected buckets
+    are read, merged and written back once per call. Only used to rebuild the table, inserts
+    leave the sketches to be refreshed by the queries, see fresh_sketches.
+    """
+    values = defaultdict(list)
+    for granularity in granularities:
+        for row in rows:
+            values[sketch_key(row, granularity)].append(row['value'])
+    if not values:
+        return
+    keys = list(values.keys())
+    stored = {}
+    for position in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        query = session.query(ReadingSketch.device_uuid,
+                              ReadingSketch.type,
+                              ReadingSketch.granularity,
+                              ReadingSketch.bucket_start,
+                              ReadingSketch.sketch).\
+                        filter(tuple_(ReadingSketch.device_uuid,
+                                      ReadingSketch.type,
+                                      ReadingSketch.granularity,
+                                      ReadingSketch.bucket_start).in_(keys[position:position + LOOKUP_CHUNK_SIZE]))
+        for device_uuid, sensor_type, granularity, start, sketch in query:
+            stored[(device_uuid, sensor_type, granularity, start)] = sketch
+    updated = {}
+    for key, key_values in values.items():
+        sketch = KLLSketch.from_bytes(stored[key]) if key in stored else KLLSketch(k)
+        for value in key_values:
+            sketch.update(value)
+        updated[key] = sketch
+    _store_sketches(session, updated)
+
+def rebuild_sketches(session, chunk_size=10000, k=DEFAULT_K):
+    """Recomputes the reading_sketches table from the readings table and commits
+
+    The readings are read in (device_uuid, type, date_created) order in chunks of chunk_size
+    rows, so every bucket is written once per chunk.
+    Returns the number of readings.
+    """
+    session.query(ReadingSketch).delete()
+    result = session.connection().execution_options(stream_results=True).execute(
+        select(Reading.device_uuid, Reading.type, Reading.value, Reading.date_created).
+        order_by(Reading.device_uuid, Reading.type, Reading.date_created))
+    count = 0
+    while True:
+        rows = [row._mapping for row in result.fetchmany(chunk_size)]
+        if not rows:
+            break
+        update_sketches(session, rows, k=k)
+        count += len(rows)
+    session.commit()
+    return count
+
+def bucket_states_query(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start):
+    """Query for the bucket_start and number_of_readings of the rollups of a device in a range of buckets
+
+    Every rollup comes with the number_of_readings and the serialized sketch stored for its
+    bucket, both None if there is none.
+    """
+    return session.query(ReadingRollup.bucket_start,
+                         ReadingRollup.number_of_readings,
+                         ReadingSketch.number_of_readings,
+                         ReadingSketch.sketch).\
+                   outerjoin(ReadingSketch, and_(ReadingSketch.device_uuid==ReadingRollup.device_uuid,
+                                                 ReadingSketch.type==ReadingRollup.type,
+                                                 ReadingSketch.granularity==ReadingRollup.granularity,
+                                                 ReadingSketch.bucket_start==ReadingRollup.bucket_start)).\
+                   filter(ReadingRollup.device_uuid==device_uuid).\
+                   filter(ReadingRollup.type==sensor_type).\
+                   filter(ReadingRollup.granularity==granularity).\
+                   filter(ReadingRollup.bucket_start >= first_bucket_start).\
+                   filter(ReadingRollup.bucket_start <= last_bucket_start)
+
+def fresh_sketches(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start, refreshed, k=DEFAULT_K):
+    """Returns the sketches of the buckets of a device with readings in a range of buckets
+
+    Inserts do not touch the sketches, a stored sketch is fresh as long as it holds as many
+    readings as the rollup of its bucket, which every insert updates. Stale and missing
+    sketches are computed again, those of the finest granularity from the readings of their
+    bucket and the coarser ones by merging the sketches of the next finer granularity, so a
+    day costs at most the readings of an hour plus 24 merges. The computed sketches are added
+    to the dict refreshed by key for the caller to store.
+    """
+    result = []
+    for start, number_of_readings, sketch_readings, sketch in bucket_states_query(session, device_uuid, sensor_type, granularity,
+                                                                                  first_bucket_start, last_bucket_start):
+        if sketch is not None and sketch_readings == number_of_readings:
+            result.append(KLLSketch.from_bytes(sketch))
+            continue
+        bucket = KLLSketch(k)
+        finer = [other for other in GRANULARITIES if other < granularity]
+        if finer:
+            for part in fresh_sketches(session, device_uuid, sensor_type, max(finer), start, start + granularity - max(finer), refreshed, k):
+                bucket.merge(part)
+        else:
+            for value, _ in rollups.edge_query(session, device_uuid, sensor_type, start, start + granularity, False):
+                bucket.update(value)
+        #The stored count is the one of the readings actually read, a reading committed meanwhile leaves the sketch stale
+        refreshed[(device_uuid, sensor_type, granularity, start)] = bucket
+        result.append(bucket)
+    return result
+
+def store_sketches_nowait(session, sketches):
+    """Stores and commits refreshed sketches unless another connection holds the write lock
+
+    Storing only spares later queries the refresh, so a read must not wait for it: the rows
+    are written with busy_timeout 0 and skipped on SQLITE_BUSY, instead of stalling the read
+    behind an ingest transaction for the busy_timeout of the connection.
+    Returns whether the sketches were stored.
+    """
+    cursor = session.connection().connection.cursor()
+    try:
+        busy_timeout, = cursor.execute('PRAGMA busy_timeout').fetchone()
+        cursor.execute('PRAGMA busy_timeout=0')
+        try:
+            _store_sketches(session, sketches)
+            stored = True
+        except OperationalError:
+            stored = False
+        finally:
+            #Restored before the session hands the pooled connection back
+            cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+    finally:
+        cursor.close()
+    if stored:
+        session.commit()
+    else:
+        session.rollback()
+    return stored
+
+def range_sketch(session, device_uuid, sensor_type, start=None, end=None, k=DEFAULT_K):
+    """Returns a sketch of the readings of a device with start <= date_created <= end
+
+    Missing bounds are replaced by the first and last date_created of the device. The fresh
+    sketches of the buckets covering the range are merged with the raw values of the edges
+    below an hour. Sketches refreshed on the way are stored if that does not wait for the
+    write lock, see store_sketches_nowait.
+    Returns None if there are no readings.
+    """
+    if start is None or end is None:
+        first, last = rollups.date_bounds(session, device_uuid, sensor_type)
+        if first is None:
+            return None
+        start = first if start is None else start
+        end = last if end is None else end
+    buckets, edges = rollups.plan_range(start, end, GRANULARITIES)
+    result = KLLSketch(k)
+    refreshed = {}
+    for granularity, first_bucket_start, last_bucket_start in buckets:
+        for sketch in fresh_sketches(session, device_uuid, sensor_type, granularity, first_bucket_start, last_bucket_start, refreshed, k):
+            result.merge(sketch)
+    for lo, hi, hi_inclusive in edges:
+        for value, _ in rollups.edge_query(session, device_uuid, sensor_type, lo, hi, hi_inclusive):
+            result.update(value)
+    if refreshed:
+        store_sketches_nowait(session, refreshed)
+    if result.number_of_readings == 0:
+        return None
+    return result
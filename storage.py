@@ -0,0 +1,482 @@
+import bisect
+import functools
+import heapq
+import itertools
+import threading
+from collections import Counter, defaultdict
+import aggregates
+import analytics
+import db
+import histograms
+import ingest
+import queries
+import rollups
+import sketches
+import summary
+
+#Metrics of Storage.statistics, the first four are answered from the aggregates, the others from the ranks
+STATISTICS = ['number_of_readings', 'min', 'max', 'mean', 'median', 'quartiles', 'mode']
+AGGREGATE_STATISTICS = STATISTICS[:4]
+
+def to_value(value):
+    """Returns an integral float as int like the readings table stores it"""
+    return int(value) if isinstance(value, float) and value.is_integer() else value
+
+def fold_statistics(aggregate, histogram, earliest_date_created):
+    """Returns the statistics in the format of analytics.statistics from aggregates and a value histogram
+
+    Either may be None to leave out its statistics, earliest_date_created is a function
+    returning the date_created of the median value. Returns None if there are no readings.
+    """
+    result = {}
+    if aggregate is not None:
+        result.update({'number_of_readings': aggregate[0],
+                       'min': {'value': aggregate[2], 'date_created': aggregate[3]},
+                       'max': {'value': aggregate[4], 'date_created': aggregate[5]},
+                       'mean': aggregates.round_mean(aggregate[1], aggregate[0])})
+    if histogram:
+        number_of_readings = histograms.number_of_readings(histogram)
+        quartile_1_rank, median_rank, quartile_3_rank = histograms.quartile_ranks(number_of_readings)
+        median = histograms.value_at_rank(histogram, median_rank)
+        mode, count = histograms.mode(histogram)
+        result.update({'number_of_readings': number_of_readings,
+                       'quartile_1': histograms.value_at_rank(histogram, quartile_1_rank),
+                       'median': {'value': median, 'date_created': earliest_date_created(median)},
+                       'quartile_3': histograms.value_at_rank(histogram, quartile_3_rank),
+                       'mode': {'value': mode, 'number_of_readings': count}})
+    return result or None
+
+class Storage:
+    """Interface of the storage engines behind the HTTP routes
+
+    Readings are written as rows returned by ingest.reading_row. Date ranges include start
+    and end, None leaves a side of the range open. Every method may be called from many
+    threads at once.
+    """
+
+    def insert(self, row):
+        """Inserts and commits a single reading"""
+        self.insert_many([row])
+
+    def insert_many(self, rows):
+        """Inserts and commits readings at once"""
+        raise NotImplementedError
+
+    def readings(self, device_uuid, sensor_type=None, start=None, end=None, chunk_size=1000):
+        """Returns an iterable of the readings of a device in a date range
+
+        Every reading is a mapping of device_uuid, type, value and date_created. The readings
+        are produced lazily, chunk_size at a time where the engine fetches in chunks.
+        """
+        raise NotImplementedError
+
+    def readings_page(self, device_uuid, limit, after=None, sensor_type=None, start=None, end=None):
+        """Returns a page of readings of a device in a date range ordered by date_created
+
+        after is the position returned with the previous page, a tuple of two numbers.
+        Returns a tuple of (readings, after) where after is None for the last page.
+        """
+        raise NotImplementedError
+
+    def aggregate(self, device_uuid, sensor_type, start=None, end=None):
+        """Returns the aggregates of the readings of a device in a date range or None if there are none
+
+        The aggregates are a list of [number_of_readings, value_sum, min_value, min_date_created,
+        max_value, max_date_created] with ties of min and max resolved to the earliest date_created.
+        """
+        raise NotImplementedError
+
+    def quantiles(self, device_uuid, sensor_type, start=None, end=None, precision=None):
+        """Returns the number of readings of a device in a date range and a function returning the value of a 1-based rank
+
+        precision 'approx' allows the engine to answer within sketches.rank_error() * number_of_readings
+        ranks. Returns None if there are no readings.
+        """
+        raise NotImplementedError
+
+    def earliest_date_created(self, device_uuid, sensor_type, value, start=None, end=None):
+        """Returns the earliest date_created of the readings of a device in a date range holding value or None"""
+        raise NotImplementedError
+
+    def mode(self, device_uuid, sensor_type, start=None, end=None):
+        """Returns (value, number_of_readings) of the most frequent value in a date range or None
+
+        Ties resolve to the smallest value.
+        """
+        raise NotImplementedError
+
+    def buckets(self, device_uuid, sensor_type, width, start=None, end=None):
+        """Returns the aggregates of the readings of a device in a date range per bucket of width seconds
+
+        Buckets start at multiples of width, empty buckets are left out. Returns a list of
+        (bucket_start, number_of_readings, value_sum, min_value, max_value) tuples ordered by
+        bucket_start.
+        """
+        raise NotImplementedError
+
+    def statistics(self, device_uuid, sensor_type, start=None, end=None, metrics=STATISTICS):
+        """Returns the metrics of the readings of a device in a date range in the format of analytics.statistics
+
+        Only the statistics needed for metrics, a subset of STATISTICS, have to be present.
+        Returns None if there are no readings.
+        """
+        raise NotImplementedError
+
+    def fleet_statistics(self, device_uuids, sensor_type, start=None, end=None, metrics=STATISTICS):
+        """Returns a dict mapping every device of device_uuids with readings in a date range to its statistics
+
+        The statistics are the ones of Storage.statistics. The default implementation
+        computes them device by device.
+        """
+        result = {}
+        for device_uuid in device_uuids:
+            statistics = self.statistics(device_uuid, sensor_type, start, end, metrics)
+            if statistics is not None:
+                result[device_uuid] = statistics
+        return result
+
+    def summaries(self, order_by, descending, sensor_type=None, start=None, end=None, after=None, limit=None, chunk_size=1000):
+        """Yields (value, summary) tuples of the devices ordered by a summary column, see summary.iter_ordered_summaries"""
+        raise NotImplementedError
+
+class SQLiteStorage(Storage):
+    """Storage engine of the readings table and its aggregates, rollups, histograms and sketches
+
+    Every call uses the scoped db session of the calling thread in session_registry.
+
+    Parameters:
+        config: Mapping with the database settings, see db.get_session
+        quantile_engine: 'histograms' or 'numpy', see QUANTILE_ENGINE
+        session_registry: Registry of the scoped sessions, see db.session_registry
+        analytic_pool: Optional parallel.AnalyticPool computing the summaries and, with the
+            'numpy' quantile engine, the exact value counts in worker processes
+    """
+
+    def __init__(self, config, quantile_engine='histograms', session_registry=db.Session, analytic_pool=None):
+        self.config = config
+        self.quantile_engine = quantile_engine
+        self.session_registry = session_registry
+        self.analytic_pool = analytic_pool
+
+    def _session(self):
+        return db.get_session(self.config, self.session_registry)
+
+    def _scans_values(self):
+        #The numpy engine scans and sorts the raw values in this process unless the pool counts them
+        return self.quantile_engine == 'numpy' and self.analytic_pool is None
+
+    def _range_histogram(self, session, device_uuid, sensor_type, start, end):
+        if self.quantile_engine == 'numpy' and self.analytic_pool is not None:
+            return self.analytic_pool.range_histogram(session, db.database_uri(self.config), device_uuid, sensor_type, start, end)
+        return histograms.range_histogram(session, device_uuid, sensor_type, start, end)
+
+    def insert_many(self, rows):
+        session = self._session()
+        try:
+            ingest.insert_readings(session, rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+
+    def readings(self, device_uuid, sensor_type=None, start=None, end=None, chunk_size=1000):
+        return queries.readings_query(self._session(), device_uuid, sensor_type, start, end).yield_per(chunk_size)
+
+    def readings_page(self, device_uuid, limit, after=None, sensor_type=None, start=None, end=None):
+        #The position is the (date_created, id) of the last reading of the page
+        rows = queries.readings_page_query(self._session(), device_uuid, limit, after, sensor_type, start, end).all()
+        after = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            after = (rows[-1].date_created, rows[-1].id)
+        return [{'device_uuid': row.device_uuid,
+                 'type': row.type,
+                 'value': row.value,
+                 'date_created': row.date_created} for row in rows], after
+
+    def aggregate(self, device_uuid, sensor_type, start=None, end=None):
+        session = self._session()
+        if start is None and end is None:
+            aggregate = aggregates.lookup(session, device_uuid, sensor_type)
+            if aggregate is None:
+                return None
+            return [aggregate.number_of_readings, aggregate.value_sum,
+                    aggregate.min_value, aggregate.min_date_created,
+                    aggregate.max_value, aggregate.max_date_created]
+        return rollups.range_aggregates(session, device_uuid, sensor_type, start, end)
+
+    def quantiles(self, device_uuid, sensor_type, start=None, end=None, precision=None):
+        #Approximate ranks come from the sketches, exact ones from the histograms or the sorted values of the range
+        session = self._session()
+        if precision == 'approx':
+            sketch = sketches.range_sketch(session, device_uuid, sensor_type, start, end)
+            if sketch is None:
+                return None
+            return sketch.number_of_readings, lambda rank: sketches.to_value(sketch.quantile(rank))
+        if self._scans_values():
+            values = analytics.range_values(session, device_uuid, sensor_type, start, end)
+            if len(values) == 0:
+                return None
+            return len(values), functools.partial(analytics.value_at_rank, values)
+        histogram = self._range_histogram(session, device_uuid, sensor_type, start, end)
+        if not histogram:
+            return None
+        return histograms.number_of_readings(histogram), functools.partial(histograms.value_at_rank, histogram)
+
+    def earliest_date_created(self, device_uuid, sensor_type, value, start=None, end=None):
+        return histograms.earliest_date_created_query(self._session(), device_uuid, sensor_type, value, start, end).scalar()
+
+    def mode(self, device_uuid, sensor_type, start=None, end=None):
+        session = self._session()
+        if self._scans_values():
+            result = analytics.statistics(*analytics.fetch_arrays(session, device_uuid, sensor_type, start, end))
+            if result is None:
+                return None
+            return result['mode']['value'], result['mode']['number_of_readings']
+        histogram = self._range_histogram(session, device_uuid, sensor_type, start, end)
+        if not histogram:
+            return None
+        return histograms.mode(histogram)
+
+    def buckets(self, device_uuid, sensor_type, width, start=None, end=None):
+        return rollups.range_buckets(self._session(), device_uuid, sensor_type, width, start, end)
+
+    def statistics(self, device_uuid, sensor_type, start=None, end=None, metrics=STATISTICS):
+        #One aggregate lookup or rollup plan and one histogram merge, or a single scan of the range with NumPy
+        session = self._session()
+        ranks = any(metric not in AGGREGATE_STATISTICS for metric in metrics)
+        if ranks and self._scans_values():
+            return analytics.statistics(*analytics.fetch_arrays(session, device_uuid, sensor_type, start, end))
+        aggregate = None
+        if not ranks or any(metric in AGGREGATE_STATISTICS[1:] for metric in metrics):
+            aggregate = self.aggregate(device_uuid, sensor_type, start, end)
+        histogram = self._range_histogram(session, device_uuid, sensor_type, start, end) if ranks else None
+        return fold_statistics(aggregate, histogram,
+                               lambda value: self.earliest_date_created(device_uuid, sensor_type, value, start, end))
+
+    def fleet_statistics(self, device_uuids, sensor_type, start=None, end=None, metrics=STATISTICS):
+        #One grouped query for the value counts of all devices and one join for the dates of their min, max and median
+        session = self._session()
+        device_histograms = {}
+        for device_uuid, value, count in queries.fleet_value_counts_query(session, device_uuids, sensor_type, start, end):
+            device_histograms.setdefault(device_uuid, []).append((value, count))
+
+        device_values = set()
+        for device_uuid, histogram in device_histograms.items():
+            if 'min' in metrics:
+                device_values.add((device_uuid, histogram[0][0]))
+            if 'max' in metrics:
+                device_values.add((device_uuid, histogram[-1][0]))
+            if 'median' in metrics:
+                _, median_rank, _ = histograms.quartile_ranks(histograms.number_of_readings(histogram))
+                device_values.add((device_uuid, histograms.value_at_rank(histogram, median_rank)))
+        dates = {}
+        if device_values:
+            #The temporary table holds the values as REAL
+            for device_uuid, value, date_created in queries.fleet_earliest_dates_query(session, sorted(device_values), sensor_type, start, end):
+                dates[(device_uuid, float(value))] = date_created
+
+        result = {}
+        for device_uuid, histogram in device_histograms.items():
+            def earliest_date_created(value):
+                return dates.get((device_uuid, float(value)))
+            aggregate = [histograms.number_of_readings(histogram), sum(value * count for value, count in histogram),
+                         histogram[0][0], earliest_date_created(histogram[0][0]),
+                         histogram[-1][0], earliest_date_created(histogram[-1][0])]
+            result[device_uuid] = fold_statistics(aggregate, histogram, earliest_date_created)
+        return result
+
+    def summaries(self, order_by, descending, sensor_type=None, start=None, end=None, after=None, limit=None, chunk_size=1000):
+        #The pool folds the summaries of all devices, which pays off unless the database orders and
+        #limits the devices. The mean is left to the database, which rounds it differently.
+        if self.analytic_pool is not None and order_by != 'mean_reading_value' and \
+           (limit is None or order_by not in summary.DATABASE_ORDER_COLUMNS):
+            return self.analytic_pool.summaries(self._session(), db.database_uri(self.config), order_by, descending,
+                                                sensor_type, start, end, after, limit)
+        return summary.iter_ordered_summaries(self._session(), order_by, descending, sensor_type, start, end, after, limit, chunk_size)
+
+class SliceStorage(Storage):
+    """Base of storage engines handing out the readings of a date range as slices sorted by date_created
+
+    Subclasses implement insert_many, device_uuids, sensor_types and slices, every query is
+    computed over the slices in Python. Quantiles are always exact.
+    """
+
+    def device_uuids(self):
+        """Returns the sorted device_uuids with readings"""
+        raise NotImplementedError
+
+    def sensor_types(self, device_uuid, sensor_type=None):
+        """Returns the sorted sensor types of a device, restricted to sensor_type if given"""
+        raise NotImplementedError
+
+    def slices(self, device_uuid, sensor_type=None, start=None, end=None):
+        """Yields (sensor_type, dates, values) slices of the readings of a device in a date range
+
+        Each slice is sorted by date_created and stays valid while new readings are inserted.
+        """
+        raise NotImplementedError
+
+    def aggregate(self, device_uuid, sensor_type, start=None, end=None):
+        result = None
+        for _, dates, values in self.slices(device_uuid, sensor_type, start, end):
+            row = self._slice_aggregate(dates, values)
+            result = list(row) if result is None else aggregates.merge(result, row)
+        return result
+
+    @staticmethod
+    def _slice_aggregate(dates, values):
+        min_value = min(values)
+        max_value = max(values)
+        #Slices are sorted by date_created, so the first occurrence is the earliest one of the slice
+        return (len(values), sum(values),
+                to_value(min_value), to_value(dates[_first_index(values, min_value)]),
+                to_value(max_value), to_value(dates[_first_index(values, max_value)]))
+
+    def histogram(self, device_uuid, sensor_type=None, start=None, end=None):
+        """Returns the sorted (value, number_of_readings) tuples of the readings of a device in a date range"""
+        counts = Counter()
+        for _, _, values in self.slices(device_uuid, sensor_type, start, end):
+            counts.update(values)
+        return sorted((to_value(value), count) for value, count in counts.items())
+
+    def quantiles(self, device_uuid, sensor_type, start=None, end=None, precision=None):
+        histogram = self.histogram(device_uuid, sensor_type, start, end)
+        if not histogram:
+            return None
+        return histograms.number_of_readings(histogram), functools.partial(histograms.value_at_rank, histogram)
+
+    def earliest_date_created(self, device_uuid, sensor_type, value, start=None, end=None):
+        result = None
+        for _, dates, values in self.slices(device_uuid, sensor_type, start, end):
+            index = _first_index(values, value)
+            if index is not None and (result is None or dates[index] < result):
+                result = dates[index]
+        return to_value(result)
+
+    def mode(self, device_uuid, sensor_type, start=None, end=None):
+        histogram = self.histogram(device_uuid, sensor_type, start, end)
+        if not histogram:
+            return None
+        return histograms.mode(histogram)
+
+    def buckets(self, device_uuid, sensor_type, width, start=None, end=None):
+        result = {}
+        for _, dates, values in self.slices(device_uuid, sensor_type, start, end):
+            for date_created, value in zip(dates, values):
+                key = rollups.bucket_start(date_created, width)
+                bucket = result.get(key)
+                if bucket is None:
+                    result[key] = [key, 1, value, value, value]
+                else:
+                    bucket[1] += 1
+                    bucket[2] += value
+                    bucket[3] = min(bucket[3], value)
+                    bucket[4] = max(bucket[4], value)
+        return [(to_value(key), count, value_sum, to_value(min_value), to_value(max_value))
+                for key, count, value_sum, min_value, max_value in (result[key] for key in sorted(result))]
+
+    def statistics(self, device_uuid, sensor_type, start=None, end=None, metrics=STATISTICS):
+        #A single pass over the slices accumulates the aggregates and the value counts
+        aggregate = None
+        counts = Counter()
+        for _, dates, values in self.slices(device_uuid, sensor_type, start, end):
+            row = self._slice_aggregate(dates, values)
+            aggregate = list(row) if aggregate is None else aggregates.merge(aggregate, row)
+            counts.update(values)
+        histogram = sorted((to_value(value), count) for value, count in counts.items())
+        return fold_statistics(aggregate, histogram,
+                               lambda value: self.earliest_date_created(device_uuid, sensor_type, value, start, end))
+
+    def _merged_readings(self, device_uuid, sensor_type=None, start=None, end=None):
+        #Tuples of (date_created, type, position, value), the position keeps the order of equal dates stable
+        slices = []
+        for series_type, dates, values in self.slices(device_uuid, sensor_type, start, end):
+            slices.append(zip(dates, itertools.repeat(series_type), itertools.count(len(slices) << 32), values))
+        return heapq.merge(*slices)
+
+    def readings(self, device_uuid, sensor_type=None, start=None, end=None, chunk_size=1000):
+        return (_reading(device_uuid, reading) for reading in self._merged_readings(device_uuid, sensor_type, start, end))
+
+    def readings_page(self, device_uuid, limit, after=None, sensor_type=None, start=None, end=None):
+        #The position is (date_created, skip): the next page starts at date_created,
+        #skipping the first skip readings with exactly this date_created
+        skip = 0
+        if after is not None:
+            start = after[0] if start is None else max(start, after[0])
+            skip = max(0, int(after[1])) if start == after[0] else 0
+        readings = list(itertools.islice(self._merged_readings(device_uuid, sensor_type, start, end), skip, skip + limit + 1))
+        if len(readings) <= limit:
+            return [_reading(device_uuid, reading) for reading in readings], None
+        readings = readings[:limit]
+        last_date = readings[-1][0]
+        same_date = sum(1 for reading in readings if reading[0] == last_date)
+        if after is not None and readings[0][0] == after[0] == last_date:
+            same_date += skip
+        return [_reading(device_uuid, reading) for reading in readings], (to_value(last_date), same_date)
+
+    def iter_summaries(self, sensor_type=None, start=None, end=None):
+        """Yields the summaries of all devices with readings in a date range ordered by device_uuid"""
+        for device_uuid in self.device_uuids():
+            counts = Counter()
+            for _, _, values in self.slices(device_uuid, sensor_type, start, end):
+                counts.update(values)
+            if counts:
+                yield summary.device_summary(device_uuid, Counter(dict((to_value(value), count) for value, count in counts.items())))
+
+    def summaries(self, order_by, descending, sensor_type=None, start=None, end=None, after=None, limit=None, chunk_size=1000):
+        return summary.order_summaries(self.iter_summaries(sensor_type, start, end), order_by, descending, after, limit)
+
+class MemoryStorage(SliceStorage):
+    """Storage engine keeping the readings in process memory, lost when the process exits
+
+    The dates and values of every device and sensor type are kept in two lists sorted by
+    date_created. Meant for tests and for benchmarking the other engines against.
+    """
+
+    def __init__(self):
+        self._series = defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def insert_many(self, rows):
+        with self._lock:
+            for row in sorted(rows, key=lambda row: row['date_created']):
+                dates, values = self._series[row['device_uuid']].setdefault(row['type'], ([], []))
+                index = bisect.bisect_right(dates, row['date_created'])
+                dates.insert(index, row['date_created'])
+                values.insert(index, row['value'])
+
+    def device_uuids(self):
+        with self._lock:
+            return sorted(self._series)
+
+    def sensor_types(self, device_uuid, sensor_type=None):
+        with self._lock:
+            sensor_types = sorted(self._series.get(device_uuid, ()))
+        if sensor_type is not None:
+            return [sensor_type] if sensor_type in sensor_types else []
+        return sensor_types
+
+    def slices(self, device_uuid, sensor_type=None, start=None, end=None):
+        for series_type in self.sensor_types(device_uuid, sensor_type):
+            #The slices are copied under the lock, so they are not changed by later inserts
+            with self._lock:
+                dates, values = self._series[device_uuid][series_type]
+                lo = 0 if start is None else bisect.bisect_left(dates, start)
+                hi = len(dates) if end is None else bisect.bisect_right(dates, end)
+                date_slice, value_slice = dates[lo:hi], values[lo:hi]
+            if date_slice:
+                yield series_type, date_slice, value_slice
+
+def _reading(device_uuid, reading):
+    date_created, sensor_type, _, value = reading
+    return {'device_uuid': device_uuid,
+            'type': sensor_type,
+            'value': to_value(value),
+            'date_created': to_value(date_created)}
+
+def _first_index(values, value):
+    for index, item in enumerate(values):
+        if item == value:
+            return index
+    return None
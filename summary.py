@@ -0,0 +1,126 @@
+import functools
+import heapq
+import itertools
+from collections import Counter
+import aggregates
+import histograms
+import queries
+from models import Reading
+
+SUMMARY_COLUMNS = ['device_uuid',
+                   'number_of_readings',
+                   'min_reading_value',
+                   'max_reading_value',
+                   'mean_reading_value',
+                   'quartile_1_value',
+                   'median_reading_value',
+                   'quartile_3_value']
+#Columns the database can order by, the quartiles are only known after folding the value counts
+DATABASE_ORDER_COLUMNS = SUMMARY_COLUMNS[:5]
+
+def device_summary(device_uuid, counts):
+    """Returns the summary of a device from the number of readings per value"""
+    histogram = sorted(counts.items())
+    number_of_readings = histograms.number_of_readings(histogram)
+    quartile_1_rank, median_rank, quartile_3_rank = histograms.quartile_ranks(number_of_readings)
+    return {'device_uuid': device_uuid,
+            'number_of_readings': number_of_readings,
+            'min_reading_value': histogram[0][0],
+            'max_reading_value': histogram[-1][0],
+            'mean_reading_value': aggregates.round_mean(sum(value * count for value, count in histogram), number_of_readings),
+            'quartile_1_value': histograms.value_at_rank(histogram, quartile_1_rank),
+            'median_reading_value': histograms.value_at_rank(histogram, median_rank),
+            'quartile_3_value': histograms.value_at_rank(histogram, quartile_3_rank)}
+
+def iter_summaries(rows):
+    """Folds (device_uuid, value, number_of_readings) rows ordered by device into device summaries
+
+    Only the value counts of the current device are held in memory, which are at most
+    101 per sensor type for readings of 0..100, no matter how many devices there are.
+    """
+    current = None
+    counts = Counter()
+    for device_uuid, value, count in rows:
+        if device_uuid != current:
+            if current is not None:
+                yield device_summary(current, counts)
+            current = device_uuid
+            counts = Counter()
+        counts[value] += count
+    if current is not None:
+        yield device_summary(current, counts)
+
+def iter_ordered_summaries(session, order_by, descending, sensor_type=None, start=None, end=None,
+                           after=None, limit=None, chunk_size=1000):
+    """Yields (value, summary) tuples of the devices ordered by the summary column order_by
+
+    Ties are ordered by device_uuid. after is the (value, device_uuid) of the last device of the
+    previous page and at most limit summaries are yielded.
+
+    For the columns in DATABASE_ORDER_COLUMNS the database orders and limits the devices and
+    only the value counts of the devices of the page are read, chunk_size devices per query.
+    The quartile columns are ordered while folding the summaries of all matching devices,
+    holding only limit summaries in memory if a limit is given.
+    """
+    if order_by in DATABASE_ORDER_COLUMNS:
+        query = queries.summary_order_query(session, order_by, descending, sensor_type, start, end, after)
+        if limit is not None:
+            query = query.limit(limit)
+        devices = iter(query.all() if limit is not None and limit <= chunk_size else query.yield_per(chunk_size))
+        while True:
+            chunk = list(itertools.islice(devices, chunk_size))
+            if not chunk:
+                return
+            counts = queries.summary_value_counts_query(session, sensor_type, start, end).\
+                             filter(Reading.device_uuid.in_([device_uuid for device_uuid, _ in chunk]))
+            summaries = dict((summary['device_uuid'], summary) for summary in iter_summaries(counts))
+            for device_uuid, value in chunk:
+                #Aggregates of readings imported without rebuild-aggregates may name devices without readings
+                if device_uuid in summaries:
+                    yield value, summaries[device_uuid]
+
+    summaries = iter_summaries(queries.summary_value_counts_query(session, sensor_type, start, end).yield_per(chunk_size))
+    yield from order_summaries(summaries, order_by, descending, after, limit)
+
+@functools.total_ordering
+class _Descending:
+    """Wraps a number or string to compare in reverse order"""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return self.value > other.value
+
+def sort_key(descending):
+    """Returns the function mapping the value and device_uuid of a summary to its position in the order
+
+    Ties are ordered by device_uuid ascending in both directions.
+    """
+    if descending:
+        return lambda value, device_uuid: (_Descending(value), device_uuid)
+    return lambda value, device_uuid: (value, device_uuid)
+
+def order_summaries(summaries, order_by, descending, after=None, limit=None):
+    """Yields (value, summary) tuples of device summaries ordered by the summary column order_by
+
+    Ties are ordered by device_uuid, after and limit work like in iter_ordered_summaries.
+    Only limit summaries are held in memory if a limit is given.
+    """
+    order_key = sort_key(descending)
+    def key(summary):
+        return order_key(summary[order_by], summary['device_uuid'])
+    if after is not None:
+        after_key = order_key(*after)
+        summaries = (summary for summary in summaries if key(summary) > after_key)
+    if limit is not None:
+        summaries = heapq.nsmallest(limit, summaries, key=key)
+    else:
+        summaries = sorted(summaries, key=key)
+    for summary in summaries:
+        yield summary[order_by], summary
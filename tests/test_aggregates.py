@@ -0,0 +1,97 @@
+import json
+import sqlite3
+import unittest
+
+import aggregates
+import db
+from app import create_app
+
+class AggregatesTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.session = db.get_session(self.app.config)
+        aggregates.rebuild_aggregates(self.session)
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def post_readings(self, readings):
+        request = self.client().post('/devices/test_device/readings/batch/', data=json.dumps(readings))
+        self.assertEqual(request.status_code, 201)
+
+    def test_aggregates_follow_inserts(self):
+        #When we create readings in two requests
+        self.post_readings([{'type': 'temperature', 'value': 50, 'date_created': 10},
+                            {'type': 'temperature', 'value': 20, 'date_created': 20}])
+        self.post_readings([{'type': 'temperature', 'value': 20, 'date_created': 5},
+                            {'type': 'temperature', 'value': 80, 'date_created': 30}])
+
+        #Then the aggregates should match the readings table
+        self.assertEqual(aggregates.check_aggregates(self.session), [])
+
+        #And a tied min should resolve to the earliest reading
+        request = self.client().get('/devices/test_device/readings/min/', data=json.dumps({'type': 'temperature'}))
+        self.assertDictEqual(json.loads(request.data),
+                             {'device_uuid': 'test_device', 'type': 'temperature', 'value': 20, 'date_created': 5})
+
+        #And the max and mean should be answered from the aggregates
+        request = self.client().get('/devices/test_device/readings/max/', data=json.dumps({'type': 'temperature'}))
+        self.assertDictEqual(json.loads(request.data),
+                             {'device_uuid': 'test_device', 'type': 'temperature', 'value': 80, 'date_created': 30})
+        request = self.client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'temperature'}))
+        self.assertDictEqual(json.loads(request.data), {'value': 42.5})
+
+        #And a sensor type without readings should return an empty dict
+        request = self.client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'humidity'}))
+        self.assertDictEqual(json.loads(request.data), {})
+
+    def test_rebuild_aggregates(self):
+        #Given readings which were inserted bypassing the aggregates
+        self.post_readings([{'type': 'temperature', 'value': 50, 'date_created': 10}])
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('test_device', 'temperature', 10, 20))
+        conn.commit()
+        conn.close()
+
+        #Then the check should report the device
+        self.assertEqual(aggregates.check_aggregates(self.session), [('test_device', 'temperature')])
+
+        #And after a rebuild the aggregates should be consistent again
+        self.assertEqual(aggregates.rebuild_aggregates(self.session), 1)
+        self.assertEqual(aggregates.check_aggregates(self.session), [])
+        aggregate = aggregates.lookup(self.session, 'test_device', 'temperature')
+        self.assertEqual((aggregate.min_value, aggregate.min_date_created), (10, 20))
+
+    def test_missing_aggregates(self):
+        #Given a device whose readings were inserted bypassing the aggregates
+        self.post_readings([{'type': 'temperature', 'value': 50, 'date_created': 10}])
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('insert into readings (device_uuid,type,value,date_created) VALUES (?,?,?,?)',
+                     ('other_device', 'temperature', 10, 20))
+        conn.commit()
+        conn.close()
+
+        #Then the device should be reported as missing
+        self.assertEqual(aggregates.missing_aggregates(self.session), [('other_device', 'temperature')])
+
+        #And the check command should fail naming it
+        result = self.app.test_cli_runner().invoke(args=['check-aggregates'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('other_device temperature: aggregates missing', result.output)
+
+        #And after a rebuild the summary should include it
+        aggregates.rebuild_aggregates(self.session)
+        self.assertEqual(aggregates.missing_aggregates(self.session), [])
+        request = self.client().get('/summary/', data=json.dumps({}))
+        self.assertEqual(sorted(device['device_uuid'] for device in json.loads(request.data)), ['other_device', 'test_device'])
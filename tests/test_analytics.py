@@ -0,0 +1,94 @@
+import json
+import random
+import sqlite3
+import unittest
+from collections import Counter
+
+import analytics
+import db
+import histograms
+import ingest
+from app import create_app
+
+@unittest.skipIf(analytics.np is None, 'NumPy is not installed')
+class AnalyticsTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True, 'QUANTILE_ENGINE': 'numpy'})
+        self.session = db.get_session(self.app.config)
+        histograms.rebuild_histograms(self.session)
+
+        # Setup readings with many ties
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': 'test_device',
+                      'type': 'temperature',
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 100000)} for _ in range(3000)]
+        ingest.insert_readings(self.session, self.rows)
+        self.session.commit()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_fetch_arrays(self):
+        #When we fetch the readings of a range as arrays
+        dates, values = analytics.fetch_arrays(self.session, 'test_device', 'temperature', 1000, 50000)
+
+        #Then they should hold date_created and value of every matching reading in 16 bytes each
+        expected = [(row['date_created'], row['value']) for row in self.rows if 1000 <= row['date_created'] <= 50000]
+        self.assertCountEqual(zip(dates.tolist(), values.tolist()), expected)
+        self.assertEqual(dates.base.nbytes, 16 * len(expected))
+
+    def test_statistics(self):
+        #When we compute the statistics of a range in one pass
+        result = analytics.statistics(*analytics.fetch_arrays(self.session, 'test_device', 'temperature', 1000, 50000), percentiles=[0, 90, 100])
+
+        #Then every metric should match the readings
+        rows = [row for row in self.rows if 1000 <= row['date_created'] <= 50000]
+        values = sorted(row['value'] for row in rows)
+        ranks = histograms.quartile_ranks(len(values))
+        def earliest(value):
+            return min(row['date_created'] for row in rows if row['value'] == value)
+        counts = Counter(values)
+        mode = min(value for value, count in counts.items() if count == max(counts.values()))
+        self.assertEqual(result, {'number_of_readings': len(values),
+                                  'min': {'value': values[0], 'date_created': earliest(values[0])},
+                                  'max': {'value': values[-1], 'date_created': earliest(values[-1])},
+                                  'mean': round(sum(values) / len(values), 2),
+                                  'quartile_1': values[ranks[0] - 1],
+                                  'median': {'value': values[ranks[1] - 1], 'date_created': earliest(values[ranks[1] - 1])},
+                                  'quartile_3': values[ranks[2] - 1],
+                                  'mode': {'value': mode, 'number_of_readings': counts[mode]},
+                                  'percentiles': {0: values[0],
+                                                  90: values[histograms.percentile_rank(len(values), 90) - 1],
+                                                  100: values[-1]}})
+
+        #And a range without readings should have no statistics
+        self.assertIsNone(analytics.statistics(*analytics.fetch_arrays(self.session, 'other_uuid', 'temperature')))
+
+    def test_engines_agree(self):
+        histogram_app = create_app({'TESTING': True})
+        for metric, data in [('median', {}), ('quartiles', {'start': 500, 'end': 70000}), ('percentile', {'percentile': 75}), ('mode', {})]:
+            data = dict(data, type='temperature')
+
+            #When we request a metric from the NumPy and the histogram engine
+            numpy_request = self.client().get(f'/devices/test_device/readings/{metric}/', data=json.dumps(data))
+            histogram_request = histogram_app.test_client().get(f'/devices/test_device/readings/{metric}/', data=json.dumps(data))
+
+            #Then both should return the same result
+            self.assertEqual(numpy_request.status_code, 200)
+            self.assertEqual(json.loads(numpy_request.data), json.loads(histogram_request.data), metric)
+
+    def test_unknown_engine(self):
+        #When we configure an unknown engine
+        #Then the app should not be created
+        self.assertRaises(ValueError, create_app, {'QUANTILE_ENGINE': 'pandas'})
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import sqlite3
+import unittest
+
+import aggregates
+import db
+import histograms
+import rollups
+from app import create_app, create_asgi_app
+
+def call_asgi(asgi_app, method, path, body_chunks=()):
+    """Runs a single request through an ASGI app and returns (status, headers, body)"""
+    async def run():
+        messages = [{'type': 'http.request', 'body': chunk, 'more_body': True} for chunk in body_chunks]
+        messages.append({'type': 'http.request', 'body': b'', 'more_body': False})
+        sent = []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'http_version': '1.1', 'method': method, 'path': path, 'query_string': b'',
+                 'headers': [(b'host', b'testserver')], 'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}
+        await asgi_app(scope, receive, send)
+        return sent
+    sent = asyncio.run(run())
+    body = b''.join(message.get('body', b'') for message in sent[1:])
+    return sent[0]['status'], dict(sent[0]['headers']), body, sent
+
+def run_lifespan(asgi_app):
+    """Runs the lifespan startup and shutdown of an ASGI app and returns the sent messages"""
+    async def run():
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await asgi_app({'type': 'lifespan'}, receive, send)
+        return sent
+    return asyncio.run(run())
+
+class ASGITestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True, 'STREAM_CHUNK_SIZE': 2})
+        session = db.get_session(self.app.config)
+        aggregates.rebuild_aggregates(session)
+        rollups.rebuild_rollups(session)
+        histograms.rebuild_histograms(session)
+        db.remove_session()
+        self.asgi_app = create_asgi_app(self.app)
+
+    def tearDown(self):
+        self.asgi_app.executor.shutdown()
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_same_responses(self):
+        #When we post readings and a body split into many messages
+        for value in (10, 30, 20):
+            status, _, body, _ = call_asgi(self.asgi_app, 'POST', '/devices/test_device/readings/',
+                                           [json.dumps({'type': 'temperature', 'value': value, 'date_created': value}).encode()])
+            self.assertEqual((status, body), (201, b'success'))
+        lines = '\n'.join(json.dumps({'device_uuid': 'other_uuid', 'type': 'humidity', 'value': i, 'date_created': i}) for i in range(5))
+        status, _, body, _ = call_asgi(self.asgi_app, 'POST', '/readings/ingest/', [lines[i:i + 7].encode() for i in range(0, len(lines), 7)])
+        self.assertEqual((status, json.loads(body)), (201, {'accepted': 5, 'rejected': 0, 'errors': []}))
+
+        #Then every response should match the one of the WSGI app
+        for path, data in [('/devices/test_device/readings/mean/', {'type': 'temperature'}),
+                           ('/devices/test_device/readings/median/', {'type': 'temperature'}),
+                           ('/devices/test_device/readings/mean/', {'type': 'false'}),
+                           ('/devices/other_uuid/readings/', {}),
+                           ('/summary/', {})]:
+            status, headers, body, _ = call_asgi(self.asgi_app, 'GET', path, [json.dumps(data).encode()])
+            expected = self.app.test_client().get(path, data=json.dumps(data))
+            self.assertEqual(status, expected.status_code, path)
+            self.assertEqual(headers[b'content-type'].decode(), expected.headers['Content-Type'], path)
+            self.assertEqual(body, expected.data, path)
+
+    def test_streamed_response(self):
+        self.app.test_client().post('/readings/ingest/', data='\n'.join(
+            json.dumps({'device_uuid': 'test_device', 'type': 'humidity', 'value': i, 'date_created': i}) for i in range(6)))
+
+        #When we request the readings streamed in chunks of 2
+        status, _, body, sent = call_asgi(self.asgi_app, 'GET', '/devices/test_device/readings/')
+
+        #Then every chunk should be sent as a separate body message
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)), 6)
+        self.assertGreater(len(sent), 4)
+        self.assertFalse(sent[-1]['more_body'])
+
+    def test_slow_upload_holds_no_worker(self):
+        self.asgi_app.executor.shutdown()
+        self.app.config['ASGI_EXECUTOR_WORKERS'] = 1
+        self.asgi_app = create_asgi_app(self.app)
+        scope = {'type': 'http', 'http_version': '1.1', 'query_string': b'', 'headers': [(b'host', b'testserver')]}
+
+        async def run():
+            uploaded = asyncio.Event()
+            sent = []
+
+            async def slow_receive():
+                await uploaded.wait()
+                return {'type': 'http.request', 'body': json.dumps({'type': 'temperature', 'value': 10}).encode(), 'more_body': False}
+
+            async def receive():
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+            async def send(message):
+                sent.append(message)
+
+            #When a client uploads its body slowly to the only worker
+            upload = asyncio.ensure_future(self.asgi_app(dict(scope, method='POST', path='/devices/test_device/readings/'), slow_receive, send))
+            await asyncio.sleep(0.05)
+
+            #Then another request should still be served meanwhile
+            await asyncio.wait_for(self.asgi_app(dict(scope, method='GET', path='/devices/test_device/readings/'), receive, send), 5)
+            self.assertEqual(sent[0]['status'], 200)
+            uploaded.set()
+            await asyncio.wait_for(upload, 5)
+            return sent
+        sent = asyncio.run(run())
+
+        #And the upload should complete once its body arrived
+        self.assertEqual([message['status'] for message in sent if 'status' in message], [200, 201])
+
+    def test_body_too_large(self):
+        self.asgi_app.executor.shutdown()
+        self.app.config['ASGI_MAX_BODY_BYTES'] = 16
+        self.asgi_app = create_asgi_app(self.app)
+
+        #When we post a body larger than the maximum
+        status, _, _, _ = call_asgi(self.asgi_app, 'POST', '/devices/test_device/readings/',
+                                    [json.dumps({'type': 'temperature', 'value': 10}).encode()])
+
+        #Then we should receive a 413
+        self.assertEqual(status, 413)
+
+        #And the ingest body should still be streamed without a maximum
+        lines = '\n'.join(json.dumps({'device_uuid': 'other_uuid', 'type': 'humidity', 'value': i, 'date_created': i}) for i in range(5))
+        status, _, _, _ = call_asgi(self.asgi_app, 'POST', '/readings/ingest/', [lines.encode()])
+        self.assertEqual(status, 201)
+
+    def test_unknown_mode(self):
+        #When we configure an unknown server mode
+        #Then the app should not be created
+        self.assertRaises(ValueError, create_app, {'SERVER_MODE': 'cgi'})
+
+    def test_shutdown_flushes_ingest_queue(self):
+        #Given an app queueing readings for a long batch interval
+        self.app.config.update(INGEST_MODE='queued', INGEST_BATCH_INTERVAL=60)
+        status, _, _, _ = call_asgi(self.asgi_app, 'POST', '/devices/test_device/readings/',
+                                    [json.dumps({'type': 'temperature', 'value': 10}).encode()])
+        self.assertEqual(status, 202)
+
+        #When the server shuts the ASGI app down
+        sent = run_lifespan(self.asgi_app)
+
+        #Then the queued reading should be committed before the shutdown completes
+        self.assertEqual([message['type'] for message in sent], ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+        conn = sqlite3.connect('test_database.db')
+        self.assertEqual(conn.execute('SELECT count(*) FROM readings').fetchone()[0], 1)
+        conn.close()
@@ -0,0 +1,107 @@
+import json
+import sqlite3
+import unittest
+
+import aggregates
+import db
+from app import create_app
+from cache import ResultCache
+
+class ResultCacheTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.cache = ResultCache(2, 10, clock=lambda: self.now)
+
+    def test_lru_eviction(self):
+        #Given a full cache
+        self.cache.put('a', 'device', 0, 1)
+        self.cache.put('b', 'device', 0, 2)
+
+        #When we use the older entry and add a third one
+        self.assertEqual(self.cache.get('a', 'device'), 1)
+        self.cache.put('c', 'device', 0, 3)
+
+        #Then the least recently used entry should be evicted
+        self.assertIsNone(self.cache.get('b', 'device'))
+        self.assertEqual(self.cache.get('a', 'device'), 1)
+        self.assertEqual(self.cache.get('c', 'device'), 3)
+        self.assertEqual(self.cache.status(), {'entries': 2,
+                                               'max_entries': 2,
+                                               'hits': 3,
+                                               'misses': 1,
+                                               'evictions': 1,
+                                               'expirations': 0,
+                                               'invalidations': 0})
+
+    def test_ttl(self):
+        #When an entry is older than the TTL
+        self.cache.put('a', 'device', 0, 1)
+        self.now = 10
+
+        #Then it should be a miss
+        self.assertIsNone(self.cache.get('a', 'device'))
+        self.assertEqual(self.cache.status()['expirations'], 1)
+
+    def test_generations(self):
+        #Given cached results of two devices
+        generation = self.cache.generation('device')
+        self.cache.put('a', 'device', generation, 1)
+        self.cache.put('b', 'other_device', 0, 2)
+
+        #When the first device gets new readings
+        self.cache.bump(['device'])
+
+        #Then only its result should be stale
+        self.assertIsNone(self.cache.get('a', 'device'))
+        self.assertEqual(self.cache.get('b', 'other_device'), 2)
+        self.assertEqual(self.cache.status()['invalidations'], 1)
+
+        #And a result computed before the bump should not be cached
+        self.cache.put('a', 'device', generation, 1)
+        self.assertIsNone(self.cache.get('a', 'device'))
+
+class CachedEndpointTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True, 'RESULT_CACHE_SIZE': 16})
+        self.client = self.app.test_client
+        aggregates.rebuild_aggregates(db.get_session(self.app.config))
+        db.remove_session()
+
+    def tearDown(self):
+        db.dispose_engines()
+
+    def test_cached_mean(self):
+        self.client().post('/devices/test_device/readings/', data=json.dumps({'type': 'temperature', 'value': 10}))
+
+        #When we request the same mean twice
+        for _ in range(2):
+            request = self.client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'temperature'}))
+            self.assertEqual(json.loads(request.data), {'value': 10.0})
+
+        #Then the second request should be answered from the cache
+        request = self.client().get('/stats/cache/')
+        self.assertEqual(json.loads(request.data)['hits'], 1)
+        self.assertEqual(json.loads(request.data)['misses'], 1)
+
+        #When the device gets a new reading
+        self.client().post('/devices/test_device/readings/', data=json.dumps({'type': 'temperature', 'value': 20}))
+
+        #Then the mean should be recomputed
+        request = self.client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'temperature'}))
+        self.assertEqual(json.loads(request.data), {'value': 15.0})
+        self.assertEqual(json.loads(self.client().get('/stats/cache/').data)['invalidations'], 1)
+
+        #And invalid requests should not be cached
+        for _ in range(2):
+            request = self.client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'false'}))
+            self.assertEqual(request.status_code, 422)
+        self.assertEqual(json.loads(self.client().get('/stats/cache/').data)['entries'], 1)
@@ -0,0 +1,233 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import struct
+import tempfile
+import unittest
+from array import array
+from unittest import mock
+
+import aggregates
+import columnar
+import db
+import histograms
+import rollups
+from app import create_app
+
+class ColumnStoreTestCases(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = columnar.ColumnStore(self.root)
+
+        # Setup readings arriving in batches out of date order
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': f'device_{generator.randint(0, 3)}',
+                      'type': generator.choice(['temperature', 'humidity']),
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 10000)} for _ in range(2000)]
+        for index in range(0, len(self.rows), 100):
+            self.store.insert_many(self.rows[index:index + 100])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def matching(self, device_uuid, sensor_type, start, end):
+        return [row for row in self.rows if row['device_uuid'] == device_uuid and row['type'] == sensor_type
+                and start <= row['date_created'] <= end]
+
+    def test_range_slices(self):
+        #When we read the slices of a range
+        slices = list(self.store.slices('device_1', 'temperature', 1000, 5000))
+
+        #Then they should be views of the mapped columns holding exactly the matching readings
+        readings = [(date_created, value) for _, dates, values in slices for date_created, value in zip(dates, values)]
+        expected = [(row['date_created'], row['value']) for row in self.matching('device_1', 'temperature', 1000, 5000)]
+        self.assertCountEqual(readings, expected)
+        self.assertTrue(all(isinstance(values, memoryview) for _, _, values in slices))
+
+    def test_aggregate(self):
+        #When we aggregate a range
+        result = self.store.aggregate('device_2', 'humidity', 2000, 8000)
+
+        #Then it should match the aggregates of the readings with ties resolved to the earliest date_created
+        rows = self.matching('device_2', 'humidity', 2000, 8000)
+        self.assertEqual(result, aggregates.accumulate(rows)[('device_2', 'humidity')])
+
+        #And a range without readings should have no aggregates
+        self.assertIsNone(self.store.aggregate('device_2', 'humidity', 20000, 30000))
+        self.assertIsNone(self.store.aggregate('other_uuid', 'humidity'))
+
+    def test_histogram(self):
+        #When we read the value counts of a range
+        histogram = self.store.histogram('device_0', 'temperature', 0, 4000)
+
+        #Then they should match the readings
+        values = sorted(row['value'] for row in self.matching('device_0', 'temperature', 0, 4000))
+        self.assertEqual(histograms.number_of_readings(histogram), len(values))
+        self.assertEqual(histograms.value_at_rank(histogram, len(values) // 2), values[len(values) // 2 - 1])
+
+    def test_readings_pages(self):
+        #When we walk the readings of a device in pages of 7
+        pages = []
+        after = None
+        while True:
+            readings, after = self.store.readings_page('device_3', 7, after, 'humidity')
+            pages.extend(readings)
+            if after is None:
+                break
+
+        #Then every reading should be returned once ordered by date_created
+        dates = [reading['date_created'] for reading in pages]
+        self.assertEqual(dates, sorted(dates))
+        self.assertCountEqual([(reading['date_created'], reading['value']) for reading in pages],
+                              [(row['date_created'], row['value']) for row in self.matching('device_3', 'humidity', 0, 10000)])
+
+    def test_compaction_and_reopen(self):
+        #When a series has more runs than MAX_RUNS
+        series = self.store._get_series('device_0', 'temperature')
+
+        #Then it should have been compacted
+        self.assertLessEqual(len(series.runs), columnar.MAX_RUNS)
+
+        #And a store reopened from the files should hold the same readings
+        reopened = columnar.ColumnStore(self.root)
+        self.assertEqual(reopened.device_uuids(), ['device_0', 'device_1', 'device_2', 'device_3'])
+        for device_uuid in reopened.device_uuids():
+            self.assertEqual(reopened.histogram(device_uuid), self.store.histogram(device_uuid))
+
+    def test_append_after_torn_write(self):
+        #Given columns holding the bytes of an append torn by a crash before the runs were written
+        series = self.store._get_series('device_0', 'temperature')
+        length = len(series)
+        for name in (columnar.DATE_FILE, columnar.VALUE_FILE):
+            with open(series.column_path(name), 'ab') as column:
+                column.write(b'\xff' * 12)
+
+        #When readings are appended
+        self.store.insert_many([{'device_uuid': 'device_0', 'type': 'temperature', 'value': 42, 'date_created': 200000}])
+
+        #Then the runs should point at the appended readings
+        reopened = columnar.ColumnStore(self.root)
+        series = reopened._get_series('device_0', 'temperature')
+        self.assertEqual(len(series), length + 1)
+        self.assertEqual(os.path.getsize(series.column_path(columnar.DATE_FILE)), (length + 1) * 8)
+        dates, values, runs = series.snapshot()
+        self.assertEqual(list(columnar.range_slices(dates, values, runs, 200000))[0][1].tolist(), [42])
+
+    def test_crash_during_compaction(self):
+        #Given a series whose compaction crashes after writing the new columns, before the manifest
+        series = self.store._get_series('device_1', 'humidity')
+        expected = self.store.histogram('device_1')
+        generation = series.generation
+        with mock.patch.object(columnar.Series, '_write_manifest', side_effect=OSError('crash')):
+            with self.assertRaises(OSError):
+                series.compact()
+        self.assertTrue(os.path.exists(series.column_path(columnar.DATE_FILE, generation + 1)))
+
+        #When the store is reopened
+        reopened = columnar.ColumnStore(self.root)
+
+        #Then the old generation should still be live with the same readings
+        self.assertEqual(reopened._get_series('device_1', 'humidity').generation, generation)
+        self.assertEqual(reopened.histogram('device_1'), expected)
+
+        #And the columns of the unfinished generation should be removed
+        self.assertFalse(os.path.exists(series.column_path(columnar.DATE_FILE, generation + 1)))
+
+        #When the series is compacted after the restart
+        reopened._get_series('device_1', 'humidity').compact()
+
+        #Then only the columns of the new generation should be left
+        series = columnar.ColumnStore(self.root)._get_series('device_1', 'humidity')
+        self.assertEqual(series.generation, generation + 1)
+        self.assertEqual(sorted(os.listdir(series.path)),
+                         sorted([columnar.MANIFEST_FILE, os.path.basename(series.column_path(columnar.DATE_FILE)),
+                                 os.path.basename(series.column_path(columnar.VALUE_FILE))]))
+        self.assertEqual(columnar.ColumnStore(self.root).histogram('device_1'), expected)
+
+    def test_series_without_manifest(self):
+        #Given a series written before the manifest, with a runs file and columns of generation 0
+        path = os.path.join(self.root, columnar.encode_name('legacy_device'), columnar.encode_name('temperature'))
+        os.makedirs(path)
+        for name, items in ((columnar.DATE_FILE, [20, 10, 30]), (columnar.VALUE_FILE, [2, 1, 3])):
+            with open(os.path.join(path, name), 'wb') as column:
+                column.write(array('d', items).tobytes())
+        with open(os.path.join(path, columnar.RUNS_FILE), 'wb') as runs:
+            runs.write(struct.pack('<ddQQ', 20, 20, 0, 1) + struct.pack('<ddQQ', 10, 30, 1, 2))
+
+        #When readings are appended and the series is compacted
+        store = columnar.ColumnStore(self.root)
+        store.insert_many([{'device_uuid': 'legacy_device', 'type': 'temperature', 'value': 4, 'date_created': 40}])
+        store._get_series('legacy_device', 'temperature').compact()
+
+        #Then every reading should be kept in date order
+        dates, values, runs = columnar.ColumnStore(self.root)._get_series('legacy_device', 'temperature').snapshot()
+        self.assertEqual((dates.tolist(), values.tolist(), runs), ([10, 20, 30, 40], [1, 2, 3, 4], [(10, 40, 0, 4)]))
+
+class ColumnarEndpointTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.root = tempfile.mkdtemp()
+        self.sqlite_app = create_app({'TESTING': True})
+        self.columnar_app = create_app({'TESTING': True, 'STORAGE_ENGINE': 'columnar', 'COLUMNAR_PATH': self.root})
+        session = db.get_session(self.sqlite_app.config)
+        aggregates.rebuild_aggregates(session)
+        rollups.rebuild_rollups(session)
+        histograms.rebuild_histograms(session)
+        db.remove_session()
+
+        # Setup the same readings in both storage engines
+        generator = random.Random(7)
+        lines = [json.dumps({'device_uuid': f'device_{generator.randint(0, 4)}',
+                             'type': generator.choice(['temperature', 'humidity']),
+                             'value': generator.randint(0, 100),
+                             'date_created': generator.randint(0, 100000)}) for _ in range(1500)]
+        for app in (self.sqlite_app, self.columnar_app):
+            request = app.test_client().post('/readings/ingest/', data='\n'.join(lines))
+            self.assertEqual(request.status_code, 201)
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+        shutil.rmtree(self.root)
+
+    def test_engines_agree(self):
+        requests = [('min', {}), ('max', {'start': 100, 'end': 90000}), ('mean', {'start': 5000}),
+                    ('median', {}), ('median', {'start': 500, 'end': 70000}), ('quartiles', {'start': 500, 'end': 70000}),
+                    ('percentile', {'percentile': 90}), ('mode', {'end': 50000})]
+        for metric, data in requests:
+            data = dict(data, type='temperature')
+
+            #When we request a metric from both storage engines
+            sqlite_request = self.sqlite_app.test_client().get(f'/devices/device_2/readings/{metric}/', data=json.dumps(data))
+            columnar_request = self.columnar_app.test_client().get(f'/devices/device_2/readings/{metric}/', data=json.dumps(data))
+
+            #Then both should return the same result
+            self.assertEqual(columnar_request.status_code, 200)
+            self.assertEqual(json.loads(columnar_request.data), json.loads(sqlite_request.data), metric)
+
+    def test_readings_and_summary(self):
+        for url, data in [('/devices/device_1/readings/', {'start': 1000, 'end': 60000}),
+                          ('/summary/', {'type': 'humidity', 'order_by': 'median_reading_value'})]:
+            #When we request readings and summary from both storage engines
+            sqlite_request = self.sqlite_app.test_client().get(url, data=json.dumps(data))
+            columnar_request = self.columnar_app.test_client().get(url, data=json.dumps(data))
+
+            #Then both should return the same readings
+            self.assertEqual(columnar_request.status_code, 200)
+            self.assertCountEqual(json.loads(columnar_request.data), json.loads(sqlite_request.data), url)
+
+    def test_unknown_engine(self):
+        #When we configure an unknown storage engine
+        #Then the app should not be created
+        self.assertRaises(ValueError, create_app, {'STORAGE_ENGINE': 'parquet'})
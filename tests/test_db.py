@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import unittest
+
+import aggregates
+import db
+from app import create_app
+
+class DatabasePoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.close()
+
+        self.app = create_app({'TESTING': True,
+                               'DB_POOL_SIZE': 3,
+                               'DB_MAX_OVERFLOW': 2})
+        db.dispose_engines()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        db.dispose_engines()
+
+    def test_engine_is_shared(self):
+        #When we request the engine twice for the same config
+        #Then we should receive the same engine
+        self.assertIs(db.get_engine(self.app.config), db.get_engine(self.app.config))
+
+        #And the pool should be configured as requested
+        self.assertEqual(db.get_engine(self.app.config).pool.size(), 3)
+
+    def test_session_is_returned_at_teardown(self):
+        #When we make a request which uses the database
+        request = self.client().get('/devices/test_device/readings/')
+        self.assertEqual(request.status_code, 200)
+
+        #Then no connection should be left checked out
+        self.assertEqual(db.get_engine(self.app.config).pool.checkedout(), 0)
+
+    def test_pool_stats(self):
+        #When we request the pool statistics
+        self.client().get('/devices/test_device/readings/')
+        request = self.client().get('/stats/pool/')
+
+        #We should receive a 200
+        self.assertEqual(request.status_code, 200)
+
+        #And the configured pool limits
+        stats = json.loads(request.data)
+        self.assertEqual(stats['pool_size'], 3)
+        self.assertEqual(stats['max_overflow'], 2)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['checked_in'], 1)
+
+    def test_storage_profiles(self):
+        #When we use the default profile
+        with db.get_engine(self.app.config).connect() as connection:
+            #Then the database should use WAL and fsync every commit
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 2)
+        db.dispose_engines()
+
+        #When we use the throughput profile with an overridden pragma
+        self.app.config['SQLITE_PROFILE'] = 'throughput'
+        self.app.config['SQLITE_PRAGMAS'] = {'busy_timeout': 1000}
+        with db.get_engine(self.app.config).connect() as connection:
+            #Then only the WAL should be synced at checkpoints
+            self.assertEqual(connection.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+            self.assertEqual(connection.exec_driver_sql('PRAGMA mmap_size').scalar(), 268435456)
+            #And the overridden pragma should be applied
+            self.assertEqual(connection.exec_driver_sql('PRAGMA busy_timeout').scalar(), 1000)
+        db.dispose_engines()
+
+        #When we use an unknown profile
+        self.app.config['SQLITE_PROFILE'] = 'unknown'
+
+        #Then no engine should be created
+        with self.assertRaises(ValueError):
+            db.get_engine(self.app.config)
+
+class BootstrapTestCases(unittest.TestCase):
+
+    def setUp(self):
+        #A database created with the baseline schema, before any derived table existed
+        conn = sqlite3.connect('test_database.db')
+        for table in ('readings', 'reading_aggregates', 'reading_rollups', 'reading_histograms', 'reading_sketches'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute('CREATE TABLE readings (id INTEGER PRIMARY KEY AUTOINCREMENT, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.executemany('INSERT INTO readings (device_uuid, type, value, date_created) VALUES (?, ?, ?, ?)',
+                         [('device_a', 'temperature', 20, 100), ('device_a', 'temperature', 40, 200),
+                          ('device_b', 'humidity', 60, 4000)])
+        conn.commit()
+        conn.close()
+        db.dispose_engines()
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_derived_tables_are_backfilled(self):
+        #When the app starts on the database
+        app = create_app({'TESTING': True})
+        session = db.get_session(app.config)
+
+        #Then the aggregates should match the readings
+        self.assertEqual(aggregates.check_aggregates(session), [])
+
+        #And the rollups and histograms should hold the readings
+        conn = sqlite3.connect('test_database.db')
+        for table in ('reading_rollups', 'reading_histograms'):
+            self.assertGreater(conn.execute(f'SELECT count(*) FROM {table}').fetchone()[0], 0, table)
+        conn.close()
+
+        #And the summary should include every device
+        request = app.test_client().get('/summary/', data=json.dumps({}))
+        self.assertEqual(request.status_code, 200)
+        self.assertEqual(sorted(device['device_uuid'] for device in json.loads(request.data)), ['device_a', 'device_b'])
+
+    def test_backfill_runs_once(self):
+        #Given a started app
+        app = create_app({'TESTING': True})
+        engine = db.get_engine(app.config)
+
+        #When the schema is bootstrapped again
+        #Then no table should be backfilled a second time
+        self.assertEqual(db.bootstrap_schema(engine), [])
@@ -0,0 +1,40 @@
+import random
+import unittest
+
+import downsampling
+import rollups
+
+class DownsamplingTestCases(unittest.TestCase):
+
+    def test_bucket_width(self):
+        #When we cover a week with 1000 points
+        width = downsampling.bucket_width(0, 7 * rollups.DAY, 1000)
+
+        #Then the width should be a whole number of minutes giving about 1000 buckets
+        self.assertEqual(width % rollups.MINUTE, 0)
+        self.assertTrue(900 <= 7 * rollups.DAY / width <= 1000)
+
+        #When we cover a year or ten minutes
+        #Then the width should be whole days or stay fractional
+        self.assertEqual(downsampling.bucket_width(0, 365 * rollups.DAY, 100), 4 * rollups.DAY)
+        self.assertEqual(downsampling.bucket_width(0, 600, 1000), 0.6)
+        self.assertEqual(downsampling.bucket_width(5, 5, 1000), 1)
+
+    def test_lttb(self):
+        generator = random.Random(5)
+        readings = [(date_created, generator.randint(0, 100)) for date_created in range(10000)]
+        readings[4321] = (4321, 1000)
+
+        #When we select 100 of the readings
+        result = downsampling.lttb(readings, 100)
+
+        #Then the first, the last and the peak reading should be kept in date order
+        self.assertEqual(len(result), 100)
+        self.assertEqual(result[0], readings[0])
+        self.assertEqual(result[-1], readings[-1])
+        self.assertIn((4321, 1000), result)
+        self.assertEqual(result, sorted(result))
+
+        #When we select more readings than there are
+        #Then all of them should be returned
+        self.assertEqual(downsampling.lttb(readings[:50], 100), readings[:50])
@@ -0,0 +1,152 @@
+import json
+import random
+import sqlite3
+import unittest
+from collections import Counter
+
+import db
+import histograms
+import ingest
+import rollups
+from app import create_app, normalize_quartiles
+
+class QuantileRankTestCases(unittest.TestCase):
+
+    def test_quartile_ranks(self):
+        conn = sqlite3.connect(':memory:')
+        conn.execute('CREATE TABLE readings (value INTEGER)')
+        for n in range(1, 41):
+            conn.execute('INSERT INTO readings (value) VALUES (?)', (n,))
+
+            #When we compute the quartile ranks of n readings with the values 1..n
+            ranks = histograms.quartile_ranks(n)
+
+            #Then they should select the values ntile(4) with normalize_quartiles selects
+            rows = conn.execute('SELECT quartiles, max(value) FROM (SELECT value, ntile(4) OVER (ORDER BY value) AS quartiles FROM readings) GROUP BY quartiles').fetchall()
+            quartiles = normalize_quartiles(rows)
+            self.assertEqual(ranks, (quartiles[0][1], quartiles[1][1], quartiles[2][1]), n)
+        conn.close()
+
+    def test_value_at_rank(self):
+        histogram = [(10, 2), (20, 1), (30, 3)]
+
+        #When we look up the ranks of a histogram
+        #Then every rank should be answered from the cumulative counts
+        self.assertEqual([histograms.value_at_rank(histogram, rank) for rank in range(1, 7)], [10, 10, 20, 30, 30, 30])
+        self.assertRaises(ValueError, histograms.value_at_rank, histogram, 7)
+
+        #And the nearest rank percentiles should follow
+        self.assertEqual(histograms.percentile_rank(6, 0), 1)
+        self.assertEqual(histograms.percentile_rank(6, 50), 3)
+        self.assertEqual(histograms.percentile_rank(6, 100), 6)
+
+        #And the mode should be the smallest of the most frequent values
+        self.assertEqual(histograms.mode(histogram), (30, 3))
+        self.assertEqual(histograms.mode([(10, 2), (20, 2)]), (10, 2))
+
+class HistogramQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.session = db.get_session(self.app.config)
+        histograms.rebuild_histograms(self.session)
+
+        # Setup readings spread over three days
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': 'test_device',
+                      'type': 'temperature',
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 3 * rollups.DAY)} for _ in range(2000)]
+        ingest.insert_readings(self.session, self.rows)
+        self.session.commit()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_range_histogram(self):
+        generator = random.Random(7)
+        for _ in range(50):
+            #When we query the histogram of a random range
+            start = generator.randint(0, 3 * rollups.DAY)
+            end = generator.randint(start, 3 * rollups.DAY)
+            result = histograms.range_histogram(self.session, 'test_device', 'temperature', start, end)
+
+            #Then it should equal the value counts of the raw readings
+            expected = Counter(row['value'] for row in self.rows if start <= row['date_created'] <= end)
+            self.assertEqual(result, sorted(expected.items()), (start, end))
+
+    def test_rebuild_histograms(self):
+        #When we rebuild the histograms
+        self.assertEqual(histograms.rebuild_histograms(self.session), 2000)
+
+        #Then open ranges should still equal the value counts of the raw readings
+        result = histograms.range_histogram(self.session, 'test_device', 'temperature', start=rollups.DAY)
+        expected = Counter(row['value'] for row in self.rows if row['date_created'] >= rollups.DAY)
+        self.assertEqual(result, sorted(expected.items()))
+
+        #And a device without readings should have an empty histogram
+        self.assertEqual(histograms.range_histogram(self.session, 'other_uuid', 'temperature', end=rollups.DAY), [])
+
+    def test_quantile_endpoints(self):
+        start = rollups.DAY // 2
+        end = 2 * rollups.DAY + 77
+        rows = sorted((row['value'], row['date_created']) for row in self.rows if start <= row['date_created'] <= end)
+        ranks = histograms.quartile_ranks(len(rows))
+
+        #When we request the median of a range
+        request = self.client().get('/devices/test_device/readings/median/',
+                                    data=json.dumps({'type': 'temperature', 'start': start, 'end': end}))
+
+        #Then we should receive the value of the median rank and its earliest date_created
+        median = rows[ranks[1] - 1][0]
+        self.assertDictEqual(json.loads(request.data),
+                             {'device_uuid': 'test_device',
+                              'type': 'temperature',
+                              'value': median,
+                              'date_created': min(date_created for value, date_created in rows if value == median)})
+
+        #When we request the quartiles of the range
+        request = self.client().get('/devices/test_device/readings/quartiles/',
+                                    data=json.dumps({'type': 'temperature', 'start': start, 'end': end}))
+
+        #Then we should receive the values of the quartile ranks
+        self.assertDictEqual(json.loads(request.data), {'quartile_1': rows[ranks[0] - 1][0],
+                                                        'quartile_3': rows[ranks[2] - 1][0]})
+
+        #When we request the 90th percentile of the range
+        request = self.client().get('/devices/test_device/readings/percentile/',
+                                    data=json.dumps({'type': 'temperature', 'percentile': 90, 'start': start, 'end': end}))
+
+        #Then we should receive the value of the nearest rank
+        self.assertDictEqual(json.loads(request.data), {'value': rows[histograms.percentile_rank(len(rows), 90) - 1][0]})
+
+        #When we request a percentile out of range
+        request = self.client().get('/devices/test_device/readings/percentile/',
+                                    data=json.dumps({'type': 'temperature', 'percentile': 101}))
+
+        #We should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+        #When we request the mode of the range
+        request = self.client().get('/devices/test_device/readings/mode/',
+                                    data=json.dumps({'type': 'temperature', 'start': start, 'end': end}))
+
+        #Then we should receive the most frequent value
+        counts = Counter(value for value, _ in rows)
+        value, count = max(counts.items(), key=lambda item: (item[1], -item[0]))
+        self.assertDictEqual(json.loads(request.data), {'value': value, 'number_of_readings': count})
+
+        #When we request the mode of a device without readings
+        request = self.client().get('/devices/other_uuid/readings/mode/', data=json.dumps({'type': 'temperature'}))
+
+        #Then we should receive an empty result
+        self.assertDictEqual(json.loads(request.data), {})
@@ -0,0 +1,152 @@
+import io
+import json
+import os
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import textwrap
+import unittest
+from unittest import mock
+
+import db
+import ingest
+import storage
+from app import create_app, serve
+
+class NdjsonParserTestCases(unittest.TestCase):
+
+    def test_iter_ndjson(self):
+        #Given a stream with a valid line, a blank line and an invalid line
+        stream = io.BytesIO(b'{"value": 1}\n\nNo data\n{"value": 2}')
+
+        #When we parse the stream
+        result = list(ingest.iter_ndjson(stream, 1024))
+
+        #Then blank lines should be skipped and the last line parsed without newline
+        self.assertEqual(result, [(1, {'value': 1}, None),
+                                  (3, None, 'Line contains no valid JSON'),
+                                  (4, {'value': 2}, None)])
+
+    def test_iter_ndjson_oversized_line(self):
+        #Given a stream with a line exceeding the maximum line length
+        stream = io.BytesIO(b'{"value": 1}\n' + b'x' * 100 + b'\n{"value": 2}\n')
+
+        #When we parse the stream
+        result = list(ingest.iter_ndjson(stream, 16))
+
+        #Then the oversized line should be rejected and the next line parsed
+        self.assertEqual(result, [(1, {'value': 1}, None),
+                                  (2, None, 'Line exceeds 16 bytes'),
+                                  (3, {'value': 2}, None)])
+
+class IngestQueueTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.config = {'TESTING': True}
+
+    def tearDown(self):
+        db.dispose_engines()
+
+    def count_readings(self):
+        conn = sqlite3.connect('test_database.db')
+        count = conn.execute('select count(*) from readings').fetchone()[0]
+        conn.close()
+        return count
+
+    def test_group_commit(self):
+        #Given a queue with a long batch interval
+        ingest_queue = ingest.IngestQueue(storage.SQLiteStorage(self.config).insert_many, 100, 10, 5, 1)
+
+        #When we submit more rows then fit into a single batch
+        rows = [{'device_uuid': 'test_device', 'type': 'temperature', 'value': i, 'date_created': i} for i in range(5)]
+        futures = [ingest_queue.submit(rows) for _ in range(3)]
+
+        #Then the rows should be committed in batches of at least batch_rows
+        futures[1].result(timeout=5)
+        self.assertEqual(ingest_queue.status()['batches'], 1)
+
+        #And closing the queue should flush the remaining rows
+        ingest_queue.close()
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertEqual(ingest_queue.status(), {'queued': 0, 'batches': 2, 'rows': 15})
+        self.assertEqual(self.count_readings(), 15)
+
+        #And no rows should be accepted after close
+        with self.assertRaises(ingest.IngestQueueFull):
+            ingest_queue.submit(rows)
+
+    def test_queued_post(self):
+        #Given an app in queued mode which waits for the commit
+        app = create_app(dict(self.config, INGEST_MODE='queued', INGEST_DURABILITY='commit'))
+
+        #When we make a request to create a reading
+        request = app.test_client().post('/devices/test_device/readings/',
+                                         data=json.dumps({'type': 'temperature', 'value': 100}))
+
+        #Then we should receive a 201 and the reading should be committed
+        self.assertEqual(request.status_code, 201)
+        self.assertEqual(self.count_readings(), 1)
+
+        #When we switch to asynchronous durability
+        app.config['INGEST_DURABILITY'] = 'async'
+        request = app.test_client().post('/devices/test_device/readings/batch/',
+                                         data=json.dumps([{'type': 'temperature', 'value': 10}]))
+
+        #Then we should receive a 202 and the reading should be committed after a flush
+        self.assertEqual(request.status_code, 202)
+        app.extensions['ingest_queue'].close()
+        self.assertEqual(self.count_readings(), 2)
+
+    def test_serve_flushes_on_sigterm(self):
+        #Given an app queueing readings for a long batch interval
+        app = create_app(dict(self.config, INGEST_MODE='queued', INGEST_BATCH_INTERVAL=60))
+        request = app.test_client().post('/devices/test_device/readings/',
+                                         data=json.dumps({'type': 'temperature', 'value': 100}))
+        self.assertEqual(request.status_code, 202)
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.getsignal(signal.SIGTERM))
+
+        #When the server is stopped by SIGTERM
+        with mock.patch.object(app, 'run', side_effect=lambda host, port: signal.raise_signal(signal.SIGTERM)):
+            with self.assertRaises(SystemExit):
+                serve(app)
+
+        #Then the queued reading should be committed
+        self.assertEqual(self.count_readings(), 1)
+
+    def test_flush_at_exit(self):
+        #Given a process queueing batches of many devices for the sharded storage engine
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        script = textwrap.dedent(f"""
+            import json, sys
+            sys.path.insert(0, {os.getcwd()!r})
+            from app import create_app
+            app = create_app({{'TESTING': True, 'STORAGE_ENGINE': 'sharded', 'SHARD_COUNT': 3,
+                               'TEST_SHARD_DATABASE_URI': 'sqlite:///' + {root!r} + '/shard_{{shard}}.db',
+                               'INGEST_MODE': 'queued', 'INGEST_BATCH_INTERVAL': 60}})
+            for batch in range(6):
+                readings = [{{'type': 'temperature', 'value': value}} for value in range(5)]
+                request = app.test_client().post(f'/devices/device_{{batch}}/readings/batch/', data=json.dumps(readings))
+                assert request.status_code == 202
+        """)
+
+        #When the process exits before the batch interval is over
+        subprocess.run([sys.executable, '-c', script], cwd=root, check=True, timeout=60)
+
+        #Then every accepted reading should be committed to its shard
+        count = 0
+        for name in os.listdir(root):
+            conn = sqlite3.connect(os.path.join(root, name))
+            count += conn.execute('SELECT count(*) FROM readings').fetchone()[0]
+            conn.close()
+        self.assertEqual(count, 30)
@@ -0,0 +1,114 @@
+import json
+import os
+import random
+import runpy
+import sqlite3
+import unittest
+
+import db
+import parallel
+from app import create_app
+
+class PartitionTestCases(unittest.TestCase):
+
+    def test_device_partitions(self):
+        #When we split ten devices into three ranges
+        partitions = parallel.device_partitions([f'device_{i}' for i in range(10)], 3)
+
+        #Then the ranges should be adjacent and open at both ends
+        self.assertEqual(partitions, [(None, 'device_3'), ('device_3', 'device_6'), ('device_6', None)])
+
+        #When there are fewer devices than workers or none at all
+        #Then there should be a range per device or a single open one
+        self.assertEqual(parallel.device_partitions(['a', 'b'], 4), [(None, 'b'), ('b', None)])
+        self.assertEqual(parallel.device_partitions([], 4), [(None, None)])
+
+    def test_time_partitions(self):
+        #When we split a range into four
+        #Then only the last range should include its end
+        self.assertEqual(parallel.time_partitions(0, 100, 4), [(0, 25, False), (25, 50, False), (50, 75, False), (75, 100, True)])
+        self.assertEqual(parallel.time_partitions(5, 5, 2), [(5, 5, False), (5, 5, True)])
+
+class AnalyticPoolTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        for table in ('readings', 'reading_aggregates', 'reading_rollups', 'reading_histograms', 'reading_sketches'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.pool_app = create_app({'TESTING': True, 'ANALYTIC_WORKERS': 2})
+
+        # Setup readings of many devices
+        generator = random.Random(17)
+        lines = [json.dumps({'device_uuid': f'device_{generator.randint(0, 30)}',
+                             'type': generator.choice(['temperature', 'humidity']),
+                             'value': generator.randint(0, 100),
+                             'date_created': generator.randint(0, 100000)}) for _ in range(3000)]
+        request = self.app.test_client().post('/readings/ingest/', data='\n'.join(lines))
+        self.assertEqual(request.status_code, 201)
+
+    def tearDown(self):
+        self.pool_app.extensions['storage'].analytic_pool.shutdown()
+        db.remove_session()
+        db.dispose_engines()
+
+    def get(self, app, path, data):
+        response = app.test_client().get(path, data=json.dumps(data))
+        result = response.status_code, json.loads(response.data)
+        response.close()
+        return result
+
+    def test_summary(self):
+        for data in [{}, {'type': 'humidity', 'start': 1000, 'end': 70000},
+                     {'order_by': 'median_reading_value', 'order': 'asc', 'limit': 7},
+                     {'order_by': 'device_uuid', 'top_n': 5}]:
+            #When we request the summary with and without the process pool
+            #Then the worker processes should return the same summaries
+            self.assertEqual(self.get(self.pool_app, '/summary/', data), self.get(self.app, '/summary/', data), data)
+
+    def test_summary_pages(self):
+        #When we walk the summary ordered by a quartile in pages of 4 devices with and without the process pool
+        for app in (self.pool_app, self.app):
+            pages = []
+            data = {'order_by': 'quartile_3_value', 'order': 'asc', 'limit': 4}
+            while True:
+                _, page = self.get(app, '/summary/', data)
+                pages.append(page['summaries'])
+                if page['next_cursor'] is None:
+                    break
+                data['cursor'] = page['next_cursor']
+            if app is self.pool_app:
+                pool_pages = pages
+
+        #Then the merged pages of the workers should be the same
+        self.assertEqual(pool_pages, pages)
+        self.assertGreater(len(pages), 2)
+
+    def test_quantiles(self):
+        #Given the numpy quantile engine, whose value scans run in the process pool
+        self.pool_app.extensions['storage'].quantile_engine = 'numpy'
+        requests = [('median', {}), ('quartiles', {'start': 500, 'end': 70000}), ('percentile', {'percentile': 90}),
+                    ('mode', {'end': 50000}), ('stats', {'start': 2000})]
+        for metric, data in requests:
+            data = dict(data, type='temperature')
+
+            #When we request the quantiles with and without the process pool
+            #Then the merged value counts of the time ranges should give the same results
+            path = f'/devices/device_7/readings/{metric}/'
+            self.assertEqual(self.get(self.pool_app, path, data), self.get(self.app, path, data), metric)
+
+class SpawnedWorkerTestCases(unittest.TestCase):
+
+    def test_app_module_as_worker_main(self):
+        #When a spawned worker runs app.py as its main module
+        module = runpy.run_path(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app.py'),
+                                run_name='__mp_main__')
+
+        #Then it should not build an app
+        self.assertNotIn('app', module)
+        self.assertNotIn('asgi_app', module)
+        self.assertIn('create_app', module)
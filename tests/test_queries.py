@@ -0,0 +1,42 @@
+import sqlite3
+import unittest
+
+import db
+import queries
+from app import create_app
+
+class QueryPlanTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Setup a readings table created before the index existed
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_bootstrap_creates_index(self):
+        #When the engine is created the schema bootstrap runs
+        db.get_engine(self.app.config)
+
+        #Then the composite index should exist on the existing table
+        conn = sqlite3.connect('test_database.db')
+        indexes = [row[1] for row in conn.execute('PRAGMA index_list(readings)')]
+        conn.close()
+        self.assertIn(queries.READINGS_INDEX, indexes)
+
+    def test_endpoint_queries_use_index(self):
+        #When we explain every endpoint query
+        session = db.get_session(self.app.config)
+        plans = queries.check_query_plans(session)
+
+        #Then every query should be answered from the index
+        for name, (uses_index, plan) in plans.items():
+            self.assertTrue(uses_index, f'{name}: {plan}')
@@ -0,0 +1,99 @@
+import random
+import sqlite3
+import unittest
+
+import aggregates
+import db
+import ingest
+import rollups
+from app import create_app
+
+class RollupPlannerTestCases(unittest.TestCase):
+
+    def test_plan_range(self):
+        #When we plan a range smaller than a minute
+        #Then it should be read from the readings table only
+        self.assertEqual(rollups.plan_range(10, 20), ([], [(10, 20, True)]))
+
+        #When we plan a range over two days, three hours and two minutes
+        buckets, edges = rollups.plan_range(30, 2 * rollups.DAY + 3 * rollups.HOUR + 125)
+
+        #Then the middle should be covered by whole day, hour and minute buckets
+        self.assertEqual(buckets, [(rollups.DAY, rollups.DAY, rollups.DAY),
+                                   (rollups.HOUR, rollups.HOUR, rollups.DAY - rollups.HOUR),
+                                   (rollups.MINUTE, rollups.MINUTE, rollups.HOUR - rollups.MINUTE),
+                                   (rollups.HOUR, 2 * rollups.DAY, 2 * rollups.DAY + 2 * rollups.HOUR),
+                                   (rollups.MINUTE, 2 * rollups.DAY + 3 * rollups.HOUR, 2 * rollups.DAY + 3 * rollups.HOUR + rollups.MINUTE)])
+
+        #And only the ragged edges should be read from the readings table
+        self.assertEqual(edges, [(30, 60, False),
+                                 (2 * rollups.DAY + 3 * rollups.HOUR + 120, 2 * rollups.DAY + 3 * rollups.HOUR + 125, True)])
+
+class RollupQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.session = db.get_session(self.app.config)
+        rollups.rebuild_rollups(self.session)
+
+        # Setup readings spread over three days
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': 'test_device',
+                      'type': 'temperature',
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 3 * rollups.DAY)} for _ in range(2000)]
+        ingest.insert_readings(self.session, self.rows)
+        self.session.commit()
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_range_aggregates(self):
+        generator = random.Random(7)
+        for _ in range(50):
+            #When we query the aggregates of a random range
+            start = generator.randint(0, 3 * rollups.DAY)
+            end = generator.randint(start, 3 * rollups.DAY)
+            result = rollups.range_aggregates(self.session, 'test_device', 'temperature', start, end)
+
+            #Then they should equal the aggregates of the raw readings
+            expected = aggregates.accumulate(row for row in self.rows if start <= row['date_created'] <= end)
+            self.assertEqual(result, expected.get(('test_device', 'temperature')), (start, end))
+
+    def test_range_buckets(self):
+        generator = random.Random(11)
+        for width in (rollups.MINUTE, 90, 2 * rollups.HOUR, rollups.DAY, 0.5):
+            for _ in range(10):
+                #When we query the buckets of a random range
+                start = generator.randint(0, 3 * rollups.DAY)
+                end = generator.randint(start, 3 * rollups.DAY)
+                result = rollups.range_buckets(self.session, 'test_device', 'temperature', width, start, end)
+
+                #Then they should equal the aggregates of the raw readings per bucket
+                expected = aggregates.accumulate((row for row in self.rows if start <= row['date_created'] <= end),
+                                                 lambda row: rollups.bucket_start(row['date_created'], width))
+                self.assertEqual(result, [(key, group[0], group[1], group[2], group[4]) for key, group in sorted(expected.items())],
+                                 (width, start, end))
+
+        #And a device without readings should have no buckets
+        self.assertEqual(rollups.range_buckets(self.session, 'other_uuid', 'temperature', rollups.HOUR), [])
+
+    def test_rebuild_rollups(self):
+        #When we rebuild the rollups
+        self.assertEqual(rollups.rebuild_rollups(self.session), 2000)
+
+        #Then open ranges should still equal the aggregates of the raw readings
+        result = rollups.range_aggregates(self.session, 'test_device', 'temperature', start=rollups.DAY)
+        expected = aggregates.accumulate(row for row in self.rows if row['date_created'] >= rollups.DAY)
+        self.assertEqual(result, expected[('test_device', 'temperature')])
+
+        #And a device without readings should have no aggregates
+        self.assertIsNone(rollups.range_aggregates(self.session, 'other_uuid', 'temperature', end=rollups.DAY))
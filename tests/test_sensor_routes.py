@@ -4,6 +4,10 @@ import sqlite3
 import time
 import unittest
 
+import aggregates
+import db
+import histograms
+import rollups
 from app import app
 
 class SensorRoutesTestCases(unittest.TestCase):
@@ -39,9 +43,16 @@ class SensorRoutesTestCases(unittest.TestCase):
                     (6, self.device_uuid, 'humidity', 23, 50))
 
         conn.commit()
+        conn.close()
 
         app.config['TESTING'] = True
 
+        # The readings are inserted directly, so the aggregates, rollups and histograms have to be rebuilt
+        aggregates.rebuild_aggregates(db.get_session(app.config))
+        rollups.rebuild_rollups(db.get_session(app.config))
+        histograms.rebuild_histograms(db.get_session(app.config))
+        db.remove_session()
+
         self.client = app.test_client
 
     def test_device_readings_get(self):
@@ -66,6 +77,76 @@ class SensorRoutesTestCases(unittest.TestCase):
         # And the response data should have six sensor readings
         self.assertEqual(len(json.loads(request.data)), 6)
 
+    def test_device_readings_get_streamed(self):
+        # Given a chunk size smaller than the number of readings
+        app.config['STREAM_CHUNK_SIZE'] = 4
+        try:
+            # When we make a request for the readings of a device
+            request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                        data=json.dumps({'type': 'temperature'}))
+        finally:
+            app.config['STREAM_CHUNK_SIZE'] = 1000
+
+        # Then we should receive a 200 with a streamed response
+        self.assertEqual(request.status_code, 200)
+        self.assertTrue(request.is_streamed)
+
+        # And the response should contain all readings
+        self.assertEqual(sorted(json.loads(request.data), key=lambda reading: reading['date_created']),
+                         [{'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 22, 'date_created': 5},
+                          {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 50, 'date_created': 10},
+                          {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 100, 'date_created': 20},
+                          {'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 10, 'date_created': 25}])
+
+    def test_device_readings_get_paginated(self):
+        # Given a device UUID
+        # When we make a request for the first page of readings
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    data=json.dumps({'limit': 4}))
+
+        # Then we should receive a 200
+        self.assertEqual(request.status_code, 200)
+
+        # And the four oldest readings with a cursor to the next page
+        page = json.loads(request.data)
+        self.assertEqual([reading['date_created'] for reading in page['readings']], [5, 10, 20, 25])
+        self.assertIsNotNone(page['next_cursor'])
+
+        # When we make a request for the next page
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    data=json.dumps({'limit': 4, 'cursor': page['next_cursor']}))
+
+        # Then we should receive the remaining readings and no further cursor
+        self.assertEqual(request.status_code, 200)
+        page = json.loads(request.data)
+        self.assertEqual(page['readings'],
+                         [{'device_uuid': self.device_uuid, 'type': 'humidity', 'value': 42, 'date_created': 40},
+                          {'device_uuid': self.device_uuid, 'type': 'humidity', 'value': 23, 'date_created': 50}])
+        self.assertIsNone(page['next_cursor'])
+
+        # When we make a request for a page of temperature readings
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    data=json.dumps({'limit': 4, 'type': 'temperature', 'start': 10}))
+
+        # Then we should receive only the matching readings
+        page = json.loads(request.data)
+        self.assertEqual([reading['value'] for reading in page['readings']], [50, 100, 10])
+        self.assertIsNone(page['next_cursor'])
+
+        #If we make a request with an invalid cursor
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    data=json.dumps({'cursor': 'No cursor'}))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+        #If we make a request with an invalid limit
+        request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
+                                    data=json.dumps({'limit': 0}))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
     def test_device_readings_post(self):
         # Given a device UUID
         # When we make a request with the given UUID to create a reading
@@ -139,6 +220,107 @@ class SensorRoutesTestCases(unittest.TestCase):
         #Then we should receive a 422
         self.assertEqual(request.status_code, 422)
 
+    def test_device_readings_batch_post(self):
+        # Given a device UUID
+        # When we make a request with the given UUID to create several readings
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data=
+            json.dumps([
+                {'type': 'temperature', 'value': 30, 'date_created': 60},
+                {'type': 'humidity', 'value': 40},
+                {'type': 'temperature', 'value': 101},
+                {'type': 'false', 'value': 10},
+            ]))
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And the invalid readings should be reported by their index
+        response = json.loads(request.data)
+        self.assertEqual(response['accepted'], 2)
+        self.assertEqual(response['rejected'], 2)
+        self.assertEqual([error['index'] for error in response['errors']], [2, 3])
+
+        # And when we check for readings in the db
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select value, date_created from readings where device_uuid="{}" and type="temperature" and value=30'.format(self.device_uuid))
+        rows = cur.fetchall()
+
+        # We should find the reading with its own date_created
+        self.assertEqual(rows, [(30, 60)])
+
+        # And the device should have eight readings
+        cur.execute('select * from readings where device_uuid="{}"'.format(self.device_uuid))
+        self.assertEqual(len(cur.fetchall()), 8)
+
+    def test_device_readings_batch_post_invalid_parameters(self):
+        #If we make a request with an empty list
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data=json.dumps([]))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+        #If we make a request with a single reading instead of a list
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid),
+                                     data=json.dumps({'type': 'temperature', 'value': 22}))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+        #If we make a request with non-JSON POST data
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid), data="No data")
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+        #If we make a request with only invalid readings
+        request = self.client().post('/devices/{}/readings/batch/'.format(self.device_uuid),
+                                     data=json.dumps([{'type': 'temperature', 'value': -1}]))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+        self.assertEqual(json.loads(request.data)['accepted'], 0)
+
+    def test_fleet_readings_ingest(self):
+        # Given a newline delimited stream of readings of several devices
+        lines = [json.dumps({'device_uuid': self.device_uuid, 'type': 'temperature', 'value': 30}),
+                 json.dumps({'device_uuid': 'other_uuid', 'type': 'humidity', 'value': 40, 'date_created': 60}),
+                 '',
+                 json.dumps({'device_uuid': 'new_uuid', 'type': 'temperature', 'value': 101}),
+                 'No data',
+                 json.dumps({'type': 'temperature', 'value': 10})]
+
+        # When we post the stream with a chunk size smaller than the number of readings
+        app.config['INGEST_CHUNK_SIZE'] = 1
+        try:
+            request = self.client().post('/readings/ingest/', data='\n'.join(lines),
+                                         content_type='application/x-ndjson')
+        finally:
+            app.config['INGEST_CHUNK_SIZE'] = 5000
+
+        # Then we should receive a 201
+        self.assertEqual(request.status_code, 201)
+
+        # And the invalid lines should be reported by their line number
+        response = json.loads(request.data)
+        self.assertEqual(response['accepted'], 2)
+        self.assertEqual(response['rejected'], 3)
+        self.assertEqual([error['line'] for error in response['errors']], [4, 5, 6])
+
+        # And when we check for readings in the db
+        conn = sqlite3.connect('test_database.db')
+        cur = conn.cursor()
+        cur.execute('select device_uuid, count(*) from readings group by device_uuid order by device_uuid')
+
+        # Every device should have received its reading
+        self.assertEqual(cur.fetchall(), [('other_uuid', 2), (self.device_uuid, 7)])
+
+        #If we post a stream without valid readings
+        request = self.client().post('/readings/ingest/', data='No data\n')
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
     def test_device_readings_get_invalid_parameters(self):
         #If we make a request with an invalid 'type' parameter
         request = self.client().get('/devices/{}/readings/'.format(self.device_uuid),
@@ -674,7 +856,7 @@ class SensorRoutesTestCases(unittest.TestCase):
         self.assertEqual(request.status_code, 200)
 
         #And receive the following dicts as a result
-        self.assertDictEqual(json.loads(request.data)[0],
+        self.assertDictEqual(json.loads(request.data)[1],
                              {'device_uuid': 'other_uuid',
                               'number_of_readings': 1,
                               'min_reading_value': 22,
@@ -684,7 +866,7 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'quartile_1_value': 22,
                               'quartile_3_value': 22})
 
-        self.assertDictEqual(json.loads(request.data)[1],
+        self.assertDictEqual(json.loads(request.data)[0],
                              {'device_uuid': self.device_uuid,
                               'number_of_readings': 6,
                               'min_reading_value': 10,
@@ -692,7 +874,7 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'median_reading_value': 42,
                               'mean_reading_value': 41.17,
                               'quartile_1_value': 22,
-                              'quartile_3_value': 42})
+                              'quartile_3_value': 50})
 
 
         #When we make a request with missing payload
@@ -702,7 +884,7 @@ class SensorRoutesTestCases(unittest.TestCase):
         self.assertEqual(request.status_code, 200)
 
         #And receive the following dicts as a result
-        self.assertDictEqual(json.loads(request.data)[0],
+        self.assertDictEqual(json.loads(request.data)[1],
                              {'device_uuid': 'other_uuid',
                               'number_of_readings': 1,
                               'min_reading_value': 22,
@@ -712,7 +894,7 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'quartile_1_value': 22,
                               'quartile_3_value': 22})
 
-        self.assertDictEqual(json.loads(request.data)[1],
+        self.assertDictEqual(json.loads(request.data)[0],
                              {'device_uuid': self.device_uuid,
                               'number_of_readings': 6,
                               'min_reading_value': 10,
@@ -720,7 +902,7 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'median_reading_value': 42,
                               'mean_reading_value': 41.17,
                               'quartile_1_value': 22,
-                              'quartile_3_value': 42})
+                              'quartile_3_value': 50})
      
         #When we make a valid request for 'type' temperature
         request = self.client().get('/summary/',
@@ -730,7 +912,7 @@ class SensorRoutesTestCases(unittest.TestCase):
         self.assertEqual(request.status_code, 200)
 
         #And receive the following dict as a result
-        self.assertDictEqual(json.loads(request.data)[0],
+        self.assertDictEqual(json.loads(request.data)[1],
                              {'device_uuid': 'other_uuid',
                               'number_of_readings': 1,
                               'min_reading_value': 22,
@@ -740,15 +922,15 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'quartile_1_value': 22,
                               'quartile_3_value': 22})
 
-        self.assertDictEqual(json.loads(request.data)[1],
+        self.assertDictEqual(json.loads(request.data)[0],
                              {'device_uuid': self.device_uuid,
                               'number_of_readings': 4,
                               'min_reading_value': 10,
                               'max_reading_value': 100,
-                              'median_reading_value': 42,
+                              'median_reading_value': 22,
                               'mean_reading_value': 45.5,
-                              'quartile_1_value': 22,
-                              'quartile_3_value': 42})
+                              'quartile_1_value': 10,
+                              'quartile_3_value': 50})
 
         #When we make a valid request for 'type' humudity
         request = self.client().get('/summary/',
@@ -763,9 +945,9 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'number_of_readings': 2,
                               'min_reading_value': 23,
                               'max_reading_value': 42,
-                              'median_reading_value': 42,
+                              'median_reading_value': 23,
                               'mean_reading_value': 32.5,
-                              'quartile_1_value': 22,
+                              'quartile_1_value': 23,
                               'quartile_3_value': 42})
 
         #When we make a valid request for 'type' temperature and 'start' >= 10 and 'end' <= 25
@@ -782,10 +964,10 @@ class SensorRoutesTestCases(unittest.TestCase):
                               'number_of_readings': 3,
                               'min_reading_value': 10,
                               'max_reading_value': 100,
-                              'median_reading_value': 42,
+                              'median_reading_value': 50,
                               'mean_reading_value': 53.33,
-                              'quartile_1_value': 22,
-                              'quartile_3_value': 42})
+                              'quartile_1_value': 10,
+                              'quartile_3_value': 100})
 
         #When we make valid request with dates in the future
         request = self.client().get('/summary/',
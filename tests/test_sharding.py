@@ -0,0 +1,130 @@
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import db
+import sharding
+from app import create_app
+
+class ShardedStorageTestCases(unittest.TestCase):
+
+    def setUp(self):
+        db.dispose_engines()
+        self.root = tempfile.mkdtemp()
+        self.config = {'TESTING': True,
+                       'STORAGE_ENGINE': 'sharded',
+                       'SHARD_COUNT': 3,
+                       'TEST_SHARD_DATABASE_URI': 'sqlite:///' + os.path.join(self.root, 'shard_{shard}.db')}
+        self.app = create_app(self.config)
+        self.storage = self.app.extensions['storage']
+        conn = sqlite3.connect('test_database.db')
+        for table in ('readings', 'reading_aggregates', 'reading_rollups', 'reading_histograms', 'reading_sketches'):
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.commit()
+        conn.close()
+        self.single_app = create_app({'TESTING': True})
+        self.single_storage = self.single_app.extensions['storage']
+
+        # Setup the same readings of many devices in the sharded engine and a single database
+        generator = random.Random(13)
+        self.rows = [{'device_uuid': f'device_{generator.randint(0, 20)}',
+                      'type': generator.choice(['temperature', 'humidity']),
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 50000)} for _ in range(3000)]
+        for engine in (self.storage, self.single_storage):
+            engine.insert_many(self.rows)
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+        shutil.rmtree(self.root)
+
+    def test_shard_index(self):
+        #When we route the devices to the shards
+        shards = [sharding.shard_index(f'device_{i}', 3) for i in range(300)]
+
+        #Then every shard should get a share of the devices, the same in every process
+        self.assertEqual(set(shards), {0, 1, 2})
+        self.assertEqual(sharding.shard_index('device_1', 3), sharding.shard_index('device_1', 3))
+
+    def test_devices_live_on_one_shard(self):
+        for index in range(3):
+            #When we read the readings stored in a shard file
+            conn = sqlite3.connect(os.path.join(self.root, f'shard_{index}.db'))
+            devices = set(row[0] for row in conn.execute('SELECT DISTINCT device_uuid FROM readings'))
+            conn.close()
+
+            #Then they should all belong to devices routed to that shard
+            self.assertTrue(devices)
+            self.assertTrue(all(sharding.shard_index(device_uuid, 3) == index for device_uuid in devices))
+
+    def test_engines_agree(self):
+        #When we query per device and fleet wide
+        #Then the sharded engine should return the results of a single store
+        for start, end in [(None, None), (1000, 30000)]:
+            self.assertEqual(self.storage.aggregate('device_4', 'temperature', start, end),
+                             self.single_storage.aggregate('device_4', 'temperature', start, end))
+            self.assertEqual(self.storage.statistics('device_5', 'humidity', start, end),
+                             self.single_storage.statistics('device_5', 'humidity', start, end))
+            device_uuids = [f'device_{i}' for i in range(25)]
+            self.assertEqual(self.storage.fleet_statistics(device_uuids, 'humidity', start, end),
+                             self.single_storage.fleet_statistics(device_uuids, 'humidity', start, end))
+            for order_by in ['device_uuid', 'number_of_readings', 'mean_reading_value', 'median_reading_value']:
+                for descending in (True, False):
+                    expected = list(self.single_storage.summaries(order_by, descending, 'temperature', start, end))
+                    self.assertEqual(list(self.storage.summaries(order_by, descending, 'temperature', start, end)), expected)
+
+                    #And pages should continue after the last device of the previous page
+                    page = list(self.storage.summaries(order_by, descending, 'temperature', start, end, after=expected[4][:1] + (expected[4][1]['device_uuid'],), limit=5))
+                    self.assertEqual(page, expected[5:10], (order_by, descending))
+
+    def test_summary_endpoint(self):
+        for data in [{}, {'type': 'humidity', 'order_by': 'quartile_3_value', 'order': 'asc', 'top_n': 7}]:
+            #When we request the summary of both apps
+            responses = []
+            for app in (self.app, self.single_app):
+                response = app.test_client().get('/summary/', data=json.dumps(data))
+                responses.append((response.status_code, json.loads(response.data)))
+                response.close()
+
+            #Then the merged summaries of the shards should equal the summary of the single database
+            self.assertEqual(responses[0], responses[1])
+            self.assertEqual(responses[0][0], 200)
+
+    def test_slow_summaries_do_not_starve_writes(self):
+        #Given more paused summaries than executor threads, as of clients reading slowly
+        storage = sharding.ShardedStorage(self.storage.shards, 2)
+        with self.app.app_context():
+            summaries = [storage.summaries('number_of_readings', True, chunk_size=1) for _ in range(4)]
+            for iterator in summaries:
+                next(iterator)
+
+            #When readings of devices on several shards are written
+            writer = threading.Thread(target=storage.insert_many,
+                                      args=([dict(row, date_created=60000) for row in self.rows[:50]],))
+            writer.start()
+            writer.join(10)
+
+            #Then the write should not wait for the summaries
+            self.assertFalse(writer.is_alive())
+            for iterator in summaries:
+                iterator.close()
+
+    def test_insert_after_executor_shutdown(self):
+        #Given an executor which was shut down, as at interpreter exit
+        self.storage.executor.shutdown()
+
+        #When readings of devices on several shards are written
+        rows = [dict(row, date_created=60000) for row in self.rows[:50]]
+        self.storage.insert_many(rows)
+
+        #Then they should be written on the calling thread
+        with self.app.app_context():
+            written = sum(len(list(self.storage.readings(device_uuid, start=60000)))
+                          for device_uuid in set(row['device_uuid'] for row in rows))
+        self.assertEqual(written, 50)
@@ -0,0 +1,242 @@
+import bisect
+import json
+import random
+import sqlite3
+import time
+import unittest
+
+import db
+import histograms
+import ingest
+import models
+import rollups
+import sketches
+from app import create_app
+
+def rank_distance(sorted_values, value, rank):
+    """Returns how many ranks value is away from rank in sorted_values"""
+    lo = bisect.bisect_left(sorted_values, value) + 1
+    hi = bisect.bisect_right(sorted_values, value)
+    if lo <= rank <= hi:
+        return 0
+    return min(abs(lo - rank), abs(hi - rank))
+
+class KLLSketchTestCases(unittest.TestCase):
+
+    def setUp(self):
+        generator = random.Random(42)
+        self.values = [generator.uniform(-1000, 1000) for _ in range(20000)]
+        self.sorted_values = sorted(self.values)
+
+    def assertWithinRankError(self, sketch):
+        n = len(self.sorted_values)
+        for rank in range(1, n + 1, 97):
+            distance = rank_distance(self.sorted_values, sketch.quantile(rank), rank)
+            self.assertLessEqual(distance, sketches.rank_error(sketch.k) * n, rank)
+
+    def test_update(self):
+        #When we add fractional values to a sketch
+        sketch = sketches.KLLSketch()
+        for value in self.values:
+            sketch.update(value)
+
+        #Then it should hold far fewer items than values
+        self.assertEqual(sketch.number_of_readings, len(self.values))
+        self.assertLess(sum(len(values) for values in sketch.levels), 1000)
+
+        #And every rank should be within the error bound
+        self.assertWithinRankError(sketch)
+
+    def test_merge(self):
+        #When we merge the sketches of 30 buckets
+        parts = [sketches.KLLSketch() for _ in range(30)]
+        for position, value in enumerate(self.values):
+            parts[position % 30].update(value)
+        sketch = sketches.KLLSketch()
+        for part in parts:
+            sketch.merge(part)
+
+        #Then every rank should still be within the error bound
+        self.assertEqual(sketch.number_of_readings, len(self.values))
+        self.assertWithinRankError(sketch)
+
+    def test_serialization(self):
+        sketch = sketches.KLLSketch()
+        for value in self.values:
+            sketch.update(value)
+
+        #When we serialize and deserialize a sketch
+        data = sketch.to_bytes()
+        restored = sketches.KLLSketch.from_bytes(data)
+
+        #Then it should hold the same items in 8 bytes per item plus a small header
+        self.assertEqual(restored.levels, sketch.levels)
+        self.assertEqual(restored.number_of_readings, sketch.number_of_readings)
+        self.assertLess(len(data), 8 * sum(len(values) for values in sketch.levels) + 64)
+
+        #And an unknown format should be rejected
+        self.assertRaises(ValueError, sketches.KLLSketch.from_bytes, b'\x02' + data[1:])
+
+    def test_small_sketch_is_exact(self):
+        #When a sketch holds fewer values than its capacity
+        sketch = sketches.KLLSketch()
+        for value in [50, 10, 100, 22]:
+            sketch.update(value)
+
+        #Then the ranks should be exact
+        self.assertEqual([sketch.quantile(rank) for rank in range(1, 5)], [10, 22, 50, 100])
+
+class SketchQueryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.session = db.get_session(self.app.config)
+        sketches.rebuild_sketches(self.session)
+        histograms.rebuild_histograms(self.session)
+        rollups.rebuild_rollups(self.session)
+
+        # Setup fractional readings spread over three days, inserted in several transactions
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': 'test_device',
+                      'type': 'temperature',
+                      'value': round(generator.uniform(0, 100), 3),
+                      'date_created': generator.randint(0, 3 * rollups.DAY)} for _ in range(5000)]
+        for position in range(0, len(self.rows), 1000):
+            ingest.insert_readings(self.session, self.rows[position:position + 1000])
+            self.session.commit()
+        self.client = self.app.test_client
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_range_sketch(self):
+        generator = random.Random(7)
+        for _ in range(20):
+            #When we query the sketch of a random range
+            start = generator.randint(0, 3 * rollups.DAY)
+            end = generator.randint(start, 3 * rollups.DAY)
+            sketch = sketches.range_sketch(self.session, 'test_device', 'temperature', start, end)
+            values = sorted(row['value'] for row in self.rows if start <= row['date_created'] <= end)
+            if not values:
+                self.assertIsNone(sketch)
+                continue
+
+            #Then it should hold every reading of the range and its median should be within the error bound
+            self.assertEqual(sketch.number_of_readings, len(values), (start, end))
+            rank = histograms.quartile_ranks(len(values))[1]
+            self.assertLessEqual(rank_distance(values, sketch.quantile(rank), rank), sketches.rank_error() * len(values))
+
+    def test_rebuild_sketches(self):
+        #When we rebuild the sketches
+        self.assertEqual(sketches.rebuild_sketches(self.session), 5000)
+
+        #Then open ranges should still hold every reading
+        sketch = sketches.range_sketch(self.session, 'test_device', 'temperature', start=rollups.DAY)
+        self.assertEqual(sketch.number_of_readings, sum(1 for row in self.rows if row['date_created'] >= rollups.DAY))
+
+        #And a device without readings should have no sketch
+        self.assertIsNone(sketches.range_sketch(self.session, 'other_uuid', 'temperature'))
+
+    def test_approx_endpoints(self):
+        values = sorted(row['value'] for row in self.rows)
+        ranks = histograms.quartile_ranks(len(values))
+        tolerance = sketches.rank_error() * len(values)
+
+        #When we request the approximate median
+        request = self.client().get('/devices/test_device/readings/median/',
+                                    data=json.dumps({'type': 'temperature', 'precision': 'approx'}))
+
+        #Then we should receive a reading within the error bound
+        result = json.loads(request.data)
+        self.assertLessEqual(rank_distance(values, result['value'], ranks[1]), tolerance)
+        self.assertIn({'value': result['value'], 'date_created': result['date_created']},
+                      [{'value': row['value'], 'date_created': row['date_created']} for row in self.rows])
+
+        #When we request the approximate quartiles
+        request = self.client().get('/devices/test_device/readings/quartiles/',
+                                    data=json.dumps({'type': 'temperature', 'start': 0, 'end': 3 * rollups.DAY, 'precision': 'approx'}))
+
+        #Then both should be within the error bound
+        result = json.loads(request.data)
+        self.assertLessEqual(rank_distance(values, result['quartile_1'], ranks[0]), tolerance)
+        self.assertLessEqual(rank_distance(values, result['quartile_3'], ranks[2]), tolerance)
+
+        #When we request an approximate percentile
+        request = self.client().get('/devices/test_device/readings/percentile/',
+                                    data=json.dumps({'type': 'temperature', 'percentile': 99, 'precision': 'approx'}))
+
+        #Then it should be within the error bound
+        rank = histograms.percentile_rank(len(values), 99)
+        self.assertLessEqual(rank_distance(values, json.loads(request.data)['value'], rank), tolerance)
+
+        #When we request an unknown precision
+        request = self.client().get('/devices/test_device/readings/median/',
+                                    data=json.dumps({'type': 'temperature', 'precision': 'fast'}))
+
+        #We should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+    def test_stale_sketches_are_refreshed(self):
+        #Given sketches stored by a first query
+        sketches.range_sketch(self.session, 'test_device', 'temperature')
+        stored = self.session.query(models.ReadingSketch).count()
+        self.assertGreater(stored, 0)
+
+        #When a reading is inserted into a stored hour
+        row = {'device_uuid': 'test_device', 'type': 'temperature', 'value': 1000, 'date_created': rollups.DAY + 10}
+        ingest.insert_readings(self.session, [row])
+        self.session.commit()
+
+        #Then the insert should not touch the sketches
+        hour = self.session.query(models.ReadingSketch).filter_by(granularity=rollups.HOUR, bucket_start=rollups.DAY).one()
+        self.assertEqual(hour.number_of_readings, sum(1 for other in self.rows if rollups.DAY <= other['date_created'] < rollups.DAY + rollups.HOUR))
+
+        #And the next query should hold the reading and store the refreshed hour and day sketches
+        sketch = sketches.range_sketch(self.session, 'test_device', 'temperature')
+        self.assertEqual(sketch.number_of_readings, len(self.rows) + 1)
+        self.assertEqual(sketch.quantile(sketch.number_of_readings), 1000)
+        self.session.expire_all()
+        self.assertEqual(hour.number_of_readings, sum(1 for other in self.rows + [row] if rollups.DAY <= other['date_created'] < rollups.DAY + rollups.HOUR))
+        day = self.session.query(models.ReadingSketch).filter_by(granularity=rollups.DAY, bucket_start=rollups.DAY).one()
+        self.assertEqual(day.number_of_readings, sum(1 for other in self.rows + [row] if rollups.DAY <= other['date_created'] < 2 * rollups.DAY))
+
+    def test_refresh_does_not_wait_for_write_lock(self):
+        #Given stale sketches and another connection holding the write lock, as an ingest transaction would
+        sketches.range_sketch(self.session, 'test_device', 'temperature')
+        ingest.insert_readings(self.session, [{'device_uuid': 'test_device', 'type': 'temperature', 'value': 1000, 'date_created': rollups.DAY + 10}])
+        self.session.commit()
+        writer = sqlite3.connect('test_database.db', isolation_level=None)
+        writer.execute('BEGIN IMMEDIATE')
+        try:
+            #When we query the sketch
+            began = time.monotonic()
+            sketch = sketches.range_sketch(self.session, 'test_device', 'temperature')
+
+            #Then the query should not wait for the busy_timeout and still hold every reading
+            self.assertLess(time.monotonic() - began, 2)
+            self.assertEqual(sketch.number_of_readings, len(self.rows) + 1)
+        finally:
+            writer.execute('ROLLBACK')
+            writer.close()
+
+        #And the refreshed sketches should not be stored
+        in_hour = sum(1 for row in self.rows if rollups.DAY <= row['date_created'] < rollups.DAY + rollups.HOUR)
+        hour = self.session.query(models.ReadingSketch).filter_by(granularity=rollups.HOUR, bucket_start=rollups.DAY).one()
+        self.assertEqual(hour.number_of_readings, in_hour)
+
+        #And the connection should keep its busy_timeout
+        self.assertEqual(self.session.connection().exec_driver_sql('PRAGMA busy_timeout').scalar(), 5000)
+
+        #When the lock is released
+        #Then the next query should store them
+        sketches.range_sketch(self.session, 'test_device', 'temperature')
+        self.session.expire_all()
+        self.assertEqual(hour.number_of_readings, in_hour + 1)
@@ -0,0 +1,209 @@
+import json
+import random
+import sqlite3
+import unittest
+
+import aggregates
+import analytics
+import db
+import histograms
+import rollups
+import storage
+from app import create_app
+
+class StorageTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.config = {'TESTING': True}
+        session = db.get_session(self.config)
+        aggregates.rebuild_aggregates(session)
+        rollups.rebuild_rollups(session)
+        histograms.rebuild_histograms(session)
+        self.engines = [storage.SQLiteStorage(self.config), storage.MemoryStorage()]
+
+        # Setup the same readings in every storage engine
+        generator = random.Random(3)
+        self.rows = [{'device_uuid': f'device_{generator.randint(0, 5)}',
+                      'type': generator.choice(['temperature', 'humidity']),
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 50000)} for _ in range(1000)]
+        for engine in self.engines:
+            engine.insert_many(self.rows[:-1])
+            engine.insert(self.rows[-1])
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def test_engines_agree(self):
+        sqlite_storage, memory_storage = self.engines
+        for start, end in [(None, None), (1000, 30000), (60000, 70000)]:
+            #When we query both engines
+            #Then they should return the same results
+            self.assertEqual(memory_storage.aggregate('device_1', 'temperature', start, end),
+                             sqlite_storage.aggregate('device_1', 'temperature', start, end))
+            self.assertEqual(memory_storage.mode('device_2', 'humidity', start, end),
+                             sqlite_storage.mode('device_2', 'humidity', start, end))
+            self.assertCountEqual(list(memory_storage.readings('device_3', None, start, end)),
+                                  [dict(row) for row in sqlite_storage.readings('device_3', None, start, end)])
+            self.assertEqual(list(memory_storage.summaries('median_reading_value', True, 'temperature', start, end)),
+                             list(sqlite_storage.summaries('median_reading_value', True, 'temperature', start, end)))
+            memory_quantiles = memory_storage.quantiles('device_4', 'temperature', start, end)
+            sqlite_quantiles = sqlite_storage.quantiles('device_4', 'temperature', start, end)
+            if sqlite_quantiles is None:
+                self.assertIsNone(memory_quantiles)
+                continue
+            self.assertEqual(memory_quantiles[0], sqlite_quantiles[0])
+            for rank in histograms.quartile_ranks(sqlite_quantiles[0]):
+                value = sqlite_quantiles[1](rank)
+                self.assertEqual(memory_quantiles[1](rank), value)
+                self.assertEqual(memory_storage.earliest_date_created('device_4', 'temperature', value, start, end),
+                                 sqlite_storage.earliest_date_created('device_4', 'temperature', value, start, end))
+
+    def test_readings_pages(self):
+        for engine in self.engines:
+            #When we walk the readings of a device in pages of 9
+            pages = []
+            after = None
+            while True:
+                readings, after = engine.readings_page('device_0', 9, after)
+                pages.extend(readings)
+                if after is None:
+                    break
+
+            #Then every reading should be returned once ordered by date_created
+            dates = [reading['date_created'] for reading in pages]
+            self.assertEqual(dates, sorted(dates))
+            self.assertCountEqual(pages, [row for row in self.rows if row['device_uuid'] == 'device_0'])
+
+    def test_memory_endpoints(self):
+        #Given an app using the in-memory storage engine
+        client = create_app({'TESTING': True, 'STORAGE_ENGINE': 'memory'}).test_client
+
+        #When we post readings
+        for value in (10, 30, 20):
+            request = client().post('/devices/test_device/readings/', data=json.dumps({'type': 'temperature', 'value': value}))
+            self.assertEqual(request.status_code, 201)
+
+        #Then the metrics should be computed from them
+        request = client().get('/devices/test_device/readings/mean/', data=json.dumps({'type': 'temperature'}))
+        self.assertEqual(json.loads(request.data), {'value': 20.0})
+        request = client().get('/devices/test_device/readings/median/', data=json.dumps({'type': 'temperature'}))
+        self.assertEqual(json.loads(request.data)['value'], 20)
+        request = client().get('/summary/')
+        self.assertEqual([row['number_of_readings'] for row in json.loads(request.data)], [3])
+
+    def test_stats_endpoint(self):
+        configs = [{'TESTING': True}, {'TESTING': True, 'STORAGE_ENGINE': 'memory'}]
+        if analytics.np is not None:
+            configs.append({'TESTING': True, 'QUANTILE_ENGINE': 'numpy'})
+        for config in configs:
+            client = create_app(config).test_client
+            if config.get('STORAGE_ENGINE') == 'memory':
+                client().post('/readings/ingest/', data='\n'.join(json.dumps(row) for row in self.rows))
+            for data in [{}, {'start': 1000, 'end': 30000}]:
+                data = dict(data, type='temperature')
+
+                #When we request every statistic at once
+                request = client().get('/devices/device_1/readings/stats/', data=json.dumps(data))
+                result = json.loads(request.data)
+
+                #Then each one should match the response of its own endpoint
+                self.assertEqual(request.status_code, 200)
+                self.assertCountEqual(result, storage.STATISTICS)
+                for metric in storage.STATISTICS[1:]:
+                    metric_data = dict(data, start=data.get('start', 0), end=data.get('end', 100000)) if metric == 'quartiles' else data
+                    expected = client().get(f'/devices/device_1/readings/{metric}/', data=json.dumps(metric_data))
+                    self.assertEqual(result[metric], json.loads(expected.data), (config, metric))
+
+            #When we request a subset of the statistics
+            request = client().get('/devices/device_1/readings/stats/', data=json.dumps({'type': 'temperature', 'metrics': ['mean', 'number_of_readings']}))
+
+            #Then only those should be returned
+            self.assertCountEqual(json.loads(request.data), ['mean', 'number_of_readings'])
+            expected = client().get('/devices/device_1/readings/stats/', data=json.dumps({'type': 'temperature'}))
+            self.assertEqual(json.loads(request.data)['number_of_readings'], json.loads(expected.data)['number_of_readings'])
+
+        #When we request an unknown statistic
+        request = client().get('/devices/device_1/readings/stats/', data=json.dumps({'type': 'temperature', 'metrics': ['sum']}))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+    def test_fleet_query(self):
+        client = create_app({'TESTING': True}).test_client
+        device_uuids = [f'device_{i}' for i in range(6)] + ['other_uuid']
+        for data in [{}, {'start': 1000, 'end': 30000}, {'metrics': ['median', 'number_of_readings']}]:
+            data = dict(data, type='humidity')
+
+            #When we query the statistics of many devices at once
+            request = client().post('/readings/query/', data=json.dumps(dict(data, device_uuids=device_uuids)))
+
+            #Then every device should have the result of its own stats request
+            self.assertEqual(request.status_code, 200)
+            result = json.loads(request.data)
+            self.assertEqual(sorted(result), sorted(device_uuids))
+            for device_uuid in device_uuids:
+                expected = client().get(f'/devices/{device_uuid}/readings/stats/', data=json.dumps(data))
+                self.assertEqual(result[device_uuid], json.loads(expected.data), (data, device_uuid))
+            self.assertEqual(result['other_uuid'], {})
+
+        #And the in-memory engine should return the same results
+        memory_result = storage.MemoryStorage()
+        memory_result.insert_many(self.rows)
+        self.assertEqual(memory_result.fleet_statistics(device_uuids, 'humidity', 1000, 30000),
+                         self.engines[0].fleet_statistics(device_uuids, 'humidity', 1000, 30000))
+
+        #When we query without devices
+        request = client().post('/readings/query/', data=json.dumps({'type': 'humidity', 'device_uuids': []}))
+
+        #Then we should receive a 422
+        self.assertEqual(request.status_code, 422)
+
+    def test_buckets_endpoint(self):
+        responses = []
+        for config in [{'TESTING': True}, {'TESTING': True, 'STORAGE_ENGINE': 'memory'}]:
+            client = create_app(config).test_client
+            if config.get('STORAGE_ENGINE') == 'memory':
+                client().post('/readings/ingest/', data='\n'.join(json.dumps(row) for row in self.rows))
+
+            #When we request 100 buckets of a range
+            data = {'type': 'temperature', 'start': 1000, 'end': 41000, 'points': 100}
+            request = client().get('/devices/device_1/readings/buckets/', data=json.dumps(data))
+
+            #Then the readings should be aggregated into whole minute buckets
+            self.assertEqual(request.status_code, 200)
+            result = json.loads(request.data)
+            self.assertEqual(result['bucket'], 420)
+            self.assertLessEqual(len(result['buckets']), 100)
+            readings = [row for row in self.rows
+                        if row['device_uuid'] == 'device_1' and row['type'] == 'temperature' and 1000 <= row['date_created'] <= 41000]
+            self.assertEqual(sum(bucket['number_of_readings'] for bucket in result['buckets']), len(readings))
+            self.assertEqual(min(bucket['min'] for bucket in result['buckets']), min(row['value'] for row in readings))
+            responses.append(result)
+
+            #When we select readings with lttb
+            request = client().get('/devices/device_1/readings/buckets/', data=json.dumps({'type': 'temperature', 'method': 'lttb', 'points': 10}))
+
+            #Then the first and last of the selected readings should be the first and last reading
+            self.assertEqual(request.status_code, 200)
+            selected = json.loads(request.data)['readings']
+            self.assertEqual(len(selected), 10)
+            dates = sorted(row['date_created'] for row in self.rows if row['device_uuid'] == 'device_1' and row['type'] == 'temperature')
+            self.assertEqual((selected[0]['date_created'], selected[-1]['date_created']), (dates[0], dates[-1]))
+
+            #When we neither pass a bucket nor a closed range
+            request = client().get('/devices/device_1/readings/buckets/', data=json.dumps({'type': 'temperature', 'points': 10}))
+
+            #Then we should receive a 422
+            self.assertEqual(request.status_code, 422)
+
+        #And both engines should return the same buckets
+        self.assertEqual(responses[0], responses[1])
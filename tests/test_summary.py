@@ -0,0 +1,126 @@
+import json
+import random
+import sqlite3
+import unittest
+
+import aggregates
+import db
+import histograms
+import ingest
+import queries
+import summary
+from app import create_app
+
+class SummaryTestCases(unittest.TestCase):
+
+    def setUp(self):
+        conn = sqlite3.connect('test_database.db')
+        conn.execute('DROP TABLE IF EXISTS readings')
+        conn.execute('CREATE TABLE IF NOT EXISTS readings (id INTEGER, device_uuid TEXT, type TEXT, value INTEGER, date_created INTEGER)')
+        conn.commit()
+        conn.close()
+
+        db.dispose_engines()
+        self.app = create_app({'TESTING': True})
+        self.session = db.get_session(self.app.config)
+        aggregates.rebuild_aggregates(self.session)
+
+        # Setup readings of 30 devices and both sensor types
+        generator = random.Random(42)
+        self.rows = [{'device_uuid': f'device_{generator.randint(0, 29)}',
+                      'type': generator.choice(['temperature', 'humidity']),
+                      'value': generator.randint(0, 100),
+                      'date_created': generator.randint(0, 1000)} for _ in range(3000)]
+        ingest.insert_readings(self.session, self.rows)
+        self.session.commit()
+
+    def tearDown(self):
+        db.remove_session()
+        db.dispose_engines()
+
+    def expected_summaries(self, sensor_type, start, end):
+        values = {}
+        for row in self.rows:
+            if (sensor_type is None or row['type'] == sensor_type) and start <= row['date_created'] <= end:
+                values.setdefault(row['device_uuid'], []).append(row['value'])
+        result = []
+        for device_uuid in sorted(values):
+            device_values = sorted(values[device_uuid])
+            ranks = histograms.quartile_ranks(len(device_values))
+            result.append({'device_uuid': device_uuid,
+                           'number_of_readings': len(device_values),
+                           'min_reading_value': device_values[0],
+                           'max_reading_value': device_values[-1],
+                           'mean_reading_value': aggregates.round_mean(sum(device_values), len(device_values)),
+                           'quartile_1_value': device_values[ranks[0] - 1],
+                           'median_reading_value': device_values[ranks[1] - 1],
+                           'quartile_3_value': device_values[ranks[2] - 1]})
+        return result
+
+    def test_iter_summaries(self):
+        for sensor_type, start, end in [(None, 0, 1000), ('temperature', 0, 1000), ('humidity', 100, 400), (None, 990, 1000)]:
+            #When we summarize the readings matching the filters
+            rows = queries.summary_value_counts_query(self.session, sensor_type, start, end)
+            result = list(summary.iter_summaries(rows))
+
+            #Then every device summary should respect type, start and end
+            self.assertEqual(result, self.expected_summaries(sensor_type, start, end), (sensor_type, start, end))
+
+    def test_summary_query_plan(self):
+        #When we explain the summary query filtered by type
+        plan = db.explain_query_plan(self.session, queries.summary_value_counts_query(self.session, 'temperature', 0, 1))
+
+        #Then the groups should stream from the index without sorting
+        self.assertEqual(len(plan), 1)
+        self.assertIn('COVERING INDEX ix_readings_device_type_value_date', plan[0])
+
+    def test_ordered_summaries(self):
+        for start, end in [(None, None), (100, 900)]:
+            expected = self.expected_summaries('temperature', 0 if start is None else start, 1000 if end is None else end)
+            for order_by in summary.SUMMARY_COLUMNS:
+                for descending in (False, True):
+                    #When we order the summaries by a column
+                    result = [row for _, row in summary.iter_ordered_summaries(self.session, order_by, descending, 'temperature', start, end, chunk_size=7)]
+
+                    #Then they should be sorted by the column and ties by device_uuid
+                    ordered = sorted(expected, key=lambda row: row['device_uuid'])
+                    ordered = sorted(ordered, key=lambda row: row[order_by], reverse=descending)
+                    if order_by != 'device_uuid':
+                        self.assertEqual([row[order_by] for row in result], [row[order_by] for row in ordered])
+                        ties = [(row[order_by], row['device_uuid']) for row in result]
+                        self.assertEqual(ties, sorted(ties, key=lambda tie: ((-tie[0] if descending else tie[0]), tie[1])))
+                    else:
+                        self.assertEqual(result, ordered)
+                    self.assertCountEqual(result, expected)
+
+    def test_summary_pages(self):
+        client = self.app.test_client
+        for order_by in ('number_of_readings', 'median_reading_value'):
+            #When we request the top 5 devices
+            request = client().get('/summary/', data=json.dumps({'order_by': order_by, 'top_n': 5}))
+            top = json.loads(request.data)
+
+            #Then we should receive the first 5 devices of the full summary
+            request = client().get('/summary/', data=json.dumps({'order_by': order_by}))
+            full = json.loads(request.data)
+            self.assertEqual(top, full[:5])
+
+            #When we walk the summary in pages of 4 devices
+            pages = []
+            data = {'order_by': order_by, 'limit': 4}
+            while True:
+                request = client().get('/summary/', data=json.dumps(data))
+                page = json.loads(request.data)
+                pages.extend(page['summaries'])
+                if page['next_cursor'] is None:
+                    break
+                data['cursor'] = page['next_cursor']
+
+            #Then the pages should hold every device exactly once in order
+            self.assertEqual(pages, full)
+
+        #When we pass a cursor of a summary in a different order
+        request = client().get('/summary/', data=json.dumps({'order': 'asc', 'cursor': data['cursor']}))
+
+        #We should receive a 422
+        self.assertEqual(request.status_code, 422)
@@ -0,0 +1,50 @@
+import itertools
+import unittest
+
+import validation
+from jsonschema import ValidationError
+from app import (SENSOR_MAX, SENSOR_MIN, VALID_SENSOR_TYPES, request_device_readings_post_validator,
+                 request_fleet_reading_validator)
+
+TYPES = ['temperature', 'humidity', 'false', '', None, 0, 1, True, ['temperature']]
+VALUES = [0, 1, 22, 99.5, 100, 100.0, -1, -0.5, 100.5, 101, True, False, '22', None, [22], {},
+          float('nan'), float('inf'), float('-inf')]
+DATES = [5, 5.5, -1, True, '5', None, float('nan')]
+UUIDS = ['test_device', '', 1, None, True, ['test_device']]
+
+def payloads(with_device_uuid):
+    """Yields reading payloads covering every combination of valid and invalid fields"""
+    yield from [None, [], 'No data', 1, True, {}]
+    uuids = UUIDS if with_device_uuid else [None]
+    missing = object()
+    for device_uuid, sensor_type, value, date_created in itertools.product(uuids + [missing], TYPES + [missing],
+                                                                           VALUES + [missing], DATES + [missing]):
+        payload = {'extra': 1}
+        for key, field in (('device_uuid', device_uuid), ('type', sensor_type),
+                           ('value', value), ('date_created', date_created)):
+            if field is not missing:
+                payload[key] = field
+        yield payload
+
+class FastValidationTestCases(unittest.TestCase):
+
+    def assert_same_decisions(self, validator, require_device_uuid):
+        for payload in payloads(require_device_uuid):
+            expected = validator.is_valid(payload)
+            error = validation.reading_error(payload, VALID_SENSOR_TYPES, SENSOR_MIN, SENSOR_MAX, require_device_uuid)
+            self.assertEqual(error is None, expected, f'{payload!r}: {error}')
+
+    def test_reading_error_matches_jsonschema(self):
+        #Every payload should be accepted by the fast path exactly if jsonschema accepts it
+        self.assert_same_decisions(request_device_readings_post_validator, False)
+
+    def test_fleet_reading_error_matches_jsonschema(self):
+        #Every payload should be accepted by the fast path exactly if jsonschema accepts it
+        self.assert_same_decisions(request_fleet_reading_validator, True)
+
+    def test_validate_raises_best_match(self):
+        #When we validate an invalid payload with a precompiled validator
+        #Then we should receive the ValidationError jsonschema.validate raises
+        with self.assertRaises(ValidationError) as context:
+            validation.validate(request_device_readings_post_validator, {'type': 'temperature', 'value': -1})
+        self.assertEqual(context.exception.message, '-1 is less than the minimum of 0')
@@ -0,0 +1,62 @@
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+
+def compile_validator(schema):
+    """Checks schema and returns a validator which can be reused for every request
+
+    jsonschema.validate checks the schema and creates a new validator on every call,
+    which is one of the largest costs of a request.
+    """
+    Draft7Validator.check_schema(schema)
+    return Draft7Validator(schema)
+
+def validate(validator, instance):
+    """Validates instance with a precompiled validator
+
+    Raises the same ValidationError jsonschema.validate would raise for the schema of validator.
+    """
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+def is_number(value):
+    """JSON number check of jsonschema, booleans are no numbers"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def reading_error(data, sensor_types, value_min, value_max, require_device_uuid=False):
+    """Hand written validation of a single reading payload
+
+    Accepts and rejects exactly the payloads request_device_readings_schema_post
+    (or request_fleet_reading_schema if require_device_uuid is set) does,
+    without the overhead of jsonschema.
+
+    Returns the error message for an invalid payload or None if it is valid.
+    """
+    if not isinstance(data, dict):
+        return f'{data!r} is not of type \'object\''
+    if require_device_uuid:
+        if 'device_uuid' not in data:
+            return '\'device_uuid\' is a required property'
+        device_uuid = data['device_uuid']
+        if not isinstance(device_uuid, str):
+            return f'{device_uuid!r} is not of type \'string\''
+        if not device_uuid:
+            return f'{device_uuid!r} is too short'
+    if 'type' not in data:
+        return '\'type\' is a required property'
+    if 'value' not in data:
+        return '\'value\' is a required property'
+    sensor_type = data['type']
+    if sensor_type not in sensor_types:
+        return f'{sensor_type!r} is not one of {sensor_types!r}'
+    value = data['value']
+    if not is_number(value):
+        return f'{value!r} is not of type \'number\''
+    #Written as comparisons which fail for NaN, like the minimum/maximum keywords of jsonschema
+    if value < value_min:
+        return f'{value!r} is less than the minimum of {value_min!r}'
+    if value > value_max:
+        return f'{value!r} is greater than the maximum of {value_max!r}'
+    if 'date_created' in data and not is_number(data['date_created']):
+        return f'{data["date_created"]!r} is not of type \'number\''
+    return None